@@ -14,3 +14,13 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BookShareBackend.settings')
 
 application = get_asgi_application()
+
+# /notifications/stream/, the Server-Sent Events of the new notifications (see core/push.py)
+from core.push import with_notification_stream  # noqa: E402
+
+application = with_notification_stream(application)
+
+# Build the autocomplete index before the first request (see core/suggest.py)
+from core.suggest import warm_up  # noqa: E402
+
+warm_up()
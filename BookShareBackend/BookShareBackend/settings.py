@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -163,3 +164,61 @@ EMAIL_FROM = config("EMAIL_FROM")
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
 ]
+
+# Number of neighbours kept per book in the "more like this" similarity index
+SIMILARITY_INDEX_SIZE = 50
+
+# The recommendation results are cached per user (see core/recommendation_cache.py).
+# LocMemCache is a bounded LRU cache local to each process, point this alias to a
+# shared backend (Redis, Memcached) when running several workers.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'recommendations': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'recommendations',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# How often (seconds) a process reads again the version stamps shared through the database
+# (see core/recommendation_cache.py), the longest a change made by another process, such as
+# "manage.py update_similarity_index", takes to show up
+SHARED_VERSION_INTERVAL = 5
+
+# How long (seconds) the top rated chart is served from its snapshot before it is recomputed
+TOP_RATED_REFRESH = 10 * 60
+
+# How long (seconds) the facets of the home page are cached, a change of an owner's name or
+# address (searched, but not a catalog change) shows up in the counts within this time
+FACETS_TIMEOUT = 5 * 60
+
+# Notification push (see core/push.py): the longest wait (seconds) of a long-poll, and the
+# interval of the keep-alive comments of an event stream. A waiting long-poll holds a worker
+# thread, serve /notifications/poll/ with threaded or ASGI workers.
+NOTIFICATION_POLL_TIMEOUT = 25
+NOTIFICATION_STREAM_KEEPALIVE = 15
+
+# The notifications older than this (days) are deleted by "manage.py prune_notifications",
+# except the pending borrow requests (see core/retention.py)
+NOTIFICATION_RETENTION_DAYS = 90
+
+# Full-text index of the book and catalog searches (see core/search.py), None to search with LIKE
+SEARCH_BACKEND = 'core.search.SQLiteFTSBackend'
+
+# Per-view query budgets (see core/query_budget.py): with DEBUG on a request over its budget
+# is logged, with QUERY_BUDGET_STRICT on it raises. Requests slower than REQUEST_TIME_BUDGET
+# (milliseconds) are logged.
+QUERY_BUDGET_STRICT = False
+REQUEST_TIME_BUDGET = 1000
+
+# Where "python manage.py train_recommender" writes the collaborative-filtering model
+RECOMMENDER_MODEL_DIR = os.path.join(BASE_DIR, 'recommender_model')
+# The collaborative-filtering list replaces the content-based "recommended for you" of the
+# users it learned from at least this many ratings, None to never use it (the default: on the
+# benchmark catalog it scores below the content-based list, see benchmark_recommender --collaborative)
+COLLABORATIVE_MIN_RATINGS = None
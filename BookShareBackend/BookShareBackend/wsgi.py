@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BookShareBackend.settings')
 
 application = get_wsgi_application()
+
+# Build the autocomplete index before the first request (see core/suggest.py)
+from core.suggest import warm_up  # noqa: E402
+
+warm_up()
@@ -0,0 +1,143 @@
+import random
+import statistics
+import time
+import tracemalloc
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+
+from .models import Book, BookRating, BookRatingBucket, Category, UserBook
+from .ratings import repair_aggregates, repair_buckets
+from .search import get_backend
+from .similarity import rebuild_terms
+
+############################## Recommender benchmark helpers ##################################
+# Synthetic catalogs and the measurements used by "python manage.py benchmark_recommender"
+# and by the tests. The catalog is written with bulk_create, so no signal fires: the
+# similarity index and the caches are left alone, only the term index, the rating
+# aggregates, the rating buckets and the search index the requests depend on are rebuilt.
+
+BATCH_SIZE = 5000
+
+
+def generate_catalog(copies=1000, books=None, users=None, categories=25, ratings_per_user=20, seed=0):
+    # Every user likes two categories: books in them get ratings 7-10, the others 0-6,
+    # so the held-out high ratings can be predicted from the author/category features.
+    rng = random.Random(seed)
+    books = books or max(2, copies // 3)
+    users = users or max(2, copies // 20)
+    copies = min(copies, books * users)
+    User = get_user_model()
+
+    category_objs = Category.objects.bulk_create(
+        [Category(category=f'Synthetic Category {i}') for i in range(categories)], batch_size=BATCH_SIZE)
+    user_objs = User.objects.bulk_create(
+        [User(email=f'synthetic-{seed}-{i}@example.com', first_name='Synthetic', last_name=f'User {i}',
+              password='!', is_active=True) for i in range(users)], batch_size=BATCH_SIZE)
+    authors = [f'Synthetic Author {i}' for i in range(max(1, books // 4))]
+    book_objs = Book.objects.bulk_create(
+        [Book(book_name=f'Synthetic Book {i}', author=rng.choice(authors)) for i in range(books)],
+        batch_size=BATCH_SIZE)
+
+    # 1 to 3 categories per book, the first categories are the most popular ones
+    book_categories = {}
+    links = []
+    for book in book_objs:
+        chosen = {min(int(rng.expovariate(1 / 6)), categories - 1) for _ in range(rng.randint(1, 3))}
+        book_categories[book.id] = chosen
+        links += [Book.categories.through(book_id=book.id, category_id=category_objs[i].id) for i in chosen]
+    Book.categories.through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+
+    owned = set()
+    while len(owned) < copies:
+        owned.add((rng.randrange(users), rng.randrange(books)))
+    UserBook.objects.bulk_create(
+        [UserBook(book_owner_id=user_objs[user], book_id=book_objs[book]) for user, book in owned],
+        batch_size=BATCH_SIZE)
+
+    by_category = defaultdict(list)
+    for book in book_objs:
+        for i in book_categories[book.id]:
+            by_category[i].append(book)
+    ratings = []
+    for user in user_objs:
+        liked = {min(int(rng.expovariate(1 / 6)), categories - 1) for _ in range(2)}
+        pool = [book for i in liked for book in by_category[i]]
+        rated = {book.id: book for book in rng.sample(pool, min(len(pool), ratings_per_user // 2))}
+        rated.update((book.id, book) for book in rng.sample(book_objs, min(books, ratings_per_user // 2)))
+        for book in rated.values():
+            rating = rng.randint(7, 10) if book_categories[book.id] & liked else rng.randint(0, 6)
+            ratings.append(BookRating(book_id=book, book_rater_id=user, book_rating=rating))
+    BookRating.objects.bulk_create(ratings, batch_size=BATCH_SIZE)
+    repair_aggregates(Book, BookRating.objects.all(), 'book_id', 'book_rating')
+    repair_buckets(BookRatingBucket, BookRating.objects.all())
+    rebuild_terms()
+    if get_backend():
+        get_backend().rebuild()
+
+    return {
+        'users': user_objs,
+        'books': len(book_objs),
+        'copies': len(owned),
+        'ratings': len(ratings),
+    }
+
+
+def hold_out_ratings(users, fraction=0.2, seed=0):
+    # Remove a fraction of the high (> 6) ratings of these users, return {user id: held-out book ids}
+    rng = random.Random(seed)
+    high = defaultdict(list)
+    for rating_id, user_id, book_id in BookRating.objects.filter(
+            book_rater_id__in=[user.id for user in users], book_rating__gt=6).values_list(
+            'id', 'book_rater_id', 'book_id'):
+        high[user_id].append((rating_id, book_id))
+
+    held_out, removed = {}, []
+    for user_id, ratings in high.items():
+        # keep at least one high rating to seed the recommendations
+        count = min(len(ratings) - 1, round(len(ratings) * fraction))
+        if count > 0:
+            chosen = rng.sample(ratings, count)
+            held_out[user_id] = {book_id for _, book_id in chosen}
+            removed += [rating_id for rating_id, _ in chosen]
+    for start in range(0, len(removed), BATCH_SIZE):
+        BookRating.objects.filter(id__in=removed[start:start + BATCH_SIZE]).delete()
+    return held_out
+
+
+def precision_at_k(recommended, relevant, k=10):
+    # Mean over the users of |top k recommended books that are relevant| / k
+    if not relevant:
+        return 0.0
+    return statistics.mean(
+        len(set(recommended.get(user_id, [])[:k]) & books) / k for user_id, books in relevant.items())
+
+
+def measure(func, *args, repeat=5, with_stages=False):
+    # Run func repeat times, return the median wall time (s), the median time of every stage
+    # (func must accept timings= when with_stages is set) and the peak Python memory of one
+    # extra traced run (bytes)
+    walls, stages = [], defaultdict(list)
+    for _ in range(repeat):
+        timings = {}
+        start = time.perf_counter()
+        if with_stages:
+            func(*args, timings=timings)
+        else:
+            func(*args)
+        walls.append(time.perf_counter() - start)
+        for name, seconds in timings.items():
+            stages[name].append(seconds)
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall': statistics.median(walls),
+        'stages': {name: statistics.median(values) for name, values in stages.items()},
+        'peak_memory': peak,
+    }
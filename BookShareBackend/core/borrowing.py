@@ -0,0 +1,151 @@
+import functools
+import time
+
+from django.db import OperationalError, transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, PermissionDenied, ValidationError
+
+from .models import Notification, UserBook
+
+############################## Borrowing ##################################
+# The life of a copy, sent through /create-notification/ (see NotificationRequest):
+#
+#   available --borrow_request--> available, with a pending request (a Notification, one per sender)
+#   pending request --accept--> borrowed by its sender (the request is replaced by the answer)
+#   pending request --reject--> available (the request is replaced by the answer)
+#   borrowed --return--> available
+#
+# Every transition runs in one transaction that first locks the copy (SELECT ... FOR UPDATE,
+# then the request it answers), so two clicks of the owner or two requests racing for the
+# same copy are serialized: the second one sees the state left by the first and fails
+# instead of lending the copy twice. Each row is read once, the lock is held for the few
+# writes of the transition. The signals (indexes, caches) run after commit.
+# SQLite has no SELECT ... FOR UPDATE: both transactions read, and the second one to write
+# fails with "database is locked". It is run again (a new transaction, the state left by
+# the first one) after a short wait, or answers 409 when it can't be (inside an outer
+# transaction).
+
+RETRIES = 3
+RETRY_DELAY = 0.05
+
+BORROW_REQUEST = 'borrow_request'
+ACCEPT = 'accept'
+REJECT = 'reject'
+RETURN = 'return'
+
+
+class BorrowingError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_code = 'invalid_transition'
+
+
+class BookNotFound(NotFound):
+    default_detail = 'The Book does not exist.'
+
+
+class NotTheOwner(PermissionDenied):
+    default_detail = 'You do not have permission to perform this action.'
+
+
+class RequestNotFound(NotFound):
+    default_detail = 'The borrow request does not exist.'
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'This book is being updated, try again.'
+    default_code = 'conflict'
+
+
+def _transition(function):
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        for attempt in range(RETRIES):
+            outer = transaction.get_connection().in_atomic_block
+            try:
+                return function(*args, **kwargs)
+            except OperationalError as error:
+                if 'database is locked' not in str(error):
+                    raise
+                if outer or attempt == RETRIES - 1:
+                    raise Conflict()
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+    return run
+
+
+def _clean_message(message):
+    # Validated like NotificationsSerializer did when it created the notifications
+    from .serializers import NotificationsSerializer
+
+    try:
+        return NotificationsSerializer().fields['message'].run_validation(message)
+    except ValidationError as error:
+        raise ValidationError({'message': error.detail})
+
+
+def _lock_copy(user_book_id):
+    try:
+        return UserBook.objects.select_for_update().get(id=user_book_id)
+    except (UserBook.DoesNotExist, ValueError, TypeError):
+        raise BookNotFound()
+
+
+def _lock_owned_copy(user_book_id, owner):
+    copy = _lock_copy(user_book_id)
+    if copy.book_owner_id_id != owner.id:
+        raise NotTheOwner()
+    return copy
+
+
+@_transition
+def request_borrow(user_book_id, borrower):
+    # The request of borrower, sent to the owner of the copy. Asking again while it is pending
+    # gives the same request (one per sender and copy, see the constraint of Notification).
+    with transaction.atomic():
+        copy = _lock_copy(user_book_id)
+        if copy.book_owner_id_id == borrower.id:
+            raise BorrowingError('You can not borrow your own book.')
+        if not copy.status:
+            raise BorrowingError('This book is already borrowed.')
+        borrow_request, _ = Notification.objects.get_or_create(
+            sender_id=borrower, receiver_id_id=copy.book_owner_id_id, user_book_id=copy,
+            type=BORROW_REQUEST, defaults={'message': ''})
+        return borrow_request
+
+
+@_transition
+def answer_request(user_book_id, owner, notification_id, answer, message=None):
+    # Accept or reject (answer) a request for a copy of owner, the answer replaces the request
+    message = _clean_message(message)
+    with transaction.atomic():
+        copy = _lock_owned_copy(user_book_id, owner)
+        borrow_request = Notification.objects.select_for_update().filter(
+            id=notification_id, user_book_id=copy.id, type=BORROW_REQUEST).first()
+        if borrow_request is None:
+            raise RequestNotFound()
+        if answer == ACCEPT:
+            if not copy.status:
+                raise BorrowingError('This book is already borrowed.')
+            copy.status, copy.borrowed_by_id = False, borrow_request.sender_id_id
+            copy.save(update_fields=['status', 'borrowed_by', 'updated_at'])
+        borrow_request.delete()
+        return Notification.objects.create(
+            sender_id=owner, receiver_id_id=borrow_request.sender_id_id, user_book_id=copy, type=answer,
+            message=message)
+
+
+@_transition
+def return_copy(user_book_id, owner, message=None, notify=True):
+    # The owner got the copy back, the borrower is told unless notify is off
+    message = _clean_message(message)
+    with transaction.atomic():
+        copy = _lock_owned_copy(user_book_id, owner)
+        if copy.status:
+            raise BorrowingError('This book is not borrowed.')
+        borrower_id = copy.borrowed_by_id
+        copy.status, copy.borrowed_by = True, None
+        copy.save(update_fields=['status', 'borrowed_by', 'updated_at'])
+        if notify and borrower_id is not None:
+            Notification.objects.create(
+                sender_id=owner, receiver_id_id=borrower_id, user_book_id=copy, type=RETURN, message=message)
+        return copy
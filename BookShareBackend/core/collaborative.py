@@ -0,0 +1,150 @@
+import os
+import threading
+
+from django.conf import settings
+
+from .models import BookRating, UserBook
+from .similarity import recommendation_records, top_k
+
+############################## Collaborative filtering ##################################
+# Matrix factorization of the user x book BookRating matrix, trained offline with
+# alternating least squares (python manage.py train_recommender). The factors are
+# stored as float32 arrays in a single .npz file, a user is scored against every book
+# with one matrix-vector product.
+# RecommendedForYou only uses it for the users with COLLABORATIVE_MIN_RATINGS ratings or
+# more when it was trained (off when None), the others get the content-based list.
+# A model is complete when train or load_model returns it and is never changed afterwards,
+# the requests of every thread share it.
+
+MODEL_FILE = 'collaborative.npz'
+
+_lock = threading.Lock()
+_model = None
+
+
+def model_path():
+    return os.path.join(settings.RECOMMENDER_MODEL_DIR, MODEL_FILE)
+
+
+def _solve(ratings, fixed, target, regularization):
+    # One ALS half-step: a ridge regression for every row of `ratings` against the fixed factors
+    import numpy as np
+
+    eye = np.eye(fixed.shape[1])
+    for row in range(ratings.shape[0]):
+        lo, hi = ratings.indptr[row], ratings.indptr[row + 1]
+        if lo == hi:
+            continue
+        observed = fixed[ratings.indices[lo:hi]]
+        a = observed.T @ observed + regularization * (hi - lo) * eye
+        target[row] = np.linalg.solve(a, observed.T @ ratings.data[lo:hi])
+
+
+def train(factors=32, regularization=0.1, iterations=15, seed=0):
+    # Returns the model (ids and factors of the users and the books) or None when there are no ratings
+    import numpy as np
+    from scipy import sparse
+
+    ratings = list(BookRating.objects.values_list('book_rater_id', 'book_id', 'book_rating'))
+    if not ratings:
+        return None
+
+    raters, books, values = (np.array(column) for column in zip(*ratings))
+    user_ids, user_rows = np.unique(raters, return_inverse=True)
+    book_ids, book_rows = np.unique(books, return_inverse=True)
+
+    # Centered on the global mean, so the factors only model the deviations from it
+    values = values.astype(np.float64)
+    matrix = sparse.csr_matrix((values - values.mean(), (user_rows, book_rows)),
+                               shape=(len(user_ids), len(book_ids)))
+    transposed = matrix.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    user_factors = rng.normal(scale=0.1, size=(len(user_ids), factors))
+    book_factors = rng.normal(scale=0.1, size=(len(book_ids), factors))
+    for _ in range(iterations):
+        _solve(matrix, book_factors, user_factors, regularization)
+        _solve(transposed, user_factors, book_factors, regularization)
+
+    return _with_user_rows({
+        'user_ids': user_ids,
+        'book_ids': book_ids,
+        'user_factors': user_factors.astype(np.float32),
+        'book_factors': book_factors.astype(np.float32),
+        # The number of ratings of each user the model learned from
+        'user_ratings': np.bincount(user_rows, minlength=len(user_ids)).astype(np.int32),
+    })
+
+
+def _with_user_rows(model):
+    # user id -> row of the factors
+    model['user_rows'] = {int(user_id): row for row, user_id in enumerate(model['user_ids'])}
+    return model
+
+
+def save(model):
+    import numpy as np
+
+    os.makedirs(settings.RECOMMENDER_MODEL_DIR, exist_ok=True)
+    # Written next to the model then renamed, the workers never see a partial file
+    tmp_path = model_path() + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, user_ids=model['user_ids'], book_ids=model['book_ids'],
+                 user_factors=model['user_factors'], book_factors=model['book_factors'],
+                 user_ratings=model['user_ratings'])
+    os.replace(tmp_path, model_path())
+
+
+def model_version():
+    # Modification time of the model file, None if it has not been trained yet
+    try:
+        return os.stat(model_path()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_model():
+    # The model is read once per process and reloaded when the file changes
+    global _model
+    import numpy as np
+
+    version = model_version()
+    if version is None:
+        return None
+    with _lock:
+        if _model is None or _model['version'] != version:
+            with np.load(model_path()) as arrays:
+                model = {name: arrays[name] for name in arrays.files}
+            model['version'] = version
+            _model = _with_user_rows(model)
+        return _model
+
+
+def recommend(user_id, limit=10, model=None, min_ratings=0):
+    # Best scored books this user doesn't own and hasn't rated, None if the model doesn't know the user
+    # or learned from fewer than min_ratings of their ratings.
+    # Uses the trained model on disk unless another one is given.
+    import numpy as np
+
+    model = model or load_model()
+    if model is None:
+        return None
+    row = model['user_rows'].get(user_id)
+    if row is None:
+        return None
+    # A model trained before the counts were stored is only used without a minimum
+    if (model['user_ratings'][row] if 'user_ratings' in model else 0) < min_ratings:
+        return None
+
+    scores = model['book_factors'] @ model['user_factors'][row]
+
+    # only the books that have a copy someone else owns can be recommended
+    book_ids = model['book_ids']
+    available = UserBook.objects.exclude(book_owner_id=user_id).values_list('book_id', flat=True).distinct()
+    excluded = list(UserBook.objects.filter(book_owner_id=user_id).values_list('book_id', flat=True))
+    excluded += list(BookRating.objects.filter(book_rater_id=user_id).values_list('book_id', flat=True))
+    keep = np.isin(book_ids, list(available)) & ~np.isin(book_ids, excluded)
+
+    candidates = np.flatnonzero(keep)
+    best = candidates[top_k(scores[candidates], limit, candidates)]
+    return recommendation_records([int(book_id) for book_id in book_ids[best]])
@@ -0,0 +1,40 @@
+from django.db.models import CharField, Count, F, IntegerField, Value
+
+############################## Home page facets ##################################
+# The counts shown next to the filters of the home page (/list/facets/), for the copies
+# the list would return. As usual for facets, the count of a category ignores the selected
+# categories (it's the number of copies selecting it would give) and the counts of the
+# statuses ignore the selected status. Both come from one query, a UNION ALL of:
+#   - the copies grouped by category and status (a copy is in every one of its categories),
+#   - the copies in the selected categories grouped by status, each one counted once.
+# The view caches the result per user and normalized query (see core/recommendation_cache.py).
+
+BY_CATEGORY, BY_STATUS = 0, 1
+
+
+def count_facets(queryset, category_ids, status):
+    # queryset: the copies matching the search; category_ids, status: the selected filters
+    # (empty/None when not selected), like ?book_id__categories= (any of them) and ?status= of the list
+    queryset = queryset.order_by()
+    by_category = queryset.values(
+        'status', part=Value(BY_CATEGORY, IntegerField()), category_id=F('book_id__categories'),
+        name=F('book_id__categories__category'),
+    ).annotate(copies=Count('id'))
+    selected = queryset.filter(book_id__categories__in=category_ids) if category_ids else queryset
+    by_status = selected.values(
+        'status', part=Value(BY_STATUS, IntegerField()), category_id=Value(None, IntegerField()),
+        name=Value(None, CharField()),
+    ).annotate(copies=Count('id', distinct=True))
+
+    categories, statuses = {}, {True: 0, False: 0}
+    for row in by_category.union(by_status, all=True):
+        if row['part'] == BY_STATUS:
+            statuses[row['status']] = row['copies']
+        elif row['category_id'] is not None and status in (None, row['status']):
+            category = categories.setdefault(row['category_id'], {
+                'id': row['category_id'], 'category': row['name'], 'count': 0})
+            category['count'] += row['copies']
+    return {
+        'categories': sorted(categories.values(), key=lambda category: (category['category'], category['id'])),
+        'status': [{'status': value, 'count': statuses[value]} for value in (True, False)],
+    }
@@ -0,0 +1,38 @@
+############################## ISBNs ##################################
+# Book.ISBN holds the ISBN-10 or ISBN-13 as given, without its hyphens and spaces, and
+# Book.isbn13 its ISBN-13 (an ISBN-10 is the ISBN-13 978 + its first 9 digits). isbn13 has
+# a unique index: scanning a barcode (an ISBN-13) or typing the ISBN-10 printed in an old
+# book finds the same Book with one indexed lookup (/book-search/?isbn=).
+
+
+def normalize_isbn(value):
+    # The ISBN without its separators, ValueError if it's not a valid ISBN-10/ISBN-13.
+    # Fewer than 10 digits are an ISBN-10 that lost its leading zeros (ISBN used to be an integer).
+    isbn = str(value).replace('-', '').replace(' ', '').upper()
+    if isbn.isdigit() and len(isbn) < 10:
+        isbn = isbn.zfill(10)
+    if len(isbn) == 10 and isbn[:9].isdigit() and (isbn[9].isdigit() or isbn[9] == 'X'):
+        digits = [10 if c == 'X' else int(c) for c in isbn]
+        if sum((10 - i) * digit for i, digit in enumerate(digits)) % 11 == 0:
+            return isbn
+    elif len(isbn) == 13 and isbn.isdigit():
+        if sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(isbn)) % 10 == 0:
+            return isbn
+    raise ValueError(f'Invalid ISBN: {value}')
+
+
+def to_isbn13(isbn):
+    # The ISBN-13 of a normalized ISBN
+    if len(isbn) == 13:
+        return isbn
+    body = '978' + isbn[:9]
+    check = -sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(body)) % 10
+    return body + str(check)
+
+
+def parse_isbn(value):
+    # (ISBN, ISBN-13) to store for a value, (None, None) for an empty one
+    if value is None or str(value).strip() == '':
+        return None, None
+    isbn = normalize_isbn(value)
+    return isbn, to_isbn13(isbn)
@@ -0,0 +1,89 @@
+import random
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core import collaborative
+from core.benchmark import generate_catalog, hold_out_ratings, measure, precision_at_k
+from core.models import BookRating, UserBook
+from core.recommender import get_recommendations, get_recommendations_for_books, top_rated
+from core.views import RecommendedForYou, TopRated
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the recommender on synthetic catalogs: wall time, time per stage, peak memory '
+            'and precision@10 on held-out ratings. Everything runs in a transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, nargs='+', default=[1000],
+                            help='Catalog sizes to run, in copies (UserBook rows).')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--eval-users', type=int, default=50,
+                            help='Number of users precision@10 is computed on.')
+        parser.add_argument('--holdout', type=float, default=0.2,
+                            help='Fraction of the high ratings of every user that is held out.')
+        parser.add_argument('--collaborative', action='store_true',
+                            help='Also train the ALS model on the catalog and report its precision@10.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        for copies in options['copies']:
+            with transaction.atomic():
+                self.run(copies, options)
+                transaction.set_rollback(True)
+
+    def run(self, copies, options):
+        seed, repeat = options['seed'], options['repeat']
+        catalog = generate_catalog(copies, seed=seed)
+        held_out = hold_out_ratings(catalog['users'], options['holdout'], seed=seed)
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{catalog["copies"]} copies, {catalog["books"]} books, {len(catalog["users"])} users, '
+            f'{catalog["ratings"]} ratings'))
+
+        users = [user for user in catalog['users'] if user.id in held_out][:options['eval_users']]
+        if not users:
+            self.stdout.write(self.style.WARNING('No user has held-out ratings, use a bigger catalog.'))
+            return
+        user = users[0]
+        user_book = UserBook.objects.exclude(book_owner_id=user).order_by('id').first()
+        seeds = list(BookRating.objects.filter(
+            book_rater_id=user, book_rating__gt=6).values_list('book_id', flat=True)[:5])
+
+        self.report('get_recommendations', measure(
+            get_recommendations, user_book.id, user.id, repeat=repeat, with_stages=True))
+        self.report('recommendations for 5 seeds', measure(
+            get_recommendations_for_books, seeds, user.id, repeat=repeat, with_stages=True))
+        self.report('RecommendedForYou endpoint', measure(
+            self.call_view, RecommendedForYou, user, repeat=repeat))
+        self.report('top_rated', measure(top_rated, repeat=repeat, with_stages=True))
+        self.report('TopRated endpoint', measure(self.call_view, TopRated, user, repeat=repeat))
+
+        recommended = {}
+        for user in users:
+            random.seed(seed)
+            data, _ = RecommendedForYou().recommend(user.id)
+            recommended[user.id] = [row['book_id'] for row in data] if isinstance(data, list) else []
+        relevant = {user.id: held_out[user.id] for user in users}
+        self.stdout.write(f'  precision@10 RecommendedForYou ({len(users)} users): '
+                          f'{precision_at_k(recommended, relevant):.3f}')
+
+        if options['collaborative']:
+            model = collaborative.train(seed=seed)
+            recommended = {user.id: [row['book_id'] for row in collaborative.recommend(user.id, model=model) or []]
+                           for user in users}
+            self.stdout.write(f'  precision@10 collaborative ({len(users)} users): '
+                              f'{precision_at_k(recommended, relevant):.3f}')
+
+    def call_view(self, view_class, user):
+        # A full request through DRF, rendering included, with a cold recommendation cache
+        caches['recommendations'].clear()
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, user=user)
+        view_class.as_view()(request).render()
+
+    def report(self, name, result):
+        stages = ' | '.join(f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in result['stages'].items())
+        self.stdout.write(f'  {name:<30} {result["wall"] * 1000:9.1f} ms  '
+                          f'peak {result["peak_memory"] / 2 ** 20:7.1f} MiB  {stages}')
@@ -0,0 +1,45 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# What a gunicorn worker does before serving its first request: load the WSGI
+# application (django.setup()) and the URL configuration with all the views.
+WORKER_BOOT = (
+    'import os;'
+    "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BookShareBackend.settings');"
+    'from BookShareBackend.wsgi import application;'
+    'from django.urls import get_resolver;'
+    'get_resolver().url_patterns'
+)
+
+
+class Command(BaseCommand):
+    help = 'Measure the wall time and the peak RSS of "manage.py check" and of a worker boot.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        targets = {
+            'manage.py check': [sys.executable, 'manage.py', 'check'],
+            'worker boot': [sys.executable, '-c', WORKER_BOOT],
+        }
+        for name, command in targets.items():
+            times, peak_rss = [], []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                process = subprocess.Popen(command, cwd=settings.BASE_DIR,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                # wait4 gives the resource usage of this child only (ru_maxrss is in KiB on Linux)
+                _, wait_status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(wait_status)
+                times.append(time.perf_counter() - start)
+                peak_rss.append(usage.ru_maxrss)
+
+            self.stdout.write(f'{name}: {statistics.median(times) * 1000:.0f} ms median wall time, '
+                              f'{max(peak_rss) / 1024:.1f} MiB peak RSS ({options["repeat"]} runs)')
@@ -0,0 +1,24 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from core.precompute import CHUNK_SIZE, precompute
+
+
+class Command(BaseCommand):
+    help = 'Compute and store the "recommended for you" list of every active user.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only the users whose ratings, books or catalog neighbourhood changed '
+                                 'since their list was computed.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes scoring the users, 1 runs in this process.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        users = precompute(incremental=options['incremental'], workers=options['workers'],
+                           chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Recommendations computed for {users} users in {time.perf_counter() - start:.1f} s.'))
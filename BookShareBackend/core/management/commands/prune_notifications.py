@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from core.retention import BATCH_SIZE, prune_notifications
+
+
+class Command(BaseCommand):
+    help = ('Delete the notifications older than NOTIFICATION_RETENTION_DAYS, except the pending borrow '
+            'requests, a batch at a time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.NOTIFICATION_RETENTION_DAYS,
+                            help='Delete the notifications older than this many days.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='The notifications deleted per transaction.')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between two batches.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1 or options['pause'] < 0:
+            raise CommandError('--days and --pause can not be negative, --batch-size must be at least 1.')
+        before = timezone.now() - timedelta(days=options['days'])
+        deleted = prune_notifications(before, options['batch_size'], options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{deleted} notifications older than {options["days"]} days deleted.'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text index of the book and catalog searches from scratch.'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if backend is None:
+            raise CommandError('The full-text search is off (SEARCH_BACKEND is None).')
+        books, copies = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Search index rebuilt ({books} books, {copies} copies).'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from core.models import SimilarityUpdate
+from core.recommendation_cache import invalidate_index
+from core.similarity import rebuild_index, rebuild_terms
+
+
+class Command(BaseCommand):
+    help = 'Recompute the term index and the "more like this" neighbours of every book from scratch.'
+
+    def handle(self, *args, **options):
+        # The queued updates are part of the new index
+        SimilarityUpdate.objects.all().delete()
+        terms = rebuild_terms()
+        rows = rebuild_index()
+        invalidate_index()
+        self.stdout.write(self.style.SUCCESS(
+            f'Similarity index rebuilt ({terms} terms, {rows} neighbour rows).'))
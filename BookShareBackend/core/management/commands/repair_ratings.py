@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Book, BookRating, BookRatingBucket, UserRating
+from core.ratings import repair_aggregates, repair_buckets, stale_aggregates, stale_buckets
+
+
+class Command(BaseCommand):
+    help = ('Recompute the stored rating aggregates of the books and users, and the daily rating buckets, '
+            'that don\'t match their ratings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report the rows that don\'t match, fail if there are any.')
+
+    def handle(self, *args, **options):
+        aggregates = [
+            ('books', Book, BookRating.objects.all(), 'book_id', 'book_rating'),
+            ('users', get_user_model(), UserRating.objects.all(), 'user_rated_id', 'user_rating'),
+        ]
+
+        if options['check']:
+            stale = {name: stale_aggregates(model, ratings, key, value)
+                     for name, model, ratings, key, value in aggregates}
+            for name, rows in stale.items():
+                self.stdout.write(f'{len(rows)} {name} out of date' + (
+                    f': {", ".join(str(row.pk) for row in rows[:20])}' if rows else '.'))
+            buckets = stale_buckets(BookRatingBucket, BookRating.objects.all())
+            self.stdout.write(f'{len(buckets)} rating buckets out of date.')
+            if any(stale.values()) or buckets:
+                raise CommandError('The stored rating aggregates are out of date, run "repair_ratings".')
+            return
+
+        for name, model, ratings, key, value in aggregates:
+            repaired = repair_aggregates(model, ratings, key, value)
+            self.stdout.write(self.style.SUCCESS(f'{repaired} {name} repaired.'))
+        buckets = repair_buckets(BookRatingBucket, BookRating.objects.all())
+        self.stdout.write(self.style.SUCCESS(f'{buckets} rating buckets repaired.'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from core import collaborative
+
+
+class Command(BaseCommand):
+    help = 'Train the collaborative-filtering recommender from the book ratings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--factors', type=int, default=32)
+        parser.add_argument('--regularization', type=float, default=0.1)
+        parser.add_argument('--iterations', type=int, default=15)
+
+    def handle(self, *args, **options):
+        model = collaborative.train(factors=options['factors'],
+                                    regularization=options['regularization'],
+                                    iterations=options['iterations'])
+        if model is None:
+            self.stdout.write(self.style.WARNING('There are no ratings to train on.'))
+            return
+
+        collaborative.save(model)
+        self.stdout.write(self.style.SUCCESS(
+            f'Trained on {len(model["user_ids"])} users and {len(model["book_ids"])} books, '
+            f'saved to {collaborative.model_path()}.'))
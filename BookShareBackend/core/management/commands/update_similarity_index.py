@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.similarity import apply_index_updates
+
+
+class Command(BaseCommand):
+    help = 'Recompute the "more like this" neighbours of the books changed since the last run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, applying the new changes every this many seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            affected = apply_index_updates()
+            if affected or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Similarity index updated ({len(affected)} books in {time.perf_counter() - start:.1f} s).'))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The table is created empty, "manage.py rebuild_similarity_index" fills it (see core/similarity.py)
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_alter_bookrating_book_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('book_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='core.book')),
+                ('similar_book_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.book')),
+            ],
+            options={
+                'ordering': ['-score'],
+                'unique_together': {('book_id', 'similar_book_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_app', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0008_booksimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationState',
+            fields=[
+                ('user_id', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recommendation_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('computed_version', models.PositiveIntegerField(default=0)),
+                ('computed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Recommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('book_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.book')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['rank'],
+                'unique_together': {('user_id', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The table is created empty, "manage.py rebuild_similarity_index" fills it (see core/similarity.py)
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_recommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=60)),
+                ('book_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='core.book')),
+            ],
+            options={
+                'unique_together': {('term', 'book_id')},
+            },
+        ),
+    ]
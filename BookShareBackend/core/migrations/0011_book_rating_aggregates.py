@@ -0,0 +1,40 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+def fill_aggregates(apps, schema_editor):
+    # The new columns, from the ratings of every book
+    from django.db.models import Count, Sum
+
+    Book = apps.get_model('core', 'Book')
+    books = [Book(id=book_id, rating_sum=total, rating_count=count, avg_rating=total / count)
+             for book_id, total, count in apps.get_model('core', 'BookRating').objects.values('book_id').annotate(
+                 total=Sum('book_rating'), count=Count('id')).values_list('book_id', 'total', 'count')]
+    Book.objects.bulk_update(books, ['rating_sum', 'rating_count', 'avg_rating'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_bookterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='avg_rating',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
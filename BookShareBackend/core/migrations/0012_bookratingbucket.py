@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_buckets(apps, schema_editor):
+    # A bucket per book and day (the day of created_at in TIME_ZONE) with ratings
+    from django.db.models import Count, Sum
+    from django.db.models.functions import TruncDate
+
+    BookRatingBucket = apps.get_model('core', 'BookRatingBucket')
+    totals = apps.get_model('core', 'BookRating').objects.annotate(day=TruncDate('created_at')).values(
+        'book_id', 'day').annotate(total=Sum('book_rating'), count=Count('id'))
+    BookRatingBucket.objects.bulk_create([
+        BookRatingBucket(book_id_id=row['book_id'], day=row['day'], rating_sum=row['total'], rating_count=row['count'])
+        for row in totals], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_book_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookRatingBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('book_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_buckets', to='core.book')),
+            ],
+            options={
+                'unique_together': {('day', 'book_id')},
+            },
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+    ]
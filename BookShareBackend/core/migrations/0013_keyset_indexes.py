@@ -0,0 +1,25 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_bookratingbucket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['receiver_id', 'created_at', 'id'], name='notification_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbook',
+            index=models.Index(fields=['created_at', 'id'], name='userbook_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbook',
+            index=models.Index(fields=['book_owner_id', 'created_at', 'id'], name='userbook_owner_created_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:40
+
+import core.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The index as it stands at this migration, core/search.py may change afterwards
+BOOK_DOCUMENTS = '''
+    SELECT book.id, book.book_name, book.author, COALESCE(book."ISBN", ''), COALESCE(book.publisher, '')
+    FROM core_book book'''
+COPY_DOCUMENTS = '''
+    SELECT copy.id, book.book_name, book.author, COALESCE(book."ISBN", ''), COALESCE(book.publisher, ''),
+           owner.first_name || ' ' || owner.last_name || ' ' || COALESCE(owner.address, '')
+    FROM core_userbook copy
+    JOIN core_book book ON book.id = copy.book_id_id
+    JOIN user_app_user owner ON owner.id = copy.book_owner_id_id'''
+
+
+def create_search_index(apps, schema_editor):
+    # The FTS5 tables only exist on SQLite, the other engines use their own backend (see core/search.py)
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS core_book_fts USING fts5(
+            book_name, author, isbn, publisher, tokenize = "unicode61 remove_diacritics 2")''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS core_userbook_fts USING fts5(
+            book_name, author, isbn, publisher, owner, tokenize = "unicode61 remove_diacritics 2")''')
+        cursor.execute("INSERT INTO core_book_fts(core_book_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0)')")
+        cursor.execute("INSERT INTO core_userbook_fts(core_userbook_fts, rank) "
+                       "VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0, 2.0)')")
+        cursor.execute(f'INSERT INTO core_book_fts(rowid, book_name, author, isbn, publisher) {BOOK_DOCUMENTS}')
+        cursor.execute(f'INSERT INTO core_userbook_fts(rowid, book_name, author, isbn, publisher, owner) '
+                       f'{COPY_DOCUMENTS}')
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS core_book_fts')
+        cursor.execute('DROP TABLE IF EXISTS core_userbook_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_keyset_indexes'),
+        ('user_app', '0002_user_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.CreateModel(
+            name='BookSearchDocument',
+            fields=[
+                ('book_id', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_document', serialize=False, to='core.book')),
+                ('document', core.models.SearchDocumentField(db_column='core_book_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_book_fts',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UserBookSearchDocument',
+            fields=[
+                ('user_book_id', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_document', serialize=False, to='core.userbook')),
+                ('document', core.models.SearchDocumentField(db_column='core_userbook_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'core_userbook_fts',
+                'managed': False,
+            },
+        ),
+    ]
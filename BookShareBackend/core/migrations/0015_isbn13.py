@@ -0,0 +1,68 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+def normalize_isbns(apps, schema_editor):
+    # The integers become ISBNs (an ISBN-10 starting with 0 lost it), with their ISBN-13.
+    # A value that isn't a valid ISBN is kept but not looked up, and so is the ISBN of a book
+    # entered twice: the first book added keeps the ISBN-13.
+    from core.isbn import normalize_isbn, to_isbn13
+
+    Book = apps.get_model('core', 'Book')
+    taken = set()
+    for book in Book.objects.exclude(ISBN=None).order_by('id'):
+        try:
+            isbn = normalize_isbn(book.ISBN)
+        except ValueError:
+            continue
+        book.ISBN, isbn13 = isbn, to_isbn13(isbn)
+        if isbn13 not in taken:
+            book.isbn13 = isbn13
+            taken.add(isbn13)
+        book.save(update_fields=['ISBN', 'isbn13'])
+
+
+def rebuild_search_index(apps, schema_editor):
+    # The documents hold the ISBNs, the index as it stands at this migration (see 0014_search_index)
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DELETE FROM core_book_fts')
+        cursor.execute('''INSERT INTO core_book_fts(rowid, book_name, author, isbn, publisher)
+            SELECT book.id, book.book_name, book.author, COALESCE(book."ISBN", ''), COALESCE(book.publisher, '')
+            FROM core_book book''')
+        cursor.execute('DELETE FROM core_userbook_fts')
+        cursor.execute('''INSERT INTO core_userbook_fts(rowid, book_name, author, isbn, publisher, owner)
+            SELECT copy.id, book.book_name, book.author, COALESCE(book."ISBN", ''), COALESCE(book.publisher, ''),
+                   owner.first_name || ' ' || owner.last_name || ' ' || COALESCE(owner.address, '')
+            FROM core_userbook copy
+            JOIN core_book book ON book.id = copy.book_id_id
+            JOIN user_app_user owner ON owner.id = copy.book_owner_id_id''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='ISBN',
+            field=models.CharField(blank=True, max_length=13, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='isbn13',
+            field=models.CharField(blank=True, editable=False, max_length=13, null=True),
+        ),
+        migrations.RunPython(normalize_isbns, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_search_index, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='book',
+            name='isbn13',
+            field=models.CharField(blank=True, editable=False, max_length=13, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_isbn13'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='is_read',
+            field=models.BooleanField(default=False),
+        ),
+    ]
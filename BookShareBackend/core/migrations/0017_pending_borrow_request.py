@@ -0,0 +1,37 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:55
+
+from django.db import migrations, models
+
+
+def coalesce_borrow_requests(apps, schema_editor):
+    # The requests sent again for a copy still pending: the first one is kept, and the unread
+    # counters lose the others (the signals don't run in a migration)
+    from django.db.models import Count, Min
+
+    from core.unread import repair_unread
+
+    Notification = apps.get_model('core', 'Notification')
+    duplicates = Notification.objects.filter(type='borrow_request').values(
+        'sender_id', 'receiver_id', 'user_book_id').annotate(first=Min('id'), count=Count('id')).filter(count__gt=1)
+    for group in duplicates:
+        Notification.objects.filter(
+            type='borrow_request', sender_id=group['sender_id'], receiver_id=group['receiver_id'],
+            user_book_id=group['user_book_id'],
+        ).exclude(id=group['first']).delete()
+    repair_unread(apps.get_model('user_app', 'User'), Notification.objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_notification_is_read'),
+        ('user_app', '0003_user_unread_notifications'),
+    ]
+
+    operations = [
+        migrations.RunPython(coalesce_borrow_requests, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('type', 'borrow_request')), fields=('sender_id', 'receiver_id', 'user_book_id', 'type'), name='unique_pending_borrow_request'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1.7 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_pending_borrow_request'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarityUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.IntegerField()),
+            ],
+        ),
+    ]
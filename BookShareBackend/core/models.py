@@ -5,6 +5,8 @@ from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 
+from .isbn import parse_isbn
+
 
 def upload_to(instance, filename):
     return 'images/book/{filename}'.format(filename=filename)
@@ -22,38 +24,45 @@ class Book(models.Model):
     author = models.CharField(max_length=30)
     publisher = models.CharField(max_length=30, blank=True, null=True)
     description = models.TextField(max_length=200, blank=True, null=True)
-    ISBN = models.IntegerField(blank=True, null=True)
+    ISBN = models.CharField(max_length=13, blank=True, null=True)
+    # The ISBN-13 of the ISBN, for the exact lookups (see core/isbn.py)
+    isbn13 = models.CharField(max_length=13, blank=True, null=True, unique=True, editable=False)
     year = models.IntegerField(blank=True, null=True)
     categories = models.ManyToManyField(Category, blank=True)
     owners = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, through='UserBook', through_fields=(
         'book_id', 'book_owner_id'), related_name='books_owned')
+    # Aggregates of the BookRatings of this book, kept up to date by core/signals.py (see core/ratings.py)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    avg_rating = models.FloatField(default=0, editable=False)
 
     def __str__(self):
         return self.book_name
 
-    def calculate_avg_rating(self):
-        # Get all UserBook objects for this book
-        book_ratings = BookRating.objects.filter(book_id=self)
-
-        # Calculate the average rating for this book
-        total_rating = sum(
-            book_rating.book_rating for book_rating in book_ratings)
-        num_ratings = book_ratings.count()
-        if num_ratings > 0:
-            avg_rating = round(total_rating / num_ratings, 1)
-        else:
-            avg_rating = 0
-
-        return avg_rating
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        book = super().from_db(db, field_names, values)
+        # The ISBN as stored, see save
+        book._stored_isbn = book.__dict__.get('ISBN', models.DEFERRED)
+        return book
 
-    def calculate_number_rating(self):
-        # Get all UserBook objects for this book
-        book_ratings = BookRating.objects.filter(book_id=self)
+    def save(self, *args, **kwargs):
+        # Only a new or changed ISBN is parsed (ValueError if it's not valid): an ISBN saved as it
+        # was keeps its isbn13, None for the second book of an ISBN entered twice and for a value
+        # stored before the validation (see migration 0015)
+        if self._state.adding or self.__dict__.get('ISBN', models.DEFERRED) != self._stored_isbn:
+            self.ISBN, self.isbn13 = parse_isbn(self.ISBN)
+        super().save(*args, **kwargs)
+        self._stored_isbn = self.__dict__.get('ISBN', models.DEFERRED)
 
-        # Get the number of ratings for this book
-        num_ratings = book_ratings.count()
+    def calculate_avg_rating(self):
+        # The average rating for this book, rounded like it's displayed
+        if self.rating_count > 0:
+            return round(self.avg_rating, 1)
+        return 0
 
-        return num_ratings
+    def calculate_number_rating(self):
+        return self.rating_count
 
 
 class UserBook(models.Model):
@@ -68,11 +77,87 @@ class UserBook(models.Model):
     class Meta:
         ordering = ['-created_at']  # Descending order
         unique_together = ('book_owner_id', 'book_id')
+        # The keys of the paginated lists (see core/pagination.py), for all copies and per owner
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='userbook_created_idx'),
+            models.Index(fields=['book_owner_id', 'created_at', 'id'], name='userbook_owner_created_idx'),
+        ]
 
     def __str__(self):
         return f'{self.book_owner_id.get_full_name()} | {self.book_id.book_name} | status: {self.status}'
 
 
+class BookSimilarity(models.Model):
+    # Precomputed "more like this" neighbours of a book (see core/similarity.py)
+    book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='neighbours')
+    similar_book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['-score']
+        unique_together = ('book_id', 'similar_book_id')
+
+    def __str__(self):
+        return f'{self.book_id_id} -> {self.similar_book_id_id} | score: {self.score:.3f}'
+
+
+class BookTerm(models.Model):
+    # Inverted index of the recommender features: term -> books (see core/similarity.py)
+    book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='terms')
+    term = models.CharField(max_length=60)
+
+    class Meta:
+        unique_together = ('term', 'book_id')
+
+    def __str__(self):
+        return f'{self.term} -> {self.book_id_id}'
+
+
+class SimilarityUpdate(models.Model):
+    # The books whose rows of the similarity index are out of date, queued by core/signals.py
+    # (see core/similarity.py). Not a foreign key, a deleted book is queued too.
+    book_id = models.IntegerField()
+
+    def __str__(self):
+        return f'{self.book_id}'
+
+
+class Recommendation(models.Model):
+    # Precomputed "recommended for you" lists (see core/precompute.py)
+    user_id = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recommendations')
+    book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['rank']
+        unique_together = ('user_id', 'rank')
+
+    def __str__(self):
+        return f'{self.user_id_id} | #{self.rank} | book: {self.book_id_id}'
+
+
+class RecommendationState(models.Model):
+    # version is bumped whenever the recommendations of the user may have changed,
+    # computed_version is the version the stored list was computed from
+    user_id = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='recommendation_state')
+    version = models.PositiveIntegerField(default=1)
+    computed_version = models.PositiveIntegerField(default=0)
+    computed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.user_id_id} | version: {self.version} | computed: {self.computed_version}'
+
+
+class VersionStamp(models.Model):
+    # A version stamp shared by all the processes (see core/recommendation_cache.py)
+    name = models.CharField(max_length=50, primary_key=True)
+    stamp = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.name} | {self.stamp}'
+
+
 class BookRating(models.Model):
     book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='bookrating')
     book_rater_id = models.ForeignKey(
@@ -89,6 +174,61 @@ class BookRating(models.Model):
         return f'{self.book_id.book_name} | {self.book_rater_id.get_full_name()} | rating: {self.book_rating}'
 
 
+class BookRatingBucket(models.Model):
+    # Sum and number of the BookRatings of a book created on a day (see core/ratings.py)
+    book_id = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='rating_buckets')
+    day = models.DateField()
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'book_id')
+
+    def __str__(self):
+        return f'{self.book_id_id} | {self.day} | {self.rating_count} ratings'
+
+
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class SearchDocumentField(models.TextField):
+    # The hidden column of an FTS5 table named after the table, the full-text query is matched against it
+    pass
+
+
+SearchDocumentField.register_lookup(Match)
+
+
+class BookSearchDocument(models.Model):
+    # A row of the SQLite FTS5 index of the book search (see core/search.py)
+    book_id = models.OneToOneField(Book, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                   related_name='search_document')
+    document = SearchDocumentField(db_column='core_book_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'core_book_fts'
+
+
+class UserBookSearchDocument(models.Model):
+    # A row of the SQLite FTS5 index of the catalog search (see core/search.py)
+    user_book_id = models.OneToOneField(UserBook, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                        related_name='search_document')
+    document = SearchDocumentField(db_column='core_userbook_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'core_userbook_fts'
+
+
 class UserRating(models.Model):
     user_rated_id = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='ratings_received')
@@ -112,8 +252,20 @@ class Notification(models.Model):
     user_book_id = models.ForeignKey(UserBook, on_delete=models.CASCADE, null=True)
     type = models.CharField(max_length=20)
     message = models.TextField(max_length=200, blank=True, null=True)
+    # Counted in User.unread_notifications until read (see core/unread.py)
+    is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['receiver_id', 'created_at', 'id'], name='notification_receiver_idx'),
+        ]
+        constraints = [
+            # A sender has one pending borrow request per copy, a new one is the same (see core/borrowing.py)
+            models.UniqueConstraint(fields=['sender_id', 'receiver_id', 'user_book_id', 'type'],
+                                    condition=models.Q(type='borrow_request'), name='unique_pending_borrow_request'),
+        ]
+
     def __str__(self):
         return self.type
 
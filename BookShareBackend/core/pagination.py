@@ -0,0 +1,124 @@
+import json
+from base64 import b64decode, b64encode
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+############################## Keyset pagination ##################################
+# A page is the rows after (or, going back, before) the sort key of the last row the client
+# saw, e.g. WHERE created_at < c OR (created_at = c AND id < i) ORDER BY created_at DESC,
+# id DESC LIMIT n + 1. The cost of a page doesn't depend on how deep it is, there's no
+# COUNT(*) and the rows inserted meanwhile don't shift the following pages. The id breaks
+# the ties between equal timestamps, so every row has a unique position.
+# The cursor holds the sort key, it is opaque to the clients.
+
+
+class KeysetPagination(BasePagination):
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+
+        position, reverse = self.decode_cursor(request, queryset)
+        ordering = [self.flip(field) for field in self.ordering] if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(ordering, position))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        # There is a page after this one if we read past it, or if we came back from it
+        has_next, has_previous = (position is not None, has_more) if reverse else (has_more, position is not None)
+        self.next_position = self.key(rows[-1]) if rows and has_next else None
+        self.previous_position = self.key(rows[0]) if rows and has_previous else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_link(self.next_position, reverse=False),
+            'previous': self.get_link(self.previous_position, reverse=True),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, request, queryset, view):
+        # The ?ordering= of the view's OrderingFilter, with the id in the same direction,
+        # else the relevance of a full-text search (see core/search.py)
+        if view is not None and OrderingFilter in getattr(view, 'filter_backends', []):
+            ordering = OrderingFilter().get_ordering(request, queryset, view)
+            if ordering:
+                return (ordering[0], '-id' if ordering[0].startswith('-') else 'id')
+        if 'search_rank' in queryset.query.annotations:
+            return ('search_rank', 'id')
+        return self.ordering
+
+    @staticmethod
+    def flip(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    def after(self, ordering, position):
+        # The rows that come after position in this ordering
+        conditions = []
+        for i, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = f'{name}__lt' if field.startswith('-') else f'{name}__gt'
+            equal = {self.fields[j]: position[j] for j in range(i)}
+            conditions.append(Q(**equal, **{lookup: position[i]}))
+        return reduce(lambda a, b: a | b, conditions)
+
+    def key(self, row):
+        return [getattr(row, field) for field in self.fields]
+
+    def get_link(self, position, reverse):
+        if position is None:
+            return None
+        cursor = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value
+                             for value in position] + [1 if reverse else 0])
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   b64encode(cursor.encode()).decode())
+
+    def decode_cursor(self, request, queryset):
+        # (sort key, reverse), the key is None on the first page
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        annotations = queryset.query.annotations
+        fields = [annotations[field].output_field if field in annotations else queryset.model._meta.get_field(field)
+                  for field in self.fields]
+        try:
+            *values, reverse = json.loads(b64decode(encoded.encode(), validate=True).decode())
+            if len(values) != len(fields):
+                raise ValueError
+            position = [field.to_python(value) for field, value in zip(fields, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, bool(reverse)
+
+
+class IdKeysetPagination(KeysetPagination):
+    # For the models without a creation date, in the order they were added
+    ordering = ('id',)
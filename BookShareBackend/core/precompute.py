@@ -0,0 +1,125 @@
+import random
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import BookRating, Recommendation, RecommendationState, UserBook
+from .recommender import load_books, recommend_for_seeds
+
+############################## Precomputed recommendations ##################################
+# "python manage.py precompute_recommendations" stores the content-based "recommended for
+# you" list of every active user in Recommendation, RecommendedForYou reads it instead of
+# scoring the catalog in the request. The users are split in chunks scored by a pool of
+# processes, every process loads and vectorizes the catalog once; the parent process
+# writes the results so the database only ever has one writer.
+
+CHUNK_SIZE = 200
+SEED_BOOKS = 5
+
+_catalog = None
+
+
+def target_users(incremental=False):
+    # Ids of the active users to compute, in incremental mode only the ones whose list is
+    # missing or older than their last change (see recommendation_cache.mark_stale)
+    users = get_user_model().objects.filter(is_active=True)
+    if incremental:
+        users = users.filter(Q(recommendation_state__isnull=True)
+                             | Q(recommendation_state__version__gt=F('recommendation_state__computed_version')))
+    return list(users.order_by('id').values_list('id', flat=True))
+
+
+def read_versions(user_ids):
+    # Read before the catalog is loaded: a change made during the run bumps the version
+    # past the one recorded, so the next incremental run picks the user up again
+    RecommendationState.objects.bulk_create(
+        [RecommendationState(user_id_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    versions = {}
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        versions.update(RecommendationState.objects.filter(
+            user_id__in=user_ids[start:start + CHUNK_SIZE]).values_list('user_id', 'version'))
+    return versions
+
+
+def init_worker():
+    global _catalog
+    import django
+
+    # A forked process must not share the parent's database connections
+    django.setup()
+    connections.close_all()
+    _catalog = load_books(None)
+
+
+def compute_chunk(user_ids):
+    # [(user id, recommended book ids)], with the seeds and filters of RecommendedForYou
+    import numpy as np
+
+    owned, rated, seeds = defaultdict(list), defaultdict(list), defaultdict(list)
+    for user_id, book_id in UserBook.objects.filter(
+            book_owner_id__in=user_ids).values_list('book_owner_id', 'book_id'):
+        owned[user_id].append(book_id)
+    for user_id, book_id, rating in BookRating.objects.filter(
+            book_rater_id__in=user_ids).values_list('book_rater_id', 'book_id', 'book_rating'):
+        rated[user_id].append(book_id)
+        if rating > 6:
+            seeds[user_id].append(book_id)
+
+    results = []
+    for user_id in user_ids:
+        book_ids = []
+        if seeds[user_id]:
+            catalog = dict(_catalog, excluded_books=np.array(owned[user_id] + rated[user_id], dtype=np.int64))
+            # Drawn with a generator seeded by the user, a run on the same data stores the same list
+            seed_books = random.Random(user_id).sample(sorted(seeds[user_id]), min(SEED_BOOKS, len(seeds[user_id])))
+            book_ids = [int(catalog['book_ids'][row]) for row in recommend_for_seeds(catalog, seed_books)]
+        results.append((user_id, book_ids))
+    return results
+
+
+def save_chunk(results, versions):
+    # Upsert the lists on (user, rank), drop the ranks past the new end of each list
+    now = timezone.now()
+    lengths = defaultdict(list)
+    rows = []
+    for user_id, book_ids in results:
+        lengths[len(book_ids)].append(user_id)
+        rows += [Recommendation(user_id_id=user_id, book_id_id=book_id, rank=rank)
+                 for rank, book_id in enumerate(book_ids)]
+
+    with transaction.atomic():
+        Recommendation.objects.bulk_create(rows, update_conflicts=True,
+                                           unique_fields=['user_id', 'rank'], update_fields=['book_id'])
+        for length, user_ids in lengths.items():
+            Recommendation.objects.filter(user_id__in=user_ids, rank__gte=length).delete()
+        RecommendationState.objects.bulk_update(
+            [RecommendationState(user_id_id=user_id, computed_version=versions[user_id], computed_at=now)
+             for user_id, _ in results], ['computed_version', 'computed_at'])
+
+
+def precompute(incremental=False, workers=1, chunk_size=CHUNK_SIZE):
+    # Returns the number of users computed
+    global _catalog
+    from concurrent.futures import ProcessPoolExecutor
+
+    user_ids = target_users(incremental)
+    if not user_ids:
+        return 0
+    versions = read_versions(user_ids)
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+    if workers <= 1:
+        _catalog = load_books(None)
+        for chunk in chunks:
+            save_chunk(compute_chunk(chunk), versions)
+        _catalog = None
+        return len(user_ids)
+
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        for results in executor.map(compute_chunk, chunks):
+            save_chunk(results, versions)
+    return len(user_ids)
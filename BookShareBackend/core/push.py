@@ -0,0 +1,239 @@
+import asyncio
+import json
+import queue
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
+
+from asgiref.sync import sync_to_async
+from corsheaders.conf import conf as cors_conf
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.core import signals
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from rest_framework.authtoken.models import Token
+
+from .models import Notification
+
+############################## Notification push ##################################
+# The new notifications are pushed to their receiver instead of the clients polling
+# /notifications/:
+#   - GET /notifications/stream/ (Server-Sent Events, ASGI only, see BookShareBackend/asgi.py):
+#     an EventSource gets a "notification" event with the NotificationsSerializer data of
+#     each new notification. EventSource can't send headers: the token is ?token= or the
+#     Authorization header. After a reconnection, the Last-Event-ID header (or ?after=)
+#     sends the notifications created meanwhile first.
+#     It is served before Django's middlewares, so it adds the CORS headers of CorsMiddleware
+#     itself, the EventSource of the frontend runs on another origin.
+#   - GET /notifications/poll/?after=<id> (long-polling, see NotificationPoll): answers with
+#     the notifications after that id as soon as there are some, [] after the timeout. A
+#     waiting poll holds its worker thread: serve it with threaded (gunicorn --threads) or
+#     ASGI workers, a sync worker would serve nothing else for NOTIFICATION_POLL_TIMEOUT.
+# The broker lives in the memory of the process, no external service. core/signals.py
+# publishes a notification after commit, serialized once for all the connections of its
+# receiver. With several worker processes, a notification created in another one is read
+# from the database at the next keep-alive of the stream, or at the next poll.
+
+STREAM_PATH = '/notifications/stream/'
+# The notifications sent at once when catching up
+CATCH_UP_LIMIT = 50
+
+
+class Subscription:
+    # The notifications of one connection, for a thread (a long-poll) or an event loop (a stream)
+
+    def __init__(self, user_id, loop=None):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue() if loop else queue.Queue()
+
+    def put(self, data):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+        else:
+            self.queue.put(data)
+
+    def get(self, timeout):
+        # Blocking, the notifications published within timeout seconds ([] if none)
+        try:
+            notifications = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while not self.queue.empty():
+            notifications.append(self.queue.get_nowait())
+        return notifications
+
+    async def get_async(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)  # user id -> subscriptions
+
+    def subscribe(self, user_id, loop=None):
+        subscription = Subscription(user_id, loop)
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def listening(self, user_id):
+        return user_id in self._subscriptions
+
+    def publish(self, user_id, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(data)
+
+
+broker = Broker()
+
+
+def serialize(notifications):
+    from .serializers import NotificationsSerializer
+
+    return NotificationsSerializer(notifications, many=True).data
+
+
+def notifications_after(user_id, after):
+    # The notifications of the user created after the notification id after, the oldest first
+    return serialize(Notification.objects.filter(receiver_id=user_id, id__gt=after).select_related(
+        'sender_id', 'receiver_id', 'user_book_id__book_id').order_by('id')[:CATCH_UP_LIMIT])
+
+
+def publish(notification_id, receiver_id):
+    # After commit (core/signals.py), read only when the receiver is connected to this process
+    if not broker.listening(receiver_id):
+        return
+    notification = Notification.objects.filter(id=notification_id).select_related(
+        'sender_id', 'receiver_id', 'user_book_id__book_id').first()
+    if notification is not None:
+        broker.publish(receiver_id, serialize([notification])[0])
+
+
+############################## Server-Sent Events ##################################
+
+def with_notification_stream(application):
+    # The ASGI application serving STREAM_PATH, the other requests go to application
+    async def router(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+            return await notification_stream(scope, receive, send)
+        return await application(scope, receive, send)
+    return router
+
+
+def _authenticate(key):
+    token = Token.objects.select_related('user').filter(key=key).first()
+    return token.user.id if token and token.user.is_active else None
+
+
+def _event(notification):
+    return (f'id: {notification["id"]}\nevent: notification\n'
+            f'data: {json.dumps(notification, cls=DjangoJSONEncoder)}\n\n').encode()
+
+
+_cors = CorsMiddleware(lambda request: None)
+
+
+def _cors_headers(scope, headers):
+    # The headers CorsMiddleware adds to the responses of Django for an allowed origin
+    origin = headers.get(b'origin', b'').decode()
+    if not origin or not re.match(cors_conf.CORS_URLS_REGEX, scope['path']):
+        return []
+    if not cors_conf.CORS_ALLOW_ALL_ORIGINS and not _cors.origin_found_in_white_lists(origin, urlsplit(origin)):
+        return [(b'vary', b'origin')]
+    allowed = '*' if cors_conf.CORS_ALLOW_ALL_ORIGINS and not cors_conf.CORS_ALLOW_CREDENTIALS else origin
+    cors = [(b'access-control-allow-origin', allowed.encode()), (b'vary', b'origin')]
+    if cors_conf.CORS_ALLOW_CREDENTIALS:
+        cors.append((b'access-control-allow-credentials', b'true'))
+    if scope['method'] == 'OPTIONS':
+        # The preflight of a client sending the Authorization header
+        cors += [(b'access-control-allow-headers', ', '.join(cors_conf.CORS_ALLOW_HEADERS).encode()),
+                 (b'access-control-allow-methods', b'GET, OPTIONS'),
+                 (b'access-control-max-age', str(cors_conf.CORS_PREFLIGHT_MAX_AGE).encode())]
+    return cors
+
+
+async def _response(send, status, content_type, body=b'', more_body=False, headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', content_type), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no'), *headers]})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+async def notification_stream(scope, receive, send):
+    # Like Django's ASGIHandler, so the database connection is handled the same way
+    await sync_to_async(signals.request_started.send)(sender=notification_stream, scope=scope)
+    try:
+        await _stream(scope, receive, send)
+    finally:
+        await sync_to_async(signals.request_finished.send)(sender=notification_stream)
+
+
+async def _stream(scope, receive, send):
+    headers = dict(scope['headers'])
+    cors = _cors_headers(scope, headers)
+    if scope['method'] == 'OPTIONS':
+        return await _response(send, 200, b'text/plain', headers=cors)
+    params = {name: values[0] for name, values in parse_qs(scope['query_string'].decode()).items()}
+    authorization = headers.get(b'authorization', b'').decode().split()
+    key = authorization[1] if len(authorization) == 2 and authorization[0] == 'Token' else params.get('token')
+    user_id = key and await sync_to_async(_authenticate)(key)
+    if not user_id:
+        return await _response(send, 401, b'application/json',
+                               b'{"detail": "Authentication credentials were not provided."}', headers=cors)
+
+    after = headers.get(b'last-event-id', b'').decode() or params.get('after', '')
+    # Subscribed before reading the database, so that nothing falls between the two
+    subscription = broker.subscribe(user_id, asyncio.get_running_loop())
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await _response(send, 200, b'text/event-stream', b'retry: 3000\n\n', more_body=True, headers=cors)
+        # Without a last id the stream starts with the next notification
+        last_id = int(after) if after.isdigit() else await sync_to_async(_latest_id)(user_id)
+        catch_up = after.isdigit()
+        while True:
+            while catch_up:
+                # the missed ones, and at each keep-alive those created by another process
+                notifications = await sync_to_async(notifications_after)(user_id, last_id)
+                for notification in notifications:
+                    await send({'type': 'http.response.body', 'body': _event(notification), 'more_body': True})
+                    last_id = notification['id']
+                catch_up = len(notifications) == CATCH_UP_LIMIT
+            getting = asyncio.ensure_future(subscription.get_async(settings.NOTIFICATION_STREAM_KEEPALIVE))
+            await asyncio.wait([getting, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                getting.cancel()
+                break
+            notification = getting.result()
+            catch_up = notification is None
+            if notification is None:
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+            elif notification['id'] > last_id:
+                await send({'type': 'http.response.body', 'body': _event(notification), 'more_body': True})
+                last_id = notification['id']
+    finally:
+        disconnected.cancel()
+        broker.unsubscribe(subscription)
+
+
+def _latest_id(user_id):
+    return Notification.objects.filter(receiver_id=user_id).aggregate(latest=Max('id'))['latest'] or 0
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
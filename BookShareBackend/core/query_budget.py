@@ -0,0 +1,83 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+############################## Query budgets ##################################
+# Every view of core and user_app declares how many SQL queries a request may run, with a
+# `query_budget` attribute on the class (or the query_budget decorator on an @api_view
+# function). The budget covers the whole request: authentication, permissions, the view
+# and the serializers, for the worst case of the view (e.g. a cold cache).
+# QueryBudgetMiddleware counts the queries and times them. With DEBUG on, a request over
+# its budget is logged and the timings are sent in a Server-Timing header; with
+# QUERY_BUDGET_STRICT on (the route tests) it raises QueryBudgetExceeded instead.
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(queries):
+    # For function views, put it above @api_view
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+def view_budget(view):
+    # The budget of a view function, None for the views that don't declare one (admin, media)
+    budget = getattr(view, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(view, 'view_class', None), 'query_budget', None)
+    return budget
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_time += time.perf_counter() - start
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        total_time = time.perf_counter() - start
+
+        budget = view_budget(request.resolver_match.func) if request.resolver_match else None
+        logger.debug('%s %s: %d queries, %.1f ms SQL, %.1f ms total', request.method, request.path,
+                     stats.queries, stats.sql_time * 1000, total_time * 1000)
+        if not (settings.DEBUG or settings.QUERY_BUDGET_STRICT):
+            return response
+
+        response['Server-Timing'] = (f'db;dur={stats.sql_time * 1000:.1f};desc="{stats.queries} queries", '
+                                     f'total;dur={total_time * 1000:.1f}')
+        if budget is not None and stats.queries > budget:
+            message = f'{request.method} {request.path} ran {stats.queries} queries, its budget is {budget}.'
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        if total_time * 1000 > settings.REQUEST_TIME_BUDGET:
+            logger.warning('%s %s took %.0f ms, the budget is %d ms.', request.method, request.path,
+                           total_time * 1000, settings.REQUEST_TIME_BUDGET)
+        return response
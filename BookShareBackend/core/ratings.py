@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf, TruncDate
+from django.utils import timezone
+
+############################## Stored rating aggregates ##################################
+# Book keeps the sum, the number and the average of its BookRatings, User the ones of the
+# UserRatings it received, so that the serializers read three columns instead of loading
+# every rating. The signals in
+# core/signals.py apply every change as a single UPDATE with F() expressions, the rows
+# are never read and written back, so concurrent ratings can't overwrite each other.
+# "python manage.py repair_ratings" checks them against the ratings and repairs them.
+
+
+def add_ratings(queryset, total, count):
+    # Add `total` to the sum and `count` to the number of ratings of the rows of queryset.
+    # The right-hand sides of an UPDATE see the old row, the average is computed from the new sum/count.
+    rating_sum = F('rating_sum') + total
+    rating_count = F('rating_count') + count
+    queryset.update(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        avg_rating=Coalesce(Cast(rating_sum, FloatField()) / NullIf(rating_count, 0), 0.0))
+
+
+def stale_aggregates(model, ratings, key, value):
+    # Rows of model whose stored aggregates don't match the ratings (ratings grouped on
+    # `key`, the rated row, and summed on `value`), as unsaved instances with the right values
+    actual = {pk: (total, count) for pk, total, count in ratings.values(key).annotate(
+        total=Sum(value), count=Count('id')).values_list(key, 'total', 'count')}
+
+    stale = []
+    for pk, rating_sum, rating_count, avg_rating in model.objects.values_list(
+            'pk', 'rating_sum', 'rating_count', 'avg_rating'):
+        total, count = actual.get(pk, (0, 0))
+        average = total / count if count else 0.0
+        if (rating_sum, rating_count) != (total, count) or abs(avg_rating - average) > 1e-9:
+            stale.append(model(pk=pk, rating_sum=total, rating_count=count, avg_rating=average))
+    return stale
+
+
+def repair_aggregates(model, ratings, key, value):
+    # Recompute the stale rows, returns how many there were.
+    stale = stale_aggregates(model, ratings, key, value)
+    model.objects.bulk_update(stale, ['rating_sum', 'rating_count', 'avg_rating'], batch_size=1000)
+    return len(stale)
+
+
+############################## Daily rating buckets ##################################
+# BookRatingBucket keeps the sum and the number of the BookRatings of a book created on a
+# day (BookRating.created_at in TIME_ZONE). A leaderboard over the last N days
+# (recommender.top_rated) adds up at most N rows per book instead of scanning the ratings.
+# A rating stays in the bucket of the day it was created, an update only changes its value.
+
+def bucket_day(created_at):
+    return timezone.localdate(created_at)
+
+
+def add_to_bucket(model, book_id, day, total, count):
+    # Only a new rating creates its bucket, an update or a delete finds it (unless the
+    # book itself is being deleted, its buckets are then already gone)
+    buckets = model.objects.filter(book_id=book_id, day=day)
+    changes = {'rating_sum': F('rating_sum') + total, 'rating_count': F('rating_count') + count}
+    if not buckets.update(**changes) and count > 0:
+        model.objects.get_or_create(book_id_id=book_id, day=day)
+        buckets.update(**changes)
+
+
+def _bucket_totals(ratings):
+    return {(book_id, day): (total, count) for book_id, day, total, count in ratings.annotate(
+        day=TruncDate('created_at')).values('book_id', 'day').annotate(
+        total=Sum('book_rating'), count=Count('id')).values_list('book_id', 'day', 'total', 'count')}
+
+
+def stale_buckets(model, ratings):
+    # (book id, day) of the buckets that don't match the ratings
+    actual = _bucket_totals(ratings)
+    stored = {(book_id, day): (total, count) for book_id, day, total, count in model.objects.exclude(
+        rating_count=0).values_list('book_id', 'day', 'rating_sum', 'rating_count')}
+    return sorted(key for key in actual.keys() | stored.keys() if actual.get(key) != stored.get(key))
+
+
+def repair_buckets(model, ratings):
+    # Rebuild all the buckets if any of them is stale, returns the number of stale buckets
+    stale = stale_buckets(model, ratings)
+    if stale:
+        rows = [model(book_id_id=book_id, day=day, rating_sum=total, rating_count=count)
+                for (book_id, day), (total, count) in _bucket_totals(ratings).items()]
+        with transaction.atomic():
+            model.objects.all().delete()
+            model.objects.bulk_create(rows, batch_size=1000)
+    return len(stale)
@@ -0,0 +1,139 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.db.models import F
+
+from .models import BookRating, RecommendationState, VersionStamp
+
+############################## Recommendation result cache ##################################
+# The recommendations of a user only change when the catalog changes (books, their
+# categories, the copies) or when the user's own ratings change. Both are tracked with
+# version stamps that are part of every cache key, the signals in core/signals.py bump
+# them, so stale entries are never read again and age out of the LRU/TTL cache.
+# The facets of the home page (see core/facets.py) are cached the same way.
+
+CATALOG_VERSION_KEY = 'catalog-version'
+# The neighbours of "more like this" change when the similarity index is updated (see core/similarity.py).
+# The index is updated by a management command, in another process: a shared stamp (see below).
+INDEX_VERSION_KEY = 'similarity-index-version'
+# The copies lent or returned, only counted by the facets
+AVAILABILITY_VERSION_KEY = 'availability-version'
+
+
+def _cache():
+    return caches['recommendations']
+
+
+def _user_version_key(user_id):
+    return f'user-version:{user_id}'
+
+
+def _version(key):
+    version = _cache().get(key)
+    if version is None:
+        # A fresh stamp, so a version key evicted from the cache never brings back old entries
+        _cache().add(key, time.time_ns(), timeout=None)
+        version = _cache().get(key)
+    return version
+
+
+def _bump(key):
+    _cache().set(key, time.time_ns(), timeout=None)
+
+
+def invalidate_catalog():
+    # After commit, so a request running in between can't cache the old state under the new stamp
+    transaction.on_commit(lambda: _bump(CATALOG_VERSION_KEY))
+
+
+def index_version():
+    return shared_version(INDEX_VERSION_KEY)
+
+
+def invalidate_index():
+    transaction.on_commit(lambda: bump_shared_version(INDEX_VERSION_KEY))
+
+
+def availability_version():
+    return _version(AVAILABILITY_VERSION_KEY)
+
+
+def invalidate_availability():
+    transaction.on_commit(lambda: _bump(AVAILABILITY_VERSION_KEY))
+
+
+def invalidate_user(user_id):
+    def bump():
+        _bump(_user_version_key(user_id))
+        mark_stale([user_id])
+    transaction.on_commit(bump)
+
+
+def get_or_compute(name, user_id, *args, compute, timeout=DEFAULT_TIMEOUT):
+    # Return the cached result of compute() for this user and arguments
+    key = ':'.join(str(part) for part in (
+        name, _version(CATALOG_VERSION_KEY), _version(_user_version_key(user_id)), user_id, *args))
+    value = _cache().get(key)
+    if value is None:
+        value = compute()
+        _cache().set(key, value, timeout=timeout)
+    return value
+
+
+############################## Shared version stamps ##################################
+# The recommendations cache is local to each process (LocMemCache), a stamp bumped in it is
+# only seen by that process. The changes made by another process (a management command, the
+# other workers) are told with a stamp kept in the database instead (VersionStamp). A process
+# reads a stamp again at most every SHARED_VERSION_INTERVAL seconds, so it keeps serving what
+# it cached under the old stamp for that long at most.
+
+_stamps = {}
+
+
+def shared_version(name):
+    read_at, stamp = _stamps.get(name, (None, None))
+    now = time.monotonic()
+    if read_at is None or now - read_at >= settings.SHARED_VERSION_INTERVAL:
+        # 0 until it is bumped for the first time
+        stamp = VersionStamp.objects.filter(name=name).values_list('stamp', flat=True).first() or 0
+        _stamps[name] = (now, stamp)
+    return stamp
+
+
+def bump_shared_version(name, previous=None):
+    # A time stamp rather than a counter, a stamp never comes back (e.g. a rolled back bump).
+    # With previous, only bumped if the stamp is still previous (nobody bumped it since): returns
+    # the new stamp, None when it was not bumped.
+    stamp = time.time_ns()
+    if previous is None:
+        VersionStamp.objects.update_or_create(name=name, defaults={'stamp': stamp})
+    elif previous == 0:
+        if not VersionStamp.objects.get_or_create(name=name, defaults={'stamp': stamp})[1]:
+            return None
+    elif not VersionStamp.objects.filter(name=name, stamp=previous).update(stamp=stamp):
+        return None
+    _stamps[name] = (time.monotonic(), stamp)
+    return stamp
+
+
+############################## Precomputed recommendations staleness ##################################
+# The lists stored by "python manage.py precompute_recommendations" are recomputed by
+# its --incremental mode when the version of their user moved past the computed one.
+
+def mark_stale(user_ids):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    RecommendationState.objects.bulk_create(
+        [RecommendationState(user_id_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    RecommendationState.objects.filter(user_id__in=user_ids).update(version=F('version') + 1)
+
+
+def invalidate_neighbourhood(book_ids):
+    # The content-based lists are seeded by the books a user rated above 6,
+    # the users whose seeds are among these books need a new list
+    mark_stale(BookRating.objects.filter(
+        book_id__in=list(book_ids), book_rating__gt=6).values_list('book_rater_id', flat=True).distinct())
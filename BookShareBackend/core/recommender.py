@@ -1,208 +1,256 @@
-from .models import *
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import CountVectorizer
-from user_app.models import User
-
-
-
-
-
-## version 1.0
-def get_recommendations(id, user_id):
-    # Load UserBooks into a DataFrame
-    user_books = pd.DataFrame.from_records(UserBook.objects.all().values(
-        'id', 'book_owner_id', 'book_id', 'book_id__book_name', 'book_id__author', 'book_id__categories__category', 'book_image_url'))
-    
-    ratings_df = pd.DataFrame.from_records(BookRating.objects.all().values())
-
-    # get all the books rated by this user as a list
-    rated_books = ratings_df.loc[ratings_df['book_rater_id_id'] == user_id, 'book_id_id'].tolist()
-    
-    user_books['book_image_url'] = user_books['book_image_url'].apply(lambda x: 'http://127.0.0.1:8000/media/' + x)
-
-    # Renaming the columns
-    user_books = user_books.rename(columns={
-        'book_id__book_name': 'title',
-        'book_owner_id': 'owner_id',
-        'book_id__author': 'author',
-        'book_id__categories__category': 'genres',
-        'book_image_url': 'image'
-    })
-
-    # Grouping the data (Grouping categories)
-    # lambda function uses the filter() function 
-    # to remove any None values from the set before joining the remaining values with ', '.
-    data = user_books.groupby('id').agg({
-        'book_id': 'first',
-        'owner_id': 'first',
-        'title': 'first',
-        'author': 'first',
-        'genres': lambda x: ', '.join(set(filter(None, x))),
-        'image': 'first'
-    }).reset_index()
-
-    # get all the books owned by this user as a list
-    owned_books = data.loc[data['owner_id'] == user_id, 'book_id'].tolist()
-
-    cleaned_data = data.copy()
-
-    # Function to convert all strings to lower case and strip names of spaces
-    def clean_data(x):
-        #Check if director exists. If not, return empty string
-        if isinstance(x, str):
-            out = str.lower(x.replace(" ", ""))
-            output_string = out.replace(',', ' ')
-            return output_string
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.db.models import OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import Book, BookRating, BookRatingBucket, UserBook
+from .ratings import bucket_day
+from .similarity import (create_metadata, feature_matrix, neighbourhood, representative_copies, similarity_rows,
+                         top_k)
+
+TOP_RATED_KEY = 'top-rated'
+
+############################## Recommendation engine ##################################
+# numpy, scipy and scikit-learn are only needed by the recommendation endpoints,
+# they are imported on first use so that the workers, the management commands and the
+# tests that never call them don't pay for loading them.
+
+
+@contextmanager
+def stage(timings, name):
+    # Add the time spent in the block to timings[name], used by the benchmark (core/benchmark.py)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+# version 3.0
+# Same results as version 1.0 (cosine on author + categories, 0.3 threshold, one copy of a book
+# stands for it) but the features are built once per book instead of once per copy, and only
+# the rows of the requested books are scored, against the sparse feature matrix.
+# The cost grows with the number of distinct books, not with the number of copies.
+# The requests only load the neighbourhood of their seed books (see similarity.neighbourhood),
+# the cosine of two books doesn't depend on the other books the vectorizer is fitted on.
+def load_books(user_id, timings=None, books=None):
+    # Every book that has a copy, or only the ones among books (ids or a subquery)
+    import numpy as np
+
+    with stage(timings, 'load'):
+        # One row per book that has a copy, ordered by book id, with its representative copy
+        latest = representative_copies(UserBook.objects.all()).values('latest')
+        links = Book.categories.through.objects.all()
+        if books is not None:
+            latest = latest.filter(book_id__in=books)
+            links = links.filter(book_id__in=books)
+        copies = list(UserBook.objects.filter(id__in=Subquery(latest)).order_by('book_id').values_list(
+            'id', 'book_owner_id', 'book_id', 'book_id__book_name', 'book_id__author', 'book_image_url'))
+        book_ids = np.array([copy[2] for copy in copies], dtype=np.int64)
+
+        categories = defaultdict(set)
+        for book_id, category in links.values_list('book_id', 'category__category'):
+            categories[book_id].add(category)
+
+        # get all the books owned and rated by this user
+        owned_books = np.array(UserBook.objects.filter(
+            book_owner_id=user_id).values_list('book_id', flat=True), dtype=np.int64)
+        rated_books = np.array(BookRating.objects.filter(
+            book_rater_id=user_id).values_list('book_id', flat=True), dtype=np.int64)
+
+    with stage(timings, 'vectorize'):
+        matrix = feature_matrix([create_metadata(copy[4], categories[copy[2]]) for copy in copies])
+
+    return {
+        'copies': copies,
+        'book_ids': book_ids,
+        'copy_ids': np.array([copy[0] for copy in copies], dtype=np.int64),
+        'categories': categories,
+        'excluded_books': np.concatenate((owned_books, rated_books)),
+        'matrix': matrix,
+    }
+
+
+def book_row(catalog, book_id):
+    # Row of this book in the catalog, None if it has no copy
+    import numpy as np
+
+    row = int(np.searchsorted(catalog['book_ids'], book_id))
+    if row < len(catalog['book_ids']) and catalog['book_ids'][row] == book_id:
+        return row
+    return None
+
+
+def recommend_rows(catalog, index, rows, scores, limit):
+    import numpy as np
+
+    book_ids = catalog['book_ids']
+
+    # drop the same book, the books owned by this user and the books rated by this user
+    keep = ~np.isin(book_ids[rows], catalog['excluded_books']) & (rows != index)
+    rows, scores = rows[keep], scores[keep]
+
+    # keep only the first `limit` books, on equal scores the oldest representative copy first
+    return rows[top_k(scores, limit, catalog['copy_ids'][rows])]
+
+
+def recommendation_dict(catalog, row):
+    copy = catalog['copies'][row]
+    return {
+        'user_book_id': copy[0],
+        'book_id': copy[2],
+        'owner_id': copy[1],
+        'book_name': copy[3],
+        'author': copy[4],
+        'categories__category': ', '.join(catalog['categories'][copy[2]]),
+        'image_url': 'http://127.0.0.1:8000/media/' + copy[5]
+    }
+
+
+def get_recommendations(id, user_id, timings=None):
+    # any copy of a book can be asked about, they all stand for the book
+    seed = UserBook.objects.values_list('book_id', flat=True).get(id=id)
+    catalog = load_books(user_id, timings, neighbourhood([seed]))
+    with stage(timings, 'score'):
+        index = book_row(catalog, seed)
+        if index is None:
+            return []
+        _, rows, scores = next(similarity_rows(catalog['matrix'], [index]))
+    with stage(timings, 'filter'):
+        recommended_rows = recommend_rows(catalog, index, rows, scores, 10)
+    with stage(timings, 'serialize'):
+        return [recommendation_dict(catalog, row) for row in recommended_rows]
+
+
+def get_recommendations_for_books(seed_book_ids, user_id, per_seed=2, timings=None):
+    # Recommendations for several seed books at once: the catalog is loaded and vectorized
+    # once and all the seed rows are scored in a single sparse product.
+    # Every seed contributes its first `per_seed` books, the duplicates are dropped (first kept).
+    catalog = load_books(user_id, timings, neighbourhood(seed_book_ids))
+    recommended_rows = recommend_for_seeds(catalog, seed_book_ids, per_seed, timings)
+    with stage(timings, 'serialize'):
+        return [recommendation_dict(catalog, row) for row in recommended_rows]
+
+
+def recommend_for_seeds(catalog, seed_book_ids, per_seed=2, timings=None):
+    # Rows of the recommended books, also used by the precompute job (core/precompute.py)
+    # which loads the catalog once and swaps the excluded books of every user
+    book_ids = catalog['book_ids']
+
+    with stage(timings, 'score'):
+        seed_rows = [row for row in (book_row(catalog, book_id) for book_id in seed_book_ids) if row is not None]
+        scored = list(similarity_rows(catalog['matrix'], seed_rows))
+
+    with stage(timings, 'filter'):
+        recommended_rows, seen = [], set()
+        for index, rows, scores in scored:
+            for row in recommend_rows(catalog, index, rows, scores, per_seed):
+                if book_ids[row] not in seen:
+                    seen.add(book_ids[row])
+                    recommended_rows.append(row)
+    return recommended_rows
+
+
+# Top rated books, ranked with the IMDB weighted rating:
+#     score = v / (v + m) * R + m / (v + m) * C
+# v is the number of ratings of the book, R its average rating, C the mean of the average
+# ratings of the rated books and m the 90th percentile of the number of ratings of all the
+# books: for a book to feature in the chart, it must have more rates than at least 90% of
+# the books. The averages and counts are the stored aggregates (core/ratings.py), one row
+# per book, scored with numpy; the endpoint serves a snapshot of it (top_rated_snapshot).
+# A chart can be limited to the books of a category and to the ratings of the last `days`
+# days, C and m are then computed over that category and those ratings only.
+def top_rated(timings=None, limit=10, category=None, days=None):
+    import numpy as np
+
+    with stage(timings, 'load'):
+        books = Book.objects.order_by('id')
+        if category is not None:
+            books = books.filter(categories=category)
+        if days is None:
+            rows = np.array(books.values_list('id', 'rating_count', 'avg_rating'), dtype=np.float64).reshape(-1, 3)
+            ids, counts, averages = rows[:, 0].astype(np.int64), rows[:, 1], rows[:, 2]
         else:
-            return ''
-            
-    # Apply clean_data function to your features.
-    features = ['author', 'genres']
-
-    for feature in features:
-        cleaned_data[feature] = cleaned_data[feature].apply(clean_data)
-
-    def create_metadata(x):
-        return x['author'] + ' ' + x['genres']
-    cleaned_data['metadata'] = cleaned_data.apply(create_metadata, axis=1)
-
-    count = CountVectorizer(stop_words='english')
-    count_matrix = count.fit_transform(cleaned_data['metadata'])
-
-    cosine_sim = cosine_similarity(count_matrix, count_matrix)
-
-    print(data)
-    print(cosine_sim)
-
-    index = data.index[data['id'] == id][0]
-    same_book_id = data[data['id'] == id]['book_id'].iloc[0]
-
-    similarity_series = pd.Series(cosine_sim[index]).sort_values(ascending=False)
-    list_index = similarity_series[similarity_series > 0.3].index.tolist()
-
-    recommended_data = data.iloc[list_index]
-
-    # drop the same books
-    recommended_data = recommended_data[~(recommended_data['book_id']==same_book_id)]
-
-    # drop all books that owned by this user
-    recommended_data = recommended_data[~recommended_data['book_id'].isin(owned_books)]
-
-    # drop all books that rated by this user
-    recommended_data = recommended_data[~recommended_data['book_id'].isin(rated_books)]
-    
-    # drop duplicate books
-    recommended_data.drop_duplicates(['book_id'], keep='last', inplace=True)
-
-    # get only first 10 books
-    if recommended_data.shape[0] > 10:
-        recommended_data = recommended_data[:10]
-
-    # convert dataframe to dictionary
-    # We used the 'records' option in the to_dict() method 
-    # to convert the DataFrame to a list of dictionaries, where each dictionary represents a row in the DataFrame.
-    recommended_data_dict = recommended_data.to_dict('records')
-    return recommended_data_dict
-
-print(get_recommendations(1, 4))
-
-### Beta version
-# def get_recommendations(id, user_id):
-#     # Load UserBooks into a DataFrame
-#     user_books = pd.DataFrame.from_records(UserBook.objects.all().values(
-#         'id', 'book_owner_id', 'book_id', 'book_id__book_name', 'book_id__author', 'book_id__categories__category', 'book_image_url'))
-#     ratings_df = pd.DataFrame.from_records(BookRating.objects.all().values())
-
-#     book_rater_id = user_id # set the book_rater_id_id that you want to filter by
-#     # get all the books rated by this user as a list
-#     rated_books = ratings_df.loc[ratings_df['book_rater_id_id'] == book_rater_id, 'book_id_id'].tolist()
-#     print(rated_books)
-    
-#     user_books['book_image_url'] = user_books['book_image_url'].apply(lambda x: 'http://127.0.0.1:8000/media/' + x)
-
-#     # Renaming the columns
-#     user_books = user_books.rename(columns={
-#         'book_id__book_name': 'title',
-#         'book_owner_id': 'owner_id',
-#         'book_id__author': 'author',
-#         'book_id__categories__category': 'genres',
-#         'book_image_url': 'image'
-#     })
-
-#     if not user_books[(user_books['owner_id'] == user_id) & (user_books['id'] == id)].empty:
-#         return {'detail': 'Bad request, this book is owned by this user'}
-#         # return Response({'detail': 'Bad request, this book is owned by this user'}, status=status.HTTP_400_BAD_REQUEST)
-
-
-
-#     # drop all books that owned by this user
-#     # user_books = user_books.drop(user_books[user_books['owner_id'] == user_id].index)
-
-#     # # drop all books that rated by this user
-#     # user_books = user_books[~user_books['book_id'].isin(rated_books)]
-
-#     # Grouping the data and drop duplicates
-#     data = user_books.groupby('id').agg({
-#         'book_id': 'first',
-#         'owner_id': 'first',
-#         'title': 'first',
-#         'author': 'first',
-#         'genres': lambda x: ', '.join(set(x)),
-#         'image': 'first'
-#     }).drop_duplicates(['book_id'], keep='last').reset_index()
-
-#     cleaned_data = data.copy()
-
-#     # Function to convert all strings to lower case and strip names of spaces
-#     def clean_data(x):
-#         #Check if director exists. If not, return empty string
-#         if isinstance(x, str):
-#             out = str.lower(x.replace(" ", ""))
-#             output_string = out.replace(',', ' ')
-#             return output_string
-#         else:
-#             return ''
-            
-#     # Apply clean_data function to your features.
-#     features = ['author', 'genres']
-
-#     for feature in features:
-#         cleaned_data[feature] = cleaned_data[feature].apply(clean_data)
-
-#     def create_metadata(x):
-#         return x['author'] + ' ' + x['genres']
-#     cleaned_data['metadata'] = cleaned_data.apply(create_metadata, axis=1)
-
-#     count = CountVectorizer(stop_words='english')
-#     count_matrix = count.fit_transform(cleaned_data['metadata'])
-
-#     cosine_sim = cosine_similarity(count_matrix, count_matrix)
-
-#     print(data)
-#     print(cosine_sim)
-
-#     index = data.index[data['id'] == id][0]
-
-#     similarity_series = pd.Series(cosine_sim[index]).sort_values(ascending=False)
-#     list_index = similarity_series[similarity_series > 0.3].index.tolist()
-
-#     list_index.remove(index)
-#     recommended_data = []
-#     if len(list_index) <= 10:
-#         recommended_data = data.iloc[list_index]
-#     else:
-#         recommended_data = data.iloc[list_index[:10]]
-
-#     # drop all books that owned by this user
-#     recommended_data = recommended_data.drop(recommended_data[recommended_data['owner_id'] == user_id].index)
-
-#     # drop all books that rated by this user
-#     recommended_data = recommended_data[~recommended_data['book_id'].isin(rated_books)]
-
-
-#     # convert dataframe to dictionary
-#     # We used the 'records' option in the to_dict() method 
-#     # to convert the DataFrame to a list of dictionaries, where each dictionary represents a row in the DataFrame.
-#     recommended_data_dict = recommended_data.to_dict('records')
-#     return recommended_data_dict
\ No newline at end of file
+            ids = np.array(books.values_list('id', flat=True), dtype=np.int64)
+            counts, averages = np.zeros(len(ids)), np.zeros(len(ids))
+            window = np.array(window_aggregates(books, days), dtype=np.float64).reshape(-1, 3)
+            positions = np.searchsorted(ids, window[:, 0].astype(np.int64))
+            counts[positions] = window[:, 2]
+            averages[positions] = window[:, 1] / window[:, 2]
+        # a book with no copy left has nothing to link to
+        available = np.isin(ids, np.array(UserBook.objects.values_list('book_id', flat=True).distinct(), dtype=np.int64))
+
+    with stage(timings, 'filter'):
+        rated = counts > 0
+        if not rated.any():
+            return []
+        C = averages[rated].mean()
+        m = np.quantile(counts, 0.9)
+        # The books that qualify for the chart, an unrated book has no average to rank it by
+        qualified = np.flatnonzero((counts >= m) & rated & available)
+
+    with stage(timings, 'score'):
+        v, R = counts[qualified], averages[qualified]
+        scores = v / (v + m) * R + m / (v + m) * C
+        # best scores first, the oldest book first on equal scores
+        best = qualified[np.lexsort((ids[qualified], -scores))[:limit]]
+        stats = {int(ids[row]): (float(averages[row]), int(counts[row]), float(scores[position]))
+                 for position, row in enumerate(qualified)}
+
+    with stage(timings, 'serialize'):
+        return top_rated_records([int(book_id) for book_id in ids[best]], stats)
+
+
+def window_aggregates(books, days):
+    # (book id, sum, number) of the ratings of the last `days` days (today included) of these books
+    since = bucket_day(timezone.now()) - timedelta(days=days - 1)
+    return BookRatingBucket.objects.filter(day__gte=since, book_id__in=books.values('id')).values(
+        'book_id').annotate(total=Sum('rating_sum'), count=Sum('rating_count')).filter(
+        count__gt=0).values_list('book_id', 'total', 'count')
+
+
+def top_rated_snapshot(category=None, days=None):
+    # A chart is the same for everybody and moves slowly: it is computed at most once per
+    # TOP_RATED_REFRESH seconds and the requests in between return the stored snapshot
+    cache = caches['recommendations']
+    key = f'{TOP_RATED_KEY}:{category}:{days}'
+    data = cache.get(key)
+    if data is None:
+        data = top_rated(category=category, days=days)
+        cache.set(key, data, timeout=settings.TOP_RATED_REFRESH)
+    return data
+
+
+def top_rated_records(book_ids, stats):
+    # stats: book id -> (average rating, number of ratings, score).
+    # One query for the books with their newest copy (an available one first), one for their categories
+    newest = UserBook.objects.filter(book_id=OuterRef('pk')).order_by('-status', '-created_at')
+    books = {book['id']: book for book in Book.objects.filter(id__in=book_ids).annotate(
+        user_book_id=Subquery(newest.values('id')[:1]),
+        image=Subquery(newest.values('book_image_url')[:1]),
+    ).values('id', 'book_name', 'user_book_id', 'image')}
+
+    categories = defaultdict(set)
+    for book_id, category in Book.categories.through.objects.filter(
+            book_id__in=book_ids).values_list('book_id', 'category__category'):
+        categories[book_id].add(category)
+
+    return [{
+        'id': book_id,
+        'book_name': books[book_id]['book_name'],
+        'avg_rating': stats[book_id][0],
+        'num_ratings': stats[book_id][1],
+        'categories__category': ', '.join(categories[book_id]),
+        'score': stats[book_id][2],
+        'user_book_id': books[book_id]['user_book_id'],
+        'image_url': 'http://127.0.0.1:8000' + default_storage.url(books[book_id]['image']),
+    } for book_id in book_ids]
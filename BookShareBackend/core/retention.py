@@ -0,0 +1,50 @@
+import time
+from collections import Counter, defaultdict
+
+from django.db import transaction
+
+from .borrowing import BORROW_REQUEST
+from .models import Notification
+from .unread import add_unread
+
+############################## Notification retention ##################################
+# The answers (accept, reject, return) stay in the list of their receiver forever, so
+# "manage.py prune_notifications" deletes the notifications older than
+# NOTIFICATION_RETENTION_DAYS. A pending borrow request is kept whatever its age, it is
+# the state of the copy until the owner answers it.
+# The old rows are deleted BATCH_SIZE at a time, walking the primary key (the oldest ids
+# first), each batch in its own short transaction so that the writes of the site wait for
+# one batch at most. The unread counters of the receivers are updated once per batch
+# instead of once per row by the post_delete signal.
+
+BATCH_SIZE = 500
+
+
+def prune_notifications(before, batch_size=BATCH_SIZE, pause=0):
+    # Delete the notifications created before the datetime before, sleeping pause seconds
+    # between the batches; returns how many were deleted
+    old = Notification.objects.filter(created_at__lt=before).exclude(type=BORROW_REQUEST)
+    deleted, last_id = 0, 0
+    while True:
+        with transaction.atomic():
+            rows = list(old.select_for_update().filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'receiver_id', 'is_read')[:batch_size])
+            if not rows:
+                return deleted
+            ids = [id for id, _, _ in rows]
+            _forget_unread(ids, [receiver_id for _, receiver_id, is_read in rows if not is_read])
+            deleted += Notification.objects.filter(id__in=ids).delete()[0]
+            last_id = ids[-1]
+        if pause:
+            time.sleep(pause)
+
+
+def _forget_unread(ids, receiver_ids):
+    # Read before deleted, the post_delete signal has nothing left to count. The receivers
+    # with the same number of unread rows in the batch are updated together.
+    Notification.objects.filter(id__in=ids, is_read=False).update(is_read=True)
+    by_count = defaultdict(list)
+    for receiver_id, count in Counter(receiver_ids).items():
+        by_count[count].append(receiver_id)
+    for count, receivers in by_count.items():
+        add_unread(receivers, -count)
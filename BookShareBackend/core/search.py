@@ -0,0 +1,151 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils.module_loading import import_string
+from rest_framework import filters
+
+from .models import Book, UserBook
+
+############################## Full-text search ##################################
+# The book search (Book rows) and the catalog search (UserBook rows, the copies, with the
+# name and address of their owner) read a full-text index instead of scanning the tables
+# with LIKE '%term%'. The backend is settings.SEARCH_BACKEND: SQLiteFTSBackend keeps two
+# FTS5 tables (read through the unmanaged BookSearchDocument/UserBookSearchDocument models,
+# created by migration 0014), another engine gets its own backend with the same methods, None falls back
+# to the LIKE search of SearchFilter. The index is kept in sync by core/signals.py and
+# rebuilt by "python manage.py rebuild_search_index".
+# Like SearchFilter every term must match (as a prefix of a word here) one of the fields
+# of the view's search_fields, the results are ranked with BM25.
+
+# model -> (search_fields of the views -> column of the index)
+COLUMNS = {
+    Book: {
+        'book_name': 'book_name',
+        'author': 'author',
+        'ISBN': 'isbn',
+        'publisher': 'publisher',
+    },
+    UserBook: {
+        'book_id__book_name': 'book_name',
+        'book_id__author': 'author',
+        'book_id__ISBN': 'isbn',
+        'book_id__publisher': 'publisher',
+        'book_owner_id__first_name': 'owner',
+        'book_owner_id__last_name': 'owner',
+        'book_owner_id__address': 'owner',
+    },
+}
+
+
+class SQLiteFTSBackend:
+    tables = {Book: 'core_book_fts', UserBook: 'core_userbook_fts'}
+    # BM25 weights of book_name, author, isbn, publisher (and owner)
+    weights = {Book: 'bm25(10.0, 5.0, 2.0, 1.0)', UserBook: 'bm25(10.0, 5.0, 2.0, 1.0, 2.0)'}
+
+    # The documents, selected from the tables so that the index can be filled without the models
+    BOOK_DOCUMENTS = '''
+        SELECT book.id, book.book_name, book.author, COALESCE(book."ISBN", ''),
+               COALESCE(book.publisher, '')
+        FROM core_book book'''
+    COPY_DOCUMENTS = '''
+        SELECT copy.id, book.book_name, book.author, COALESCE(book."ISBN", ''),
+               COALESCE(book.publisher, ''),
+               owner.first_name || ' ' || owner.last_name || ' ' || COALESCE(owner.address, '')
+        FROM core_userbook copy
+        JOIN core_book book ON book.id = copy.book_id_id
+        JOIN user_app_user owner ON owner.id = copy.book_owner_id_id'''
+
+    def create(self, cursor):
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS core_book_fts USING fts5(
+            book_name, author, isbn, publisher, tokenize = "unicode61 remove_diacritics 2")''')
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS core_userbook_fts USING fts5(
+            book_name, author, isbn, publisher, owner, tokenize = "unicode61 remove_diacritics 2")''')
+        for model, table in self.tables.items():
+            cursor.execute(f"INSERT INTO {table}({table}, rank) VALUES ('rank', %s)", [self.weights[model]])
+
+    def rebuild(self, cursor=None):
+        # Returns the number of books and copies indexed
+        with cursor or connection.cursor() as cursor:
+            cursor.execute('DELETE FROM core_book_fts')
+            cursor.execute(f'INSERT INTO core_book_fts(rowid, book_name, author, isbn, publisher) {self.BOOK_DOCUMENTS}')
+            books = cursor.rowcount
+            cursor.execute('DELETE FROM core_userbook_fts')
+            cursor.execute('INSERT INTO core_userbook_fts(rowid, book_name, author, isbn, publisher, owner) '
+                           f'{self.COPY_DOCUMENTS}')
+            return books, cursor.rowcount
+
+    def index(self, book_ids=(), copy_ids=(), owner_ids=()):
+        # Rewrite the documents of these books, of these copies and of the copies of these books/owners
+        with connection.cursor() as cursor:
+            for chunk in _chunks(book_ids):
+                cursor.execute(f'DELETE FROM core_book_fts WHERE rowid IN ({_marks(chunk)})', chunk)
+                cursor.execute(f'INSERT INTO core_book_fts(rowid, book_name, author, isbn, publisher) '
+                               f'{self.BOOK_DOCUMENTS} WHERE book.id IN ({_marks(chunk)})', chunk)
+                self._index_copies(cursor, f'copy.book_id_id IN ({_marks(chunk)})', chunk)
+            for chunk in _chunks(copy_ids):
+                self._index_copies(cursor, f'copy.id IN ({_marks(chunk)})', chunk)
+            for chunk in _chunks(owner_ids):
+                self._index_copies(cursor, f'copy.book_owner_id_id IN ({_marks(chunk)})', chunk)
+
+    def _index_copies(self, cursor, where, params):
+        cursor.execute(f'DELETE FROM core_userbook_fts WHERE rowid IN (SELECT copy.id FROM core_userbook copy '
+                       f'WHERE {where})', params)
+        cursor.execute('INSERT INTO core_userbook_fts(rowid, book_name, author, isbn, publisher, owner) '
+                       f'{self.COPY_DOCUMENTS} WHERE {where}', params)
+
+    def remove(self, book_ids=(), copy_ids=()):
+        with connection.cursor() as cursor:
+            for table, ids in (('core_book_fts', book_ids), ('core_userbook_fts', copy_ids)):
+                for chunk in _chunks(ids):
+                    cursor.execute(f'DELETE FROM {table} WHERE rowid IN ({_marks(chunk)})', chunk)
+
+    def search(self, queryset, columns, terms):
+        # queryset filtered on the rows matching every term, annotated with their search_rank
+        # (lower is better), None when the terms have nothing to search for
+        words = [' '.join(re.findall(r'\w+', term)) for term in terms]
+        words = [word for word in words if word]
+        if not words:
+            return None
+        query = '{%s} : (%s)' % (' '.join(columns), ' AND '.join(f'"{word}"*' for word in words))
+        # Joined on the rowid, the full-text query drives the join and rank is computed once per match
+        return queryset.filter(search_document__document__match=query).annotate(
+            search_rank=F('search_document__rank')).order_by('search_rank', 'id')
+
+
+def _chunks(ids, size=500):
+    ids = list(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+def _marks(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+_backend = None
+
+
+def get_backend():
+    # None when the full-text search is off
+    global _backend
+    if settings.SEARCH_BACKEND is None:
+        return None
+    if _backend is None or type(_backend) is not import_string(settings.SEARCH_BACKEND):
+        _backend = import_string(settings.SEARCH_BACKEND)()
+    return _backend
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    # SearchFilter reading the full-text index, for the views whose search_fields are all indexed
+
+    def filter_queryset(self, request, queryset, view):
+        backend = get_backend()
+        fields = getattr(view, 'search_fields', None) or []
+        columns = COLUMNS.get(queryset.model, {})
+        terms = self.get_search_terms(request)
+        if backend is None or not terms or not fields or any(field not in columns for field in fields):
+            return super().filter_queryset(request, queryset, view)
+
+        results = backend.search(queryset, sorted({columns[field] for field in fields}), terms)
+        return queryset if results is None else results
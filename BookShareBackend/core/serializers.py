@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import *
+from .isbn import parse_isbn
 from user_app.serializers import UserInfoSerializer
 
 
@@ -15,14 +16,25 @@ class BookSerializer(serializers.ModelSerializer):
         source='calculate_number_rating')
     categories_name = serializers.StringRelatedField(source='categories', many=True, read_only=True)
     categories = CategorySerializer(many=True, read_only=True)
+    # Longer than the model field, the separators are removed by validate_ISBN
+    ISBN = serializers.CharField(max_length=20, required=False, allow_null=True, allow_blank=True)
 
     class Meta:
         model = Book
-        exclude = ['owners']
+        exclude = ['owners', 'rating_sum', 'rating_count']
         # extra_kwargs = {
         #     'categories': {'write_only': True}
         # }
-    
+
+    def validate_ISBN(self, value):
+        try:
+            isbn, isbn13 = parse_isbn(value)
+        except ValueError:
+            raise serializers.ValidationError('Enter a valid ISBN-10 or ISBN-13.')
+        if isbn13 and Book.objects.filter(isbn13=isbn13).exclude(pk=getattr(self.instance, 'pk', None)).exists():
+            raise serializers.ValidationError('A book with this ISBN already exists.')
+        return isbn
+
     def create(self, validated_data):
         category_ids = validated_data.pop('categories', [])
         book = super().create(validated_data)
@@ -0,0 +1,269 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, post_init, m2m_changed
+from django.db import transaction
+from django.dispatch import receiver
+from .models import Book, BookRating, BookRatingBucket, BookSimilarity, Category, Notification, UserBook, UserRating
+from .push import publish
+from .ratings import add_ratings, add_to_bucket, bucket_day
+from .recommendation_cache import invalidate_availability, invalidate_catalog, invalidate_user
+from .search import get_backend
+from .similarity import schedule_index_update
+from .suggest import book_changed
+from .unread import add_unread
+
+
+############################## Similarity index and recommendation cache maintenance ##################################
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, **kwargs):
+    schedule_index_update([instance.id])
+    invalidate_catalog()
+
+
+@receiver(pre_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    # The neighbour rows pointing at this book are about to be cascaded away,
+    # the books that listed it need to be refilled
+    schedule_index_update(BookSimilarity.objects.filter(
+        similar_book_id=instance).values_list('book_id', flat=True))
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    # A renamed category changes the features of all of its books
+    if not created:
+        schedule_index_update(instance.book_set.values_list('id', flat=True))
+        invalidate_catalog()
+
+
+@receiver(m2m_changed, sender=Book.categories.through)
+def book_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a Category, pk_set holds book ids
+        if action == 'pre_clear':
+            instance._cleared_books = list(
+                instance.book_set.values_list('id', flat=True))
+        elif action == 'post_clear':
+            schedule_index_update(getattr(instance, '_cleared_books', []))
+        elif action in ('post_add', 'post_remove'):
+            schedule_index_update(pk_set)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        schedule_index_update([instance.id])
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_catalog()
+
+
+def listed_copy(instance):
+    # What the recommendations show of a copy, its status (lent or not) isn't part of them
+    return instance.__dict__.get('book_id_id'), instance.__dict__.get('book_owner_id_id'), str(
+        instance.__dict__.get('book_image_url'))
+
+
+@receiver(post_init, sender=UserBook)
+def user_book_loaded(sender, instance, **kwargs):
+    instance._listed, instance._was_available = listed_copy(instance), instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=UserBook)
+def user_book_saved(sender, instance, created, **kwargs):
+    # The first copy of a book makes it recommendable. Lending or returning a copy only
+    # changes the counts of the home page facets.
+    listed = listed_copy(instance)
+    if created or listed != instance._listed:
+        book_id, owner_id, _ = instance._listed
+        schedule_index_update({instance.book_id_id, book_id} - {None})
+        invalidate_catalog()
+        for user_id in {instance.book_owner_id_id, owner_id} - {None}:
+            invalidate_user(user_id)
+    if created or instance.status != instance._was_available:
+        invalidate_availability()
+    instance._listed, instance._was_available = listed, instance.status
+
+
+@receiver(post_delete, sender=UserBook)
+def user_book_deleted(sender, instance, **kwargs):
+    schedule_index_update([instance.book_id_id])
+    invalidate_catalog()
+    invalidate_availability()
+    invalidate_user(instance.book_owner_id_id)
+
+
+@receiver(post_save, sender=BookRating)
+@receiver(post_delete, sender=BookRating)
+def book_rating_changed(sender, instance, **kwargs):
+    invalidate_user(instance.book_rater_id_id)
+
+
+############################## Stored rating aggregates ##################################
+# rating model -> (rated model, foreign key to it, rating field)
+RATED = {
+    BookRating: (Book, 'book_id', 'book_rating'),
+    UserRating: (get_user_model(), 'user_rated_id', 'user_rating'),
+}
+
+
+@receiver(pre_save, sender=BookRating)
+@receiver(pre_save, sender=UserRating)
+def rating_saving(sender, instance, **kwargs):
+    # Remember the rating being replaced, its value is taken out of the aggregates
+    _, key, value = RATED[sender]
+    instance._previous = sender.objects.filter(pk=instance.pk).values_list(
+        key, value).first() if instance.pk else None
+
+
+@receiver(post_save, sender=BookRating)
+@receiver(post_save, sender=UserRating)
+def rating_saved(sender, instance, **kwargs):
+    model, key, value = RATED[sender]
+    rated_id, rating = getattr(instance, key + '_id'), int(getattr(instance, value))
+    previous = getattr(instance, '_previous', None)
+    if previous is None:
+        add_ratings(model.objects.filter(pk=rated_id), rating, 1)
+    elif previous[0] == rated_id:
+        add_ratings(model.objects.filter(pk=rated_id), rating - previous[1], 0)
+    else:
+        add_ratings(model.objects.filter(pk=previous[0]), -previous[1], -1)
+        add_ratings(model.objects.filter(pk=rated_id), rating, 1)
+    refresh_rated(sender, instance)
+
+
+@receiver(post_delete, sender=BookRating)
+@receiver(post_delete, sender=UserRating)
+def rating_deleted(sender, instance, **kwargs):
+    model, key, value = RATED[sender]
+    add_ratings(model.objects.filter(pk=getattr(instance, key + '_id')), -int(getattr(instance, value)), -1)
+    refresh_rated(sender, instance)
+
+
+def refresh_rated(sender, rating):
+    # The serializers read the aggregates through the rating's foreign key, reload them if it is already loaded
+    _, key, _ = RATED[sender]
+    if sender._meta.get_field(key).is_cached(rating):
+        getattr(rating, key).refresh_from_db(fields=['rating_sum', 'rating_count', 'avg_rating'])
+
+
+@receiver(post_save, sender=BookRating)
+def book_rating_bucketed(sender, instance, **kwargs):
+    # The rating stays in the bucket of the day it was created
+    previous = getattr(instance, '_previous', None)
+    day, rating = bucket_day(instance.created_at), int(instance.book_rating)
+    if previous is None:
+        add_to_bucket(BookRatingBucket, instance.book_id_id, day, rating, 1)
+    elif previous[0] == instance.book_id_id:
+        add_to_bucket(BookRatingBucket, instance.book_id_id, day, rating - previous[1], 0)
+    else:
+        add_to_bucket(BookRatingBucket, previous[0], day, -previous[1], -1)
+        add_to_bucket(BookRatingBucket, instance.book_id_id, day, rating, 1)
+
+
+@receiver(post_delete, sender=BookRating)
+def book_rating_unbucketed(sender, instance, **kwargs):
+    add_to_bucket(BookRatingBucket, instance.book_id_id, bucket_day(instance.created_at),
+                  -int(instance.book_rating), -1)
+
+
+############################## Full-text search index ##################################
+# Written in the same transaction as the rows (see core/search.py). The documents of the
+# copies hold their book and the name/address of their owner: the values indexed are
+# remembered when an instance is loaded, so that saving a copy's status or a user's
+# password doesn't rewrite them.
+INDEXED_FIELDS = {
+    UserBook: ('book_id_id', 'book_owner_id_id'),
+    get_user_model(): ('first_name', 'last_name', 'address'),
+}
+
+
+@receiver(post_init, sender=UserBook)
+@receiver(post_init, sender=get_user_model())
+def indexed_loaded(sender, instance, **kwargs):
+    # __dict__, a deferred field must not be loaded here
+    instance._indexed = tuple(instance.__dict__.get(field) for field in INDEXED_FIELDS[sender])
+
+
+def indexed_changed(sender, instance):
+    indexed = tuple(getattr(instance, field) for field in INDEXED_FIELDS[sender])
+    changed, instance._indexed = indexed != getattr(instance, '_indexed', None), indexed
+    return changed
+
+
+@receiver(post_save, sender=Book)
+def book_indexed(sender, instance, **kwargs):
+    backend = get_backend()
+    if backend:
+        backend.index(book_ids=[instance.id])
+
+
+@receiver(post_delete, sender=Book)
+def book_unindexed(sender, instance, **kwargs):
+    backend = get_backend()
+    if backend:
+        backend.remove(book_ids=[instance.id])
+
+
+@receiver(post_save, sender=UserBook)
+def user_book_indexed(sender, instance, created, **kwargs):
+    backend = get_backend()
+    if backend and (indexed_changed(sender, instance) or created):
+        backend.index(copy_ids=[instance.id])
+
+
+@receiver(post_delete, sender=UserBook)
+def user_book_unindexed(sender, instance, **kwargs):
+    backend = get_backend()
+    if backend:
+        backend.remove(copy_ids=[instance.id])
+
+
+@receiver(post_save, sender=get_user_model())
+def owner_indexed(sender, instance, created, **kwargs):
+    # A new user has no copies yet
+    backend = get_backend()
+    if backend and indexed_changed(sender, instance) and not created:
+        backend.index(owner_ids=[instance.id])
+
+
+############################## Autocomplete index ##################################
+# Patched after commit, in memory (see core/suggest.py)
+
+@receiver(post_save, sender=Book)
+def book_suggested(sender, instance, **kwargs):
+    book_changed(instance.id, (instance.book_name, instance.author))
+
+
+@receiver(post_delete, sender=Book)
+def book_unsuggested(sender, instance, **kwargs):
+    book_changed(instance.id, None)
+
+
+############################## Notification push ##################################
+# To the connections of the receiver, after commit (see core/push.py)
+
+@receiver(post_save, sender=Notification)
+def notification_pushed(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: publish(instance.id, instance.receiver_id_id))
+
+
+############################## Unread notification counters ##################################
+# See core/unread.py, whether a notification was read is remembered when it is loaded
+
+@receiver(post_init, sender=Notification)
+def notification_loaded(sender, instance, **kwargs):
+    instance._was_read = instance.__dict__.get('is_read')
+
+
+@receiver(post_save, sender=Notification)
+def notification_counted(sender, instance, created, **kwargs):
+    if created:
+        if not instance.is_read:
+            add_unread([instance.receiver_id_id], 1)
+    elif instance.is_read != instance._was_read:
+        add_unread([instance.receiver_id_id], -1 if instance.is_read else 1)
+    instance._was_read = instance.is_read
+
+
+@receiver(post_delete, sender=Notification)
+def notification_uncounted(sender, instance, **kwargs):
+    if not instance.is_read:
+        add_unread([instance.receiver_id_id], -1)
@@ -0,0 +1,280 @@
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Book, BookRating, BookSimilarity, BookTerm, SimilarityUpdate, UserBook
+from .recommendation_cache import invalidate_index, invalidate_neighbourhood
+
+############################## Sparse similarity engine ##################################
+# The features are the author and the categories of a book, counted with
+# CountVectorizer(stop_words='english') and L2-normalized, so the dot product of two
+# rows is their cosine similarity. The matrix is kept sparse (CSR) and only the rows
+# we are asked about are multiplied against it, block by block, instead of building
+# the dense N x N cosine_similarity matrix.
+
+SIMILARITY_THRESHOLD = 0.3
+
+
+def clean_data(x):
+    # Convert to lower case and strip names of spaces, ',' separates the tokens
+    if isinstance(x, str):
+        return x.replace(' ', '').lower().replace(',', ' ')
+    return ''
+
+
+def create_metadata(author, categories):
+    return clean_data(author) + ' ' + clean_data(', '.join(categories))
+
+
+def feature_matrix(metadata):
+    # Normalized CSR count matrix, one row per metadata string
+    from scipy import sparse
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.preprocessing import normalize
+
+    try:
+        count_matrix = CountVectorizer(stop_words='english').fit_transform(metadata)
+    except ValueError:
+        # Empty vocabulary (only stop words or no text at all): nothing is similar
+        return sparse.csr_matrix((len(metadata), 0))
+    return normalize(count_matrix, norm='l2', copy=False).tocsr()
+
+
+def similarity_rows(matrix, rows, threshold=SIMILARITY_THRESHOLD, block_size=512):
+    # Yield (row, columns, scores) with the scores above the threshold for each requested row
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        product = (matrix[block] @ matrix.T).tocsr()
+        for i, row in enumerate(block):
+            lo, hi = product.indptr[i], product.indptr[i + 1]
+            columns, scores = product.indices[lo:hi], product.data[lo:hi]
+            keep = scores > threshold
+            yield row, columns[keep], scores[keep]
+
+
+def top_k(scores, k, tiebreak):
+    # Positions of the k best scores, ordered by score (desc) then tiebreak (asc).
+    # np.partition finds the k-th best score so only the entries that can make it are sorted.
+    import numpy as np
+
+    n = len(scores)
+    if n > k:
+        kth = np.partition(scores, n - k)[n - k]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((tiebreak[candidates], -scores[candidates]))
+    return candidates[order[:k]]
+
+
+############################## Item-similarity index ##################################
+# Every book that has at least one copy gets its top-K most similar books stored in
+# BookSimilarity, so "more like this" becomes an index lookup instead of a full
+# catalog vectorization.
+# Updating it loads the whole catalog, which takes seconds on a large one, so a write
+# only queues its books (SimilarityUpdate) and "manage.py update_similarity_index",
+# run by cron or as a worker with --interval, applies the queue outside the requests.
+# Until then "more like this" shows the previous neighbours.
+# The migrations create the tables empty, "manage.py rebuild_similarity_index" fills them
+# after the deployment that adds them.
+
+def load_catalog():
+    # (book ids, feature matrix) for every book that has at least one copy
+    import numpy as np
+
+    authors = dict(Book.objects.filter(userbook__isnull=False)
+                   .values_list('id', 'author').distinct())
+    categories = defaultdict(set)
+    for book_id, category in Book.categories.through.objects.values_list('book_id', 'category__category'):
+        if book_id in authors:
+            categories[book_id].add(category)
+
+    book_ids = np.array(sorted(authors), dtype=np.int64)
+    metadata = [create_metadata(authors[book_id], categories[book_id]) for book_id in book_ids]
+    return book_ids, feature_matrix(metadata)
+
+
+def _index_size():
+    return settings.SIMILARITY_INDEX_SIZE
+
+
+def _rows(book_ids, matrix, rows):
+    size = _index_size()
+    neighbours = []
+    for row, columns, scores in similarity_rows(matrix, rows):
+        keep = columns != row
+        columns, scores = columns[keep], scores[keep]
+        # On equal scores the most recently added book comes first
+        for position in top_k(scores, size, -book_ids[columns]):
+            neighbours.append(BookSimilarity(book_id_id=int(book_ids[row]),
+                                             similar_book_id_id=int(book_ids[columns[position]]),
+                                             score=float(scores[position])))
+    return neighbours
+
+
+def rebuild_index():
+    book_ids, matrix = load_catalog()
+    rows = _rows(book_ids, matrix, list(range(len(book_ids))))
+    with transaction.atomic():
+        BookSimilarity.objects.all().delete()
+        BookSimilarity.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_index(changed):
+    # Recompute the rows of the changed books, of the books that currently list them
+    # as neighbours and of the books whose similarity to them is now above the threshold.
+    changed = set(changed)
+    book_ids, matrix = load_catalog()
+    positions = {int(book_id): row for row, book_id in enumerate(book_ids)}
+
+    affected = set(changed)
+    affected.update(BookSimilarity.objects.filter(
+        similar_book_id__in=changed).values_list('book_id', flat=True))
+    changed_rows = [positions[book_id] for book_id in changed if book_id in positions]
+    for row, columns, scores in similarity_rows(matrix, changed_rows):
+        affected.update(int(book_id) for book_id in book_ids[columns])
+
+    rows = _rows(book_ids, matrix, sorted(positions[book_id] for book_id in affected if book_id in positions))
+    with transaction.atomic():
+        BookSimilarity.objects.filter(book_id__in=affected).delete()
+        BookSimilarity.objects.bulk_create(rows, batch_size=1000)
+    return affected
+
+
+def apply_index_updates():
+    # Recompute the rows of the queued books, returns the books whose rows were recomputed
+    # (the neighbourhood that changed). A book queued meanwhile stays in the queue.
+    last = SimilarityUpdate.objects.aggregate(last=Max('id'))['last']
+    if last is None:
+        return set()
+    queued = SimilarityUpdate.objects.filter(id__lte=last)
+    affected = update_index(queued.values_list('book_id', flat=True))
+    queued.delete()
+    invalidate_neighbourhood(affected)
+    invalidate_index()
+    return affected
+
+
+_pending = threading.local()
+
+
+def schedule_index_update(book_ids):
+    # Run after the surrounding transaction commits so the indexes see the final state.
+    # The term index of the books is updated right away (the recommendations read it, and
+    # it only depends on these books), their rows of the similarity index are queued.
+    # The books scheduled in one transaction are handled together, by the first hook that
+    # runs (the others find nothing left); a view saving a book, its copy and its
+    # categories in one transaction updates the terms and queues the book once.
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    if not hasattr(_pending, 'book_ids'):
+        _pending.book_ids = set()
+    _pending.book_ids |= book_ids
+
+    def update():
+        pending, _pending.book_ids = _pending.book_ids, set()
+        if pending:
+            update_terms(pending)
+            SimilarityUpdate.objects.bulk_create([SimilarityUpdate(book_id=book_id) for book_id in pending])
+
+    transaction.on_commit(update)
+
+
+############################## Inverted term index ##################################
+# BookTerm maps every token of the features (author and categories, as tokenized by the
+# vectorizer) to the books that have it. Two books can only score above 0 if they share
+# a token, so the candidates of a seed book are the union of the postings of its tokens
+# and a request only vectorizes that neighbourhood instead of the whole catalog.
+# Tokens are used rather than category ids: the vectorizer splits and drops stop words,
+# different categories or an author and a category can share a token.
+# Like the similarity index it is filled by "manage.py rebuild_similarity_index" after the
+# deployment that adds the table.
+
+_analyzer = None
+
+
+def book_terms(author, categories):
+    global _analyzer
+    if _analyzer is None:
+        from sklearn.feature_extraction.text import CountVectorizer
+        _analyzer = CountVectorizer(stop_words='english').build_analyzer()
+    return set(_analyzer(create_metadata(author, categories)))
+
+
+def _term_rows(books):
+    categories = defaultdict(set)
+    for book_id, category in Book.categories.through.objects.filter(
+            book_id__in=books.values('id')).values_list('book_id', 'category__category'):
+        categories[book_id].add(category)
+    return [BookTerm(book_id_id=book_id, term=term)
+            for book_id, author in books.values_list('id', 'author')
+            for term in book_terms(author, categories[book_id])]
+
+
+def rebuild_terms():
+    rows = _term_rows(Book.objects.all())
+    with transaction.atomic():
+        BookTerm.objects.all().delete()
+        BookTerm.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_terms(book_ids):
+    book_ids = list(book_ids)
+    rows = _term_rows(Book.objects.filter(id__in=book_ids))
+    with transaction.atomic():
+        BookTerm.objects.filter(book_id__in=book_ids).delete()
+        BookTerm.objects.bulk_create(rows, batch_size=1000)
+
+
+def neighbourhood(book_ids):
+    # Subquery of the ids of the books sharing a term with one of these books (themselves included,
+    # a book without any term can't be similar to anything)
+    terms = BookTerm.objects.filter(book_id__in=book_ids).values('term')
+    return BookTerm.objects.filter(term__in=Subquery(terms)).values('book_id')
+
+
+def representative_copies(copies):
+    # One (book_id, latest) row per book among these copies, latest being the id of the copy that
+    # stands for the book: its newest available copy, or its newest one when they are all lent
+    return copies.values('book_id').annotate(latest=Coalesce(Max('id', filter=Q(status=True)), Max('id')))
+
+
+def recommendation_records(book_ids, image_prefix='http://127.0.0.1:8000/media/'):
+    # Build the recommender's output rows for these books, keeping the given order.
+    copy_ids = representative_copies(UserBook.objects.filter(book_id__in=book_ids)).values_list('latest', flat=True)
+    copies = {copy['book_id']: copy for copy in UserBook.objects.filter(id__in=list(copy_ids)).values(
+        'id', 'book_owner_id', 'book_id', 'book_id__book_name', 'book_id__author', 'book_image_url')}
+
+    categories = defaultdict(set)
+    for book_id, category in Book.categories.through.objects.filter(
+            book_id__in=book_ids).values_list('book_id', 'category__category'):
+        categories[book_id].add(category)
+
+    return [{
+        'user_book_id': copies[book_id]['id'],
+        'book_id': book_id,
+        'owner_id': copies[book_id]['book_owner_id'],
+        'book_name': copies[book_id]['book_id__book_name'],
+        'author': copies[book_id]['book_id__author'],
+        'categories__category': ', '.join(categories[book_id]),
+        'image_url': image_prefix + copies[book_id]['book_image_url'],
+    } for book_id in book_ids if book_id in copies]
+
+
+def similar_books(book_id, user_id, limit=10):
+    # Index lookup, then drop the books this user owns or has already rated
+    owned = UserBook.objects.filter(book_owner_id=user_id).values('book_id')
+    rated = BookRating.objects.filter(book_rater_id=user_id).values('book_id')
+    book_ids = list(BookSimilarity.objects.filter(book_id=book_id)
+                    .exclude(similar_book_id__in=owned)
+                    .exclude(similar_book_id__in=rated)
+                    .order_by('-score', '-similar_book_id')
+                    .values_list('similar_book_id', flat=True)[:limit])
+    return recommendation_records(book_ids)
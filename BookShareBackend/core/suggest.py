@@ -0,0 +1,185 @@
+import bisect
+import heapq
+import threading
+import unicodedata
+from collections import defaultdict
+
+from django.db import DatabaseError, transaction
+
+from .models import Book
+from .recommendation_cache import bump_shared_version, shared_version
+
+############################## Autocomplete index ##################################
+# /book-search/suggest/?q= answers from an index kept in the memory of every process
+# instead of querying the database at each keystroke. The words of the book names and
+# authors are kept in a sorted vocabulary (prefix lookups with bisect) and under their
+# variants with one letter deleted (a word one typo away from a word typed shares a
+# variant with it). A query matches the books having, for every word typed, a word equal
+# to it, starting with it (the last one, still being typed) or, for the words of at least
+# TYPO_LENGTH letters, one typo away from it (a letter inserted, deleted or replaced, two
+# letters swapped). The memory grows with the number of books and of distinct words, at
+# most WORDS_PER_BOOK words of at most WORD_LENGTH characters a book.
+# The index is built when the worker starts (wsgi.py/asgi.py) or on first use and patched
+# by the Book signals after commit. A change also bumps a version stamp kept in the database
+# (see recommendation_cache.shared_version), the other processes rebuild their index when
+# they see it change: they suggest the old books for SHARED_VERSION_INTERVAL seconds at most.
+
+VERSION_KEY = 'suggest-version'
+WORDS_PER_BOOK = 16
+WORD_LENGTH = 24
+# Words looked at for a prefix
+MAX_PREFIX_WORDS = 64
+# The shortest word typed that may have a typo
+TYPO_LENGTH = 4
+
+
+def normalize(text):
+    # Lower case, accents removed, only letters and digits
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return ''.join(c if c.isalnum() else ' ' for c in text)
+
+
+def words(text):
+    return [word[:WORD_LENGTH] for word in normalize(text).split()][:WORDS_PER_BOOK]
+
+
+def variants(word):
+    # The word and the word without each of its letters
+    return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def one_typo(a, b):
+    # b is a with one letter inserted, deleted, replaced, or two neighbour letters swapped
+    if len(a) > len(b):
+        a, b = b, a
+    start = 0
+    while start < len(a) and a[start] == b[start]:
+        start += 1
+    if len(a) < len(b):
+        return a[start:] == b[start + 1:]
+    if a[start + 1:] == b[start + 1:]:
+        return True
+    return a[start + 2:] == b[start + 2:] and a[start:start + 2] == b[start + 1] + b[start]
+
+
+class SuggestIndex:
+    def __init__(self):
+        self.books = {}                   # book id -> (book_name, author, words)
+        self.postings = defaultdict(set)  # word -> book ids
+        self.vocabulary = []              # the words, sorted
+        self.variants = defaultdict(list) # variant -> words (rarely more than one, a list is smaller)
+        self.version = None
+
+    def add(self, book_id, book_name, author):
+        book_words = tuple(set(words(book_name)) | set(words(author)))
+        self.books[book_id] = (book_name, author, book_words)
+        for word in book_words:
+            if not self.postings[word]:
+                bisect.insort(self.vocabulary, word)
+                for variant in variants(word):
+                    self.variants[variant].append(word)
+            self.postings[word].add(book_id)
+
+    def remove(self, book_id):
+        if book_id not in self.books:
+            return
+        for word in self.books.pop(book_id)[2]:
+            self.postings[word].discard(book_id)
+            if not self.postings[word]:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+                for variant in variants(word):
+                    self.variants[variant].remove(word)
+                    if not self.variants[variant]:
+                        del self.variants[variant]
+
+    def matches(self, word, prefix):
+        # {word of the index: quality} for a word typed
+        found = {}
+        if word in self.postings:
+            found[word] = 1.0
+        if prefix:
+            start = bisect.bisect_left(self.vocabulary, word)
+            for candidate in self.vocabulary[start:start + MAX_PREFIX_WORDS]:
+                if not candidate.startswith(word):
+                    break
+                found.setdefault(candidate, 0.9)
+        if len(word) >= TYPO_LENGTH:
+            for variant in variants(word):
+                for candidate in self.variants.get(variant, ()):
+                    if candidate not in found and one_typo(word, candidate):
+                        found[candidate] = 0.7
+        return found
+
+    def suggest(self, query, limit=10, exclude=()):
+        # [(book id, book_name, author)], the best matches first
+        typed = words(query)
+        if not typed:
+            return []
+        scores = None
+        for i, word in enumerate(typed):
+            word_scores = {}
+            for candidate, quality in self.matches(word, prefix=i == len(typed) - 1).items():
+                for book_id in self.postings[candidate]:
+                    if quality > word_scores.get(book_id, 0):
+                        word_scores[book_id] = quality
+            # every word typed must match
+            scores = word_scores if scores is None else {
+                book_id: score + word_scores[book_id] for book_id, score in scores.items() if book_id in word_scores}
+            if not scores:
+                return []
+
+        ranked = heapq.nsmallest(limit, (book_id for book_id in scores if book_id not in exclude),
+                                 key=lambda book_id: (-scores[book_id], len(self.books[book_id][0]), book_id))
+        return [(book_id, *self.books[book_id][:2]) for book_id in ranked]
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def build():
+    global _index
+    index = SuggestIndex()
+    # Read before the books, a change committed meanwhile makes the next request rebuild again
+    index.version = shared_version(VERSION_KEY)
+    for book_id, book_name, author in Book.objects.values_list('id', 'book_name', 'author').iterator():
+        index.add(book_id, book_name, author)
+    with _lock:
+        _index = index
+    return index
+
+
+def warm_up():
+    # At worker start, before the tables exist (e.g. "manage.py migrate" on an empty database) it is built on first use
+    try:
+        build()
+    except DatabaseError:
+        pass
+
+
+def suggest(query, limit=10, exclude=()):
+    index = _index
+    if index is None or index.version != shared_version(VERSION_KEY):
+        index = build()
+    with _lock:
+        return index.suggest(query, limit, exclude)
+
+
+def book_changed(book_id, book):
+    # book is (book_name, author), None when it was deleted.
+    # Patch this process' index after commit, tell the others to rebuild theirs
+    def patch():
+        with _lock:
+            if _index is not None:
+                _index.remove(book_id)
+                if book:
+                    _index.add(book_id, *book)
+                # Still up to date, unless another process changed a book since it was built
+                version = bump_shared_version(VERSION_KEY, previous=_index.version)
+                if version is not None:
+                    _index.version = version
+                    return
+        bump_shared_version(VERSION_KEY)
+
+    transaction.on_commit(patch)
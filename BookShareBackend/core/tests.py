@@ -1,3 +1,1512 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+import asyncio
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import borrowing, collaborative, push, recommendation_cache, retention, serializers, unread, urls, views
+from .benchmark import generate_catalog, hold_out_ratings, precision_at_k
+from user_app.models import User
+from .models import (Book, BookRating, BookRatingBucket, BookSimilarity, BookTerm, Category, Notification,
+                     Recommendation, SimilarityUpdate, UserBook, UserRating)
+from .isbn import normalize_isbn, parse_isbn, to_isbn13
+from .precompute import target_users
+from .query_budget import QueryBudgetExceeded, view_budget
+from .ratings import stale_aggregates, stale_buckets
+from .recommender import get_recommendations, get_recommendations_for_books, load_books, top_rated
+from .similarity import apply_index_updates, rebuild_index, rebuild_terms, recommendation_records
+from . import suggest
+
+
+def reference_recommendations(id, user_id):
+    # version 1.0 of get_recommendations (dense cosine_similarity over the copies),
+    # with a stable sort so that equal scores keep a deterministic order
+    import pandas as pd
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    from .similarity import create_metadata
+
+    data = pd.DataFrame.from_records(UserBook.objects.order_by('id').values(
+        'id', 'book_owner_id', 'book_id', 'book_id__author'))
+    categories = {}
+    for book_id, category in Book.categories.through.objects.values_list('book_id', 'category__category'):
+        categories.setdefault(book_id, set()).add(category)
+    metadata = [create_metadata(row.book_id__author, categories.get(row.book_id, ()))
+                for row in data.itertuples()]
+    cosine_sim = cosine_similarity(*[CountVectorizer(stop_words='english').fit_transform(metadata)] * 2)
+
+    index = data.index[data['id'] == id][0]
+    similarity_series = pd.Series(cosine_sim[index]).sort_values(ascending=False, kind='stable')
+    recommended = data.iloc[similarity_series[similarity_series > 0.3].index.tolist()]
+
+    rated_books = BookRating.objects.filter(book_rater_id=user_id).values_list('book_id', flat=True)
+    owned_books = data.loc[data['book_owner_id'] == user_id, 'book_id']
+    recommended = recommended[(recommended['book_id'] != data.loc[index, 'book_id'])
+                              & ~recommended['book_id'].isin(owned_books)
+                              & ~recommended['book_id'].isin(rated_books)]
+    recommended = recommended.drop_duplicates(['book_id'], keep='last')[:10]
+    return recommended['id'].tolist()
+
+
+def reference_top_rated():
+    # version 1.0 of top_rated, (book id, score) of the chart
+    import pandas as pd
+    from django.db.models import Avg, Count
+
+    books = pd.DataFrame.from_records(Book.objects.annotate(
+        average=Avg('bookrating__book_rating'), num_ratings=Count('bookrating')).values('id', 'average', 'num_ratings'))
+    C = books['average'].mean()
+    m = books['num_ratings'].quantile(0.9)
+    q_books = books.loc[(books['num_ratings'] >= m) & books['average'].notna()
+                        & books['id'].isin(list(UserBook.objects.values_list('book_id', flat=True)))].copy()
+    q_books['score'] = q_books['num_ratings'] / (q_books['num_ratings'] + m) * q_books['average'] \
+        + m / (m + q_books['num_ratings']) * C
+    q_books = q_books.sort_values(['score', 'id'], ascending=[False, True])[:10]
+    return list(zip(q_books['id'], q_books['score']))
+
+
+class RecommenderTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = generate_catalog(copies=300, books=60, users=15, categories=8, seed=1)
+        cls.users = cls.catalog['users']
+
+    def test_get_recommendations_matches_dense_reference(self):
+        for user in self.users[:5]:
+            for user_book in UserBook.objects.order_by('id')[:20]:
+                recommended = [row['user_book_id'] for row in get_recommendations(user_book.id, user.id)]
+                self.assertEqual(recommended, reference_recommendations(user_book.id, user.id))
+
+    def test_multi_seed_matches_one_call_per_seed(self):
+        for user in self.users[:5]:
+            seeds = list(BookRating.objects.filter(
+                book_rater_id=user, book_rating__gt=6).values_list('book_id', flat=True)[:5])
+            expected = []
+            for book_id in seeds:
+                user_book = UserBook.objects.filter(book_id=book_id).first()
+                if user_book:
+                    for row in get_recommendations(user_book.id, user.id)[:2]:
+                        if row['book_id'] not in [book['book_id'] for book in expected]:
+                            expected.append(row)
+            self.assertEqual(get_recommendations_for_books(seeds, user.id), expected)
+
+    def test_representative_copy_is_available(self):
+        # the newest copy stands for its book, unless it is lent and an older one isn't
+        book_id = UserBook.objects.values('book_id').annotate(copies=Count('id')).filter(
+            copies__gt=1).values_list('book_id', flat=True)[0]
+        newest, older = UserBook.objects.filter(book_id=book_id).order_by('-id')[:2]
+
+        def representative():
+            return (load_books(None, books=[book_id])['copies'][0][0],
+                    recommendation_records([book_id])[0]['user_book_id'])
+
+        self.assertEqual(representative(), (newest.id, newest.id))
+        UserBook.objects.filter(id=newest.id).update(status=False)
+        self.assertEqual(representative(), (older.id, older.id))
+        # all of them lent
+        UserBook.objects.filter(book_id=book_id).update(status=False)
+        self.assertEqual(representative(), (newest.id, newest.id))
+
+    def test_top_rated_matches_reference(self):
+        chart = top_rated()
+        self.assertEqual([row['id'] for row in chart], [book_id for book_id, _ in reference_top_rated()])
+        for row, (_, score) in zip(chart, reference_top_rated()):
+            self.assertAlmostEqual(row['score'], score)
+            copy = UserBook.objects.filter(book_id=row['id']).first()
+            self.assertEqual((row['user_book_id'], row['image_url']),
+                             (copy.id, 'http://127.0.0.1:8000' + copy.book_image_url.url))
+
+    def test_top_rated_is_served_from_a_snapshot(self):
+        caches['recommendations'].clear()
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        self.assertEqual(client.get('/top-rated/').data, top_rated())
+        with self.assertNumQueries(0):
+            client.get('/top-rated/')
+
+    def test_incremental_index_matches_rebuild(self):
+        # the signals queue the books once the changes are committed, the queue is applied later
+        rebuild_index()
+        before = sorted(BookSimilarity.objects.values_list('book_id', 'similar_book_id'))
+        with self.captureOnCommitCallbacks(execute=True):
+            book = Book.objects.filter(userbook__isnull=False).first()
+            book.categories.set(Book.objects.exclude(id=book.id).first().categories.all())
+            book.author = 'Synthetic Author 0'
+            book.save()
+            UserBook.objects.filter(book_id=Book.objects.filter(userbook__isnull=False).last()).delete()
+            deleted = Book.objects.filter(userbook__isnull=False).distinct().order_by('id')[1].id
+            Book.objects.get(id=deleted).delete()
+        self.assertEqual(sorted(BookSimilarity.objects.values_list('book_id', 'similar_book_id')),
+                         [row for row in before if deleted not in row])
+        self.assertTrue(SimilarityUpdate.objects.exists())
+
+        self.assertIn(book.id, apply_index_updates())
+        self.assertFalse(SimilarityUpdate.objects.exists())
+        self.assertEqual(apply_index_updates(), set())
+        incremental = sorted(BookSimilarity.objects.values_list('book_id', 'similar_book_id'))
+        rebuild_index()
+        self.assertEqual(incremental, sorted(BookSimilarity.objects.values_list('book_id', 'similar_book_id')))
+
+        terms = sorted(BookTerm.objects.values_list('book_id', 'term'))
+        rebuild_terms()
+        self.assertEqual(terms, sorted(BookTerm.objects.values_list('book_id', 'term')))
+
+    def test_more_like_this_skips_owned_and_rated_books(self):
+        rebuild_index()
+        user = self.users[0]
+        client = APIClient()
+        client.force_authenticate(user)
+        excluded = set(UserBook.objects.filter(book_owner_id=user).values_list('book_id', flat=True))
+        excluded |= set(BookRating.objects.filter(book_rater_id=user).values_list('book_id', flat=True))
+
+        for user_book in UserBook.objects.order_by('id')[:20]:
+            response = client.get(f'/book/{user_book.id}/more-like/')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse({row['book_id'] for row in response.data} & excluded)
+
+        self.assertEqual(client.get('/book/0/more-like/').status_code, 404)
+
+    @override_settings(SHARED_VERSION_INTERVAL=3600)
+    def test_more_like_this_follows_the_index(self):
+        rebuild_index()
+        caches['recommendations'].clear()
+        user = self.users[0]
+        client = APIClient()
+        client.force_authenticate(user)
+        user_book = UserBook.objects.exclude(book_owner_id=user).order_by('id').first()
+        before = client.get(f'/book/{user_book.id}/more-like/').data
+        self.assertTrue(before)
+
+        # a new book like this one, shown once the queue is applied
+        book = Book.objects.create(book_name='Another One', author=user_book.book_id.author)
+        book.categories.set(user_book.book_id.categories.all())
+        with self.captureOnCommitCallbacks(execute=True):
+            UserBook.objects.create(book_owner_id=self.users[1], book_id=book)
+        self.assertEqual(client.get(f'/book/{user_book.id}/more-like/').data, before)
+        # applied by the command, in another process: neither its cache nor its stamps are ours
+        with mock.patch.object(recommendation_cache, '_cache', return_value=LocMemCache('command', {})), \
+                mock.patch.dict(recommendation_cache._stamps), self.captureOnCommitCallbacks(execute=True):
+            apply_index_updates()
+        # seen once the stamp is read again
+        self.assertEqual(client.get(f'/book/{user_book.id}/more-like/').data, before)
+        with self.settings(SHARED_VERSION_INTERVAL=0):
+            after = client.get(f'/book/{user_book.id}/more-like/').data
+        self.assertEqual(after[0]['book_id'], book.id)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_generate_catalog(self):
+        catalog = generate_catalog(copies=200, books=50, users=10, seed=2)
+        self.assertEqual(UserBook.objects.count(), 200)
+        self.assertEqual(Book.objects.count(), 50)
+        self.assertEqual(len(catalog['users']), 10)
+        self.assertEqual(BookRating.objects.count(), catalog['ratings'])
+
+    def test_hold_out_keeps_one_high_rating(self):
+        catalog = generate_catalog(copies=200, books=50, users=10, seed=2)
+        held_out = hold_out_ratings(catalog['users'], fraction=0.5, seed=2)
+        self.assertTrue(held_out)
+        for user_id, book_ids in held_out.items():
+            remaining = BookRating.objects.filter(book_rater_id=user_id, book_rating__gt=6)
+            self.assertTrue(remaining.exists())
+            self.assertFalse(remaining.filter(book_id__in=book_ids).exists())
+
+    def test_precision_at_k(self):
+        recommended = {1: [1, 2, 3, 4], 2: [5]}
+        relevant = {1: {2, 4, 9}, 2: {6}}
+        self.assertAlmostEqual(precision_at_k(recommended, relevant, k=4), (2 / 4 + 0) / 2)
+        self.assertEqual(precision_at_k(recommended, {}), 0.0)
+
+    def test_benchmark_command_rolls_back(self):
+        out = StringIO()
+        call_command('benchmark_recommender', copies=[200], repeat=1, eval_users=5, stdout=out)
+        self.assertIn('precision@10', out.getvalue())
+        self.assertFalse(UserBook.objects.exists())
+
+
+class RecommendationCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=300, books=60, users=15, categories=8, seed=5)['users']
+        rebuild_index()
+
+    def setUp(self):
+        caches['recommendations'].clear()
+        self.user = self.users[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, path):
+        # the seeds of the content-based list are sampled
+        random.seed(0)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        return response.data
+
+    def test_recommended_for_you(self):
+        data = self.get('/recommended-for-you/')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get('/recommended-for-you/'), data)
+
+        # lending a copy changes no recommendation
+        copy = UserBook.objects.exclude(book_owner_id=self.user).filter(book_id=data[0]['book_id']).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.status = False
+            copy.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get('/recommended-for-you/'), data)
+
+        # a rated book is not recommended anymore
+        with self.captureOnCommitCallbacks(execute=True):
+            BookRating.objects.create(book_id_id=data[0]['book_id'], book_rater_id=self.user, book_rating=3)
+        self.assertNotIn(data[0]['book_id'], [row['book_id'] for row in self.get('/recommended-for-you/')])
+
+    def test_more_like_this(self):
+        user_book = UserBook.objects.exclude(book_owner_id=self.user).order_by('id').first()
+        path = f'/book/{user_book.id}/more-like/'
+        data = self.get(path)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(path), data)
+
+        # nor an owned one
+        with self.captureOnCommitCallbacks(execute=True):
+            UserBook.objects.create(book_owner_id=self.user, book_id_id=data[0]['book_id'])
+        self.assertNotIn(data[0]['book_id'], [row['book_id'] for row in self.get(path)])
+
+
+class CollaborativeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalog = generate_catalog(copies=300, books=60, users=15, categories=8, seed=4)
+        cls.users = cls.catalog['users']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(RECOMMENDER_MODEL_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        caches['recommendations'].clear()
+
+    def test_train_save_and_load(self):
+        self.assertIsNone(collaborative.load_model())
+        model = collaborative.train(factors=4, iterations=3)
+        self.assertEqual(set(model['user_ids']), set(BookRating.objects.values_list('book_rater_id', flat=True)))
+        self.assertEqual(model['user_factors'].shape, (len(model['user_ids']), 4))
+        self.assertEqual(model['book_factors'].shape, (len(model['book_ids']), 4))
+        self.assertEqual(int(model['user_ratings'].sum()), BookRating.objects.count())
+
+        collaborative.save(model)
+        loaded = collaborative.load_model()
+        for name in ('user_ids', 'book_ids', 'user_factors', 'book_factors', 'user_ratings'):
+            self.assertTrue((loaded[name] == model[name]).all(), name)
+        # complete once loaded, the requests only read it
+        self.assertEqual(loaded['user_rows'], model['user_rows'])
+        names = set(loaded)
+        collaborative.recommend(int(loaded['user_ids'][0]))
+        self.assertEqual(set(loaded), names)
+        self.assertEqual(loaded['version'], collaborative.model_version())
+        # the same seed gives the same model
+        self.assertTrue((collaborative.train(factors=4, iterations=3)['user_factors'] == model['user_factors']).all())
+
+    def test_no_ratings(self):
+        BookRating.objects.all().delete()
+        self.assertIsNone(collaborative.train())
+        call_command('train_recommender', stdout=StringIO())
+        self.assertIsNone(collaborative.model_version())
+
+    def test_recommend(self):
+        model = collaborative.train(factors=4, iterations=3)
+        for user in self.users:
+            data = collaborative.recommend(user.id, model=model)
+            self.assertTrue(data)
+            excluded = set(UserBook.objects.filter(book_owner_id=user).values_list('book_id', flat=True))
+            excluded |= set(BookRating.objects.filter(book_rater_id=user).values_list('book_id', flat=True))
+            self.assertFalse({row['book_id'] for row in data} & excluded)
+            # a copy someone else owns
+            for row in data:
+                self.assertNotEqual(row['owner_id'], user.id)
+        rated = model['user_ratings'][0]
+        self.assertIsNone(collaborative.recommend(int(model['user_ids'][0]), model=model, min_ratings=rated + 1))
+        self.assertTrue(collaborative.recommend(int(model['user_ids'][0]), model=model, min_ratings=rated))
+        # unknown to the model
+        newcomer = User.objects.create_user('newcomer@example.com', 'New', 'Comer')
+        self.assertIsNone(collaborative.recommend(newcomer.id, model=model))
+        self.assertIsNone(collaborative.recommend(self.users[0].id))
+
+    def test_recommended_for_you_gate(self):
+        call_command('train_recommender', '--factors=4', '--iterations=3', stdout=StringIO())
+        model = collaborative.load_model()
+        user = self.users[0]
+        rated = int(model['user_ratings'][list(model['user_ids']).index(user.id)])
+        collaborative_list = collaborative.recommend(user.id)
+
+        def recommended(min_ratings):
+            caches['recommendations'].clear()
+            # the seeds of the content-based list are sampled
+            random.seed(0)
+            client = APIClient()
+            client.force_authenticate(user)
+            with self.settings(COLLABORATIVE_MIN_RATINGS=min_ratings):
+                return client.get('/recommended-for-you/').data
+
+        content_based = recommended(None)
+        self.assertNotEqual(content_based, collaborative_list)
+        self.assertEqual(recommended(rated), collaborative_list)
+        self.assertEqual(recommended(rated + 1), content_based)
+
+
+class PrecomputeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=300, books=60, users=15, categories=8, seed=3)['users']
+        call_command('precompute_recommendations', workers=1, stdout=StringIO())
+
+    def test_precomputed_list_is_served(self):
+        user = Recommendation.objects.first().user_id
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get('/recommended-for-you/')
+        self.assertEqual(response.status_code, 200)
+
+        stored = list(Recommendation.objects.filter(user_id=user).values_list('book_id', flat=True))
+        self.assertEqual([row['book_id'] for row in response.data], stored)
+        excluded = set(UserBook.objects.filter(book_owner_id=user).values_list('book_id', flat=True))
+        excluded |= set(BookRating.objects.filter(book_rater_id=user).values_list('book_id', flat=True))
+        self.assertFalse(set(stored) & excluded)
+
+    def test_same_data_same_lists(self):
+        def stored():
+            return list(Recommendation.objects.order_by('user_id', 'rank').values_list('user_id', 'book_id'))
+        before = stored()
+        self.assertTrue(before)
+        call_command('precompute_recommendations', workers=1, stdout=StringIO())
+        self.assertEqual(stored(), before)
+
+    def test_incremental_only_recomputes_changed_users(self):
+        self.assertEqual(target_users(incremental=True), [])
+        user = self.users[0]
+        book = Book.objects.exclude(bookrating__book_rater_id=user).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            BookRating.objects.create(book_id=book, book_rater_id=user, book_rating=9)
+        self.assertEqual(target_users(incremental=True), [user.id])
+
+        call_command('precompute_recommendations', incremental=True, workers=1, stdout=StringIO())
+        self.assertEqual(target_users(incremental=True), [])
+        self.assertFalse(Recommendation.objects.filter(user_id=user, book_id=book).exists())
+
+
+class RatingAggregateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=100, books=30, users=10, seed=4)['users']
+
+    def assertAggregatesMatch(self):
+        self.assertEqual(stale_aggregates(Book, BookRating.objects.all(), 'book_id', 'book_rating'), [])
+        self.assertEqual(stale_aggregates(User, UserRating.objects.all(), 'user_rated_id', 'user_rating'), [])
+
+    def test_generated_catalog_is_consistent(self):
+        self.assertAggregatesMatch()
+
+    def test_rating_views_update_the_aggregates(self):
+        user = self.users[0]
+        user_book = UserBook.objects.exclude(book_id__bookrating__book_rater_id=user).first()
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post(f'/book/{user_book.id}/create-rating/', {'rating': 10})
+        self.assertEqual(response.status_code, 201)
+        book = Book.objects.get(pk=user_book.book_id_id)
+        self.assertEqual(response.data['number_rating'], book.calculate_number_rating())
+        self.assertEqual(response.data['avg_rating'], book.calculate_avg_rating())
+        self.assertAggregatesMatch()
+
+        response = client.post(f'/book/{user_book.id}/create-rating/', {'rating': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['number_rating'], book.calculate_number_rating())
+        self.assertAggregatesMatch()
+
+        BookRating.objects.filter(book_rater_id=user).delete()
+        self.users[1].delete()
+        self.assertAggregatesMatch()
+
+    def test_user_rating_views_update_the_aggregates(self):
+        rater, rated = self.users[0], self.users[1]
+        client = APIClient()
+        client.force_authenticate(rater)
+
+        response = client.post(f'/library/{rated.id}/create-rating/', {'rating': 8})
+        self.assertEqual(response.status_code, 201)
+        UserRating.objects.create(user_rated_id=rated, user_rater_id=self.users[2], user_rating=3)
+        response = client.post(f'/library/{rated.id}/create-rating/', {'rating': 6})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['avg_rating'], response.data['number_rating']), (4.5, 2))
+
+        with self.assertNumQueries(1):
+            response = client.get(f'/library/{rated.id}/get-rating/')
+        self.assertEqual((response.data['avg_rating'], response.data['number_rating']), (4.5, 2))
+        self.assertAggregatesMatch()
+
+        self.users[2].delete()
+        self.assertAggregatesMatch()
+
+    def test_check_command_reports_out_of_date_rows(self):
+        call_command('repair_ratings', check=True, stdout=StringIO())
+        User.objects.filter(pk=self.users[0].pk).update(rating_count=5)
+        with self.assertRaises(CommandError):
+            call_command('repair_ratings', check=True, stdout=StringIO())
+
+    def test_repair_command(self):
+        Book.objects.update(rating_sum=0, rating_count=0, avg_rating=0)
+        out = StringIO()
+        call_command('repair_ratings', stdout=out)
+        self.assertIn(f'{Book.objects.filter(bookrating__isnull=False).distinct().count()} books', out.getvalue())
+        self.assertAggregatesMatch()
+
+
+def reference_chart(category=None, days=None):
+    # (book id, score) of a top rated chart, from the ratings themselves
+    import numpy as np
+
+    books = Book.objects.filter(categories=category) if category else Book.objects.all()
+    ratings = BookRating.objects.filter(book_id__in=books)
+    if days:
+        ratings = ratings.filter(created_at__date__gte=timezone.localdate() - timedelta(days=days - 1))
+    by_book = {book_id: [] for book_id in books.values_list('id', flat=True)}
+    for book_id, rating in ratings.values_list('book_id', 'book_rating'):
+        by_book[book_id].append(rating)
+
+    counts = np.array([len(values) for values in by_book.values()])
+    C = np.mean([np.mean(values) for values in by_book.values() if values])
+    m = np.quantile(counts, 0.9)
+    available = set(UserBook.objects.values_list('book_id', flat=True))
+    chart = [(book_id, len(values) / (len(values) + m) * np.mean(values) + m / (len(values) + m) * C)
+             for book_id, values in by_book.items() if values and len(values) >= m and book_id in available]
+    return sorted(chart, key=lambda row: (-row[1], row[0]))[:10]
+
+
+class LeaderboardTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=300, books=60, users=30, categories=5, seed=5)['users']
+        # a third of the ratings were made two months ago
+        old = list(BookRating.objects.values_list('id', flat=True)[::3])
+        BookRating.objects.filter(id__in=old).update(created_at=timezone.now() - timedelta(days=60))
+        call_command('repair_ratings', stdout=StringIO())
+        cls.category = Category.objects.first()
+
+    def assertChartsMatch(self, category=None, days=None):
+        chart = top_rated(category=category, days=days)
+        reference = reference_chart(category, days)
+        self.assertEqual([row['id'] for row in chart], [book_id for book_id, _ in reference])
+        for row, (_, score) in zip(chart, reference):
+            self.assertAlmostEqual(row['score'], score)
+
+    def test_charts_match_the_ratings(self):
+        self.assertChartsMatch()
+        self.assertChartsMatch(days=30)
+        self.assertChartsMatch(days=90)
+        self.assertChartsMatch(self.category.id)
+        self.assertChartsMatch(self.category.id, 30)
+
+    def test_buckets_follow_the_rating_views(self):
+        user = self.users[0]
+        user_book = UserBook.objects.exclude(book_id__bookrating__book_rater_id=user).first()
+        client = APIClient()
+        client.force_authenticate(user)
+        client.post(f'/book/{user_book.id}/create-rating/', {'rating': 10})
+        client.post(f'/book/{user_book.id}/create-rating/', {'rating': 2})
+        BookRating.objects.filter(id__in=BookRating.objects.values('id')[:5]).delete()
+        self.assertEqual(stale_buckets(BookRatingBucket, BookRating.objects.all()), [])
+        self.assertChartsMatch(days=30)
+
+    def test_top_rated_parameters(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        response = client.get(f'/top-rated/?category={self.category.id}&window=30d')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, top_rated(category=self.category.id, days=30))
+
+        self.assertEqual(client.get('/top-rated/?window=month').status_code, 400)
+        self.assertEqual(client.get('/top-rated/?window=0d').status_code, 400)
+        self.assertEqual(client.get('/top-rated/?category=0').status_code, 404)
+
+
+class ListQueryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=120, books=30, users=6, seed=6)['users']
+        # some of the copies are lent
+        for user_book in UserBook.objects.all()[::4]:
+            user_book.status, user_book.borrowed_by = False, cls.users[-1]
+            user_book.save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def assertQueryBudget(self, path, queries):
+        # The budget doesn't depend on the number of rows
+        with self.assertNumQueries(queries):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_book_lists(self):
+        owner = self.users[1]
+        self.assertEqual(len(self.assertQueryBudget('/list/?page_size=50', 2).data['results']), 50)
+        self.assertQueryBudget('/list/?status=false&ordering=created_at', 2)
+        self.assertQueryBudget('/your-library/', 2)
+        self.assertQueryBudget(f'/library/{owner.id}/', 2)
+        self.assertQueryBudget(f'/library/{owner.id}/?search=Synthetic', 2)
+        self.assertQueryBudget('/book-search/?search=Synthetic', 2)
+
+    def test_book_pages(self):
+        user_book = UserBook.objects.filter(book_id__in=UserBook.objects.values('book_id').annotate(
+            copies=Count('id')).filter(copies__gt=2).values('book_id')).exclude(book_owner_id=self.users[0]).first()
+        self.assertQueryBudget(f'/book/{user_book.id}/', 2)
+        self.assertTrue(self.assertQueryBudget(f'/book/{user_book.id}/same-book/', 3).data)
+
+    def test_lists_are_unchanged(self):
+        # Same payload as the serializers loading every relation lazily
+        response = self.client.get('/your-library/?page_size=100')
+        expected = serializers.YourBooksSerializer(
+            UserBook.objects.filter(book_owner_id=self.users[0]).order_by('-created_at', '-id'), many=True,
+            context={'request': response.wsgi_request}).data
+        self.assertEqual(response.data['results'], expected)
+        response = self.client.get('/list/?page_size=100')
+        expected = serializers.UserBookSerializer(
+            UserBook.objects.exclude(book_owner_id=self.users[0]).order_by('-created_at', '-id')[:100], many=True,
+            context={'request': response.wsgi_request}).data
+        self.assertEqual(response.data['results'], expected)
+
+
+class PaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=150, books=40, users=6, seed=8)['users']
+        # copies added at the same time, the id decides
+        now = timezone.now()
+        for i, ids in enumerate([UserBook.objects.values_list('id', flat=True)[start:start + 10]
+                                 for start in range(0, 150, 10)]):
+            UserBook.objects.filter(id__in=list(ids)).update(created_at=now - timedelta(minutes=i % 4))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def walk(self, url, direction='next'):
+        # The ids of every page, following the links
+        pages = []
+        while url:
+            data = self.client.get(url).data
+            pages.append([row['id'] for row in data['results']])
+            url = data[direction]
+        return pages
+
+    def test_pages_cover_the_list_once(self):
+        expected = list(UserBook.objects.exclude(book_owner_id=self.users[0]).order_by(
+            '-created_at', '-id').values_list('id', flat=True))
+        pages = self.walk('/list/?page_size=7')
+        self.assertTrue(all(len(page) == 7 for page in pages[:-1]))
+        self.assertEqual(sum(pages, []), expected)
+
+        # and back, from the last page
+        last = self.client.get('/list/?page_size=7').data
+        while last['next']:
+            url, last = last['next'], self.client.get(last['next']).data
+        self.assertEqual(self.walk(url, 'previous'), pages[::-1])
+
+    def test_ordering_and_filters(self):
+        expected = list(UserBook.objects.filter(book_owner_id=self.users[1], status=True).order_by(
+            'created_at', 'id').values_list('id', flat=True))
+        pages = self.walk(f'/library/{self.users[1].id}/?page_size=3&status=true&ordering=created_at')
+        self.assertEqual(sum(pages, []), expected)
+
+        expected = list(Book.objects.exclude(owners=self.users[0]).filter(
+            book_name__contains='Synthetic').order_by('id').values_list('id', flat=True))
+        self.assertEqual(sum(self.walk('/book-search/?search=Synthetic&page_size=6'), []), expected)
+
+    def test_inserts_do_not_shift_the_pages(self):
+        first = self.client.get('/list/?page_size=10').data
+        seen = [row['id'] for row in first['results']]
+        # a copy added while the client scrolls comes before the position it holds
+        book = Book.objects.exclude(owners=self.users[1]).first()
+        UserBook.objects.create(book_owner_id=self.users[1], book_id=book)
+        second = self.client.get(first['next']).data
+        expected = list(UserBook.objects.exclude(book_owner_id=self.users[0]).order_by(
+            '-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen + [row['id'] for row in second['results']], expected[1:21])
+
+    def test_deep_pages_cost_the_same(self):
+        url = '/list/?page_size=5'
+        for _ in range(10):
+            with self.assertNumQueries(2):
+                url = self.client.get(url).data['next']
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/list/?cursor=nonsense').status_code, 404)
+        self.assertEqual(self.client.get('/notifications/').data, {'next': None, 'previous': None, 'results': []})
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class RouteBudgetTests(TransactionTestCase):
+    # Every route of core/urls.py, QueryBudgetMiddleware raises when one runs over its budget.
+    # Not wrapped in a transaction, so the on_commit hooks of the writes run in the request
+
+    def setUp(self):
+        caches['recommendations'].clear()
+        self.owner, self.visitor = generate_catalog(copies=120, books=30, users=6, seed=7)['users'][:2]
+        self.user_book = UserBook.objects.filter(book_owner_id=self.owner).exclude(
+            book_id__in=UserBook.objects.filter(book_owner_id=self.visitor).values('book_id')).exclude(
+            book_id__bookrating__book_rater_id=self.visitor).first()
+        self.category = Category.objects.first()
+        self.tokens = {user.id: Token.objects.create(user=user).key for user in (self.owner, self.visitor)}
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.tokens[user.id]}')
+        return client
+
+    def request(self, client, method, path, data=None, status_code=200, format=None):
+        response = getattr(client, method)(path, data, format=format)
+        self.assertEqual(response.status_code, status_code, path)
+        return response
+
+    def test_every_route_declares_a_budget(self):
+        for pattern in urls.urlpatterns:
+            self.assertIsNotNone(view_budget(pattern.callback), pattern.name)
+
+    def test_writes_independent_of_the_catalog(self):
+        # The similarity index is updated outside the requests (see core/similarity.py),
+        # a write costs the same on a bigger catalog
+        owner = self.client_for(self.owner)
+
+        def queries(method, path, data=None, status_code=200):
+            response = self.request(owner, method, path, data, status_code, format='multipart')
+            return int(re.search(r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+        def writes():
+            edit = {'book_id': self.user_book.book_id_id, 'book_name': 'Edited Book', 'author': 'New Author',
+                    'categories': f'{self.category.id}'}
+            copy = UserBook.objects.filter(book_owner_id=self.owner).exclude(id=self.user_book.id).first()
+            return queries('post', '/add-edit/', edit), queries('delete', f'/your-library/{copy.id}/', None, 204)
+
+        writes()
+        small = writes()
+        generate_catalog(copies=1200, books=300, users=30, seed=8)
+        rebuild_index()
+        self.assertEqual(writes(), small)
+
+    def test_over_budget(self):
+        client = self.client_for(self.visitor)
+        with mock.patch.object(views.BookUserList, 'query_budget', 1):
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get('/list/')
+            # Only logged outside of the tests
+            with self.settings(QUERY_BUDGET_STRICT=False, DEBUG=True), self.assertLogs('core.query_budget', 'WARNING'):
+                response = client.get('/list/')
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+
+    def test_read_routes(self):
+        client = self.client_for(self.visitor)
+        user_book, owner = self.user_book, self.owner
+        for path in ['/list/', '/list/?search=Synthetic&ordering=created_at', '/recommended-for-you/',
+                     '/recommended-for-you/', '/top-rated/', f'/top-rated/?category={self.category.id}&window=30d',
+                     '/book-search/?search=Synthetic', '/book-search/suggest/?q=synth', '/list/facets/?status=true',
+                     '/notifications/poll/?timeout=0', '/notifications/count/',
+                     '/book-search/?isbn=978-0-306-40615-7', f'/book-general/{user_book.book_id_id}/', '/categories/',
+                     '/your-library/', f'/library/{owner.id}/', f'/library/{owner.id}/get-rating/',
+                     f'/book/{user_book.id}/', f'/book/{user_book.id}/get-rating/',
+                     f'/book/{user_book.id}/same-book/', f'/book/{user_book.id}/more-like/', '/notifications/']:
+            self.request(client, 'get', path)
+
+    def test_write_routes(self):
+        visitor, owner, user_book = self.client_for(self.visitor), self.client_for(self.owner), self.user_book
+        self.request(visitor, 'post', f'/library/{self.owner.id}/create-rating/', {'rating': 8}, 201)
+        self.request(visitor, 'post', f'/library/{self.owner.id}/create-rating/', {'rating': 6})
+        self.request(visitor, 'post', f'/book/{user_book.id}/create-rating/', {'rating': 9}, 201)
+        self.request(visitor, 'post', f'/book/{user_book.id}/create-rating/', {'rating': 3})
+
+        self.request(visitor, 'post', '/add-new/', {
+            'book_name': 'New Book', 'author': 'New Author', 'categories': f'{self.category.id}', 'rating': 7},
+            201, format='multipart')
+        self.request(visitor, 'post', '/add-edit/', {
+            'book_id': user_book.book_id_id, 'book_name': 'Edited Book', 'author': 'New Author',
+            'categories': f'{self.category.id}', 'rating': 5}, format='multipart')
+        copy = UserBook.objects.get(book_owner_id=self.visitor, book_id=user_book.book_id)
+        self.request(visitor, 'post', '/add-edit/', {
+            'book_id': user_book.book_id_id, 'book_name': 'Edited Book', 'author': 'New Author',
+            'categories': f'{self.category.id}', 'del_image': 'true'}, format='multipart')
+
+        self.request(visitor, 'post', '/create-notification/',
+                     {'user_book_id': user_book.id, 'type': 'borrow_request'}, 201)
+        notification = Notification.objects.get(receiver_id=self.owner)
+        self.request(owner, 'post', '/create-notification/', {
+            'user_book_id': user_book.id, 'receiver_id': self.visitor.id, 'type': 'accept',
+            'message': 'call me', 'notification_id': notification.id}, 201)
+        self.request(owner, 'patch', f'/your-library/{user_book.id}/', {'status': True}, format='json')
+        notification = Notification.objects.get(receiver_id=self.visitor)
+        self.request(visitor, 'post', '/notifications/read/', {'ids': [notification.id]}, format='json')
+        self.request(visitor, 'delete', f'/notification-delete/{notification.id}/', status_code=204)
+        self.request(visitor, 'delete', f'/your-library/{copy.id}/', status_code=204)
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user('reader@example.com', 'Rania', 'Haddad', address='Irbid')
+        cls.owner = User.objects.create_user('owner@example.com', 'Omar', 'Khalil', address='Amman')
+        books = [
+            Book.objects.create(book_name='The Hobbit', author='Tolkien', publisher='Allen & Unwin', ISBN='0261102214'),
+            Book.objects.create(book_name='Dune', author='Frank Herbert', publisher='Chilton Books'),
+            Book.objects.create(book_name='Dune Messiah', author='Frank Herbert', publisher='Putnam'),
+            Book.objects.create(book_name='Children of Dune', author='Frank Herbert', publisher='Putnam'),
+            Book.objects.create(book_name='Dune Road', author='Dune Author', publisher='Gollancz'),
+            Book.objects.create(book_name='The Silmarillion', author='Tolkien', publisher='Allen & Unwin'),
+        ]
+        cls.copies = [UserBook.objects.create(book_owner_id=cls.owner, book_id=book) for book in books]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def search(self, path):
+        return [row['id'] for row in self.client.get(path).data['results']]
+
+    def like_search(self, path):
+        with self.settings(SEARCH_BACKEND=None):
+            return self.search(path)
+
+    def test_fields_and_terms(self):
+        hobbit, dune, messiah, children, road, silmarillion = self.copies
+        self.assertEqual(set(self.search('/list/?search=tolk')), {hobbit.id, silmarillion.id})
+        self.assertEqual(self.search('/list/?search=hobbit tolkien'), [hobbit.id])
+        self.assertEqual(self.search('/list/?search=hobbit herbert'), [])
+        self.assertEqual(set(self.search('/list/?search=putnam')), {messiah.id, children.id})
+        self.assertEqual(self.search('/list/?search=02611022'), [hobbit.id])
+        self.assertEqual(len(self.search('/list/?search=khalil amman')), 6)
+        # the owner is not one of the search fields of a library
+        self.assertEqual(self.search(f'/library/{self.owner.id}/?search=khalil'), [])
+        self.assertEqual(self.search('/book-search/?search=silmar'), [silmarillion.book_id_id])
+        # nothing to search for
+        self.assertEqual(len(self.search('/list/?search=%26')), 6)
+
+    def test_same_rows_as_the_like_search(self):
+        for terms in ['dune', 'frank herbert', 'allen', 'omar']:
+            self.assertEqual(set(self.search(f'/list/?search={terms}')),
+                             set(self.like_search(f'/list/?search={terms}')), terms)
+            self.assertEqual(set(self.search(f'/book-search/?search={terms}')),
+                             set(self.like_search(f'/book-search/?search={terms}')), terms)
+
+    def test_ranked_with_bm25(self):
+        hobbit, dune, messiah, children, road, silmarillion = self.copies
+        results = self.search('/list/?search=dune')
+        # matching the title and the author first, then the shortest titles
+        self.assertEqual(results, [road.id, dune.id, messiah.id, children.id])
+        pages = [self.search('/list/?search=dune&page_size=2')]
+        data = self.client.get('/list/?search=dune&page_size=2').data
+        while data['next']:
+            data = self.client.get(data['next']).data
+            pages.append([row['id'] for row in data['results']])
+        self.assertEqual(sum(pages, []), results)
+        # an explicit ordering wins over the relevance
+        self.assertEqual(self.search('/list/?search=dune&ordering=created_at'), [dune.id, messiah.id, children.id, road.id])
+
+    def test_index_follows_the_writes(self):
+        hobbit, dune, messiah, children, road, silmarillion = self.copies
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        client.post('/add-edit/', {'book_id': hobbit.book_id_id, 'book_name': 'There and Back Again',
+                                   'author': 'Tolkien', 'categories': f'{Category.objects.create(category="Fantasy").id}'},
+                    format='multipart')
+        self.assertEqual(self.search('/list/?search=hobbit'), [])
+        self.assertEqual(self.search('/list/?search=back again'), [hobbit.id])
+
+        client.patch(f'/account/profile/{self.owner.id}/', {'last_name': 'Nassar'}, format='json')
+        self.assertEqual(len(self.search('/list/?search=nassar')), 6)
+        self.assertEqual(self.search('/list/?search=khalil'), [])
+
+        client.delete(f'/your-library/{road.id}/')
+        Book.objects.filter(id=silmarillion.book_id_id).delete()
+        self.assertEqual(set(self.search('/list/?search=nassar')), {hobbit.id, dune.id, messiah.id, children.id})
+
+        # the same documents as a rebuild
+        def documents():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT rowid, * FROM core_userbook_fts ORDER BY rowid')
+                copies = cursor.fetchall()
+                cursor.execute('SELECT rowid, * FROM core_book_fts ORDER BY rowid')
+                return copies, cursor.fetchall()
+        indexed = documents()
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(documents(), indexed)
+
+
+class SuggestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user('reader@example.com', 'Rania', 'Haddad')
+        cls.hobbit = Book.objects.create(book_name='The Hobbit', author='J. R. R. Tolkien')
+        cls.silmarillion = Book.objects.create(book_name='The Silmarillion', author='J. R. R. Tolkien')
+        cls.dune = Book.objects.create(book_name='Dune', author='Frank Herbert')
+        cls.messiah = Book.objects.create(book_name='Dune Messiah', author='Frank Herbert')
+        cls.cien = Book.objects.create(book_name='Cien años de soledad', author='Gabriel García Márquez')
+
+    def setUp(self):
+        caches['recommendations'].clear()
+        recommendation_cache._stamps.clear()
+        suggest.build()
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def suggest(self, query):
+        return [row['id'] for row in self.client.get('/book-search/suggest/', {'q': query}).data]
+
+    def test_prefixes_and_typos(self):
+        self.assertEqual(self.suggest('hob'), [self.hobbit.id])
+        self.assertEqual(self.suggest('dun'), [self.dune.id, self.messiah.id])
+        self.assertEqual(self.suggest('dune mes'), [self.messiah.id])
+        self.assertEqual(self.suggest('tolkein'), [self.hobbit.id, self.silmarillion.id])
+        self.assertEqual(self.suggest('silmarilion'), [self.silmarillion.id])
+        self.assertEqual(self.suggest('garcia anos'), [self.cien.id])
+        # every word must match
+        self.assertEqual(self.suggest('dune tolkien'), [])
+        self.assertEqual(self.suggest(' '), [])
+
+        response = self.client.get('/book-search/suggest/', {'q': 'the', 'limit': 1})
+        self.assertEqual(response.data, [{'id': self.hobbit.id, 'book_name': 'The Hobbit', 'author': 'J. R. R. Tolkien'}])
+        self.assertEqual(self.client.get('/book-search/suggest/', {'q': 'the', 'limit': 'x'}).status_code, 400)
+
+    def test_owned_books_excluded(self):
+        UserBook.objects.create(book_owner_id=self.reader, book_id=self.dune)
+        self.assertEqual(self.suggest('dune'), [self.messiah.id])
+
+    def test_patched_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.hobbit.book_name = 'There and Back Again'
+            self.hobbit.save()
+            Book.objects.filter(id=self.messiah.id).delete()
+            dracula = Book.objects.create(book_name='Dracula', author='Bram Stoker')
+        index = suggest._index
+        self.assertEqual(self.suggest('hobbit'), [])
+        self.assertEqual(self.suggest('back ag'), [self.hobbit.id])
+        self.assertEqual(self.suggest('dune'), [self.dune.id])
+        self.assertEqual(self.suggest('drac'), [dracula.id])
+        # patched in place, not rebuilt
+        self.assertIs(suggest._index, index)
+        self.assertNotIn('messiah', index.postings)
+        self.assertNotIn('messiah', index.vocabulary)
+
+    @override_settings(SHARED_VERSION_INTERVAL=3600)
+    def test_rebuilt_when_another_process_changed_a_book(self):
+        index = suggest._index
+        # changed by another process: neither its index nor its stamps are ours
+        with mock.patch.object(suggest, '_index', None), mock.patch.dict(recommendation_cache._stamps), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.dune.book_name = 'Dune (1965)'
+            self.dune.save()
+        self.assertEqual(self.suggest('1965'), [])
+        # seen once the stamp is read again
+        with self.settings(SHARED_VERSION_INTERVAL=0):
+            self.assertEqual(self.suggest('1965'), [self.dune.id])
+        self.assertIsNot(suggest._index, index)
+
+    def test_bounded_words(self):
+        index = suggest.SuggestIndex()
+        index.add(1, ' '.join(f'word{i}' for i in range(100)), 'x' * 1000)
+        self.assertEqual(len(index.vocabulary), suggest.WORDS_PER_BOOK + 1)
+        self.assertEqual(max(map(len, index.vocabulary)), suggest.WORD_LENGTH)
+        index.remove(1)
+        self.assertEqual((index.books, index.vocabulary, dict(index.postings), dict(index.variants)), ({}, [], {}, {}))
+
+
+class IsbnTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner@example.com', 'Omar', 'Khalil')
+        cls.category = Category.objects.create(category='Science')
+        cls.book = Book.objects.create(book_name='Thinking in Systems', author='Donella Meadows', ISBN='978-1-60358-055-7')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_normalize(self):
+        self.assertEqual(normalize_isbn('0-306-40615-2'), '0306406152')
+        self.assertEqual(normalize_isbn('080442957x'), '080442957X')
+        self.assertEqual(normalize_isbn(9780306406157), '9780306406157')
+        # an ISBN-10 stored as an integer lost its leading zero
+        self.assertEqual(normalize_isbn(306406152), '0306406152')
+        self.assertEqual(normalize_isbn('306406152'), '0306406152')
+        self.assertEqual(to_isbn13('0306406152'), '9780306406157')
+        self.assertEqual(to_isbn13('080442957X'), '9780804429573')
+        self.assertEqual(parse_isbn(' '), (None, None))
+        for value in ['0306406151', '9780306406158', '978030640615', 'ISBN 0306406152']:
+            with self.assertRaises(ValueError, msg=value):
+                normalize_isbn(value)
+
+    def test_stored_normalized(self):
+        self.assertEqual((self.book.ISBN, self.book.isbn13), ('9781603580557', '9781603580557'))
+        book = Book.objects.create(book_name='Old Book', author='Someone', ISBN='306406152')
+        self.assertEqual((book.ISBN, book.isbn13), ('0306406152', '9780306406157'))
+        with self.assertRaises(ValueError):
+            Book.objects.create(book_name='Bad Book', author='Someone', ISBN='0306406151')
+        # a value stored before the validation is kept as long as it doesn't change
+        Book.objects.filter(id=book.id).update(ISBN='12345', isbn13=None)
+        book = Book.objects.get(id=book.id)
+        book.book_name = 'Old Book, 2nd edition'
+        book.save()
+        self.assertEqual(Book.objects.filter(id=book.id).values_list('ISBN', 'isbn13').get(), ('12345', None))
+
+    def test_lookup(self):
+        other = Book.objects.create(book_name='Dracula', author='Bram Stoker', ISBN='0-306-40615-2')
+        for isbn in ['9780306406157', '0306406152', '978-0-306-40615-7']:
+            data = self.client.get('/book-search/', {'isbn': isbn}).data
+            self.assertEqual([row['id'] for row in data['results']], [other.id], isbn)
+        self.assertEqual(self.client.get('/book-search/', {'isbn': '9780000000002'}).data['results'], [])
+        self.assertEqual(self.client.get('/book-search/', {'isbn': '12345'}).status_code, 400)
+
+    def test_add_and_edit(self):
+        def add(isbn):
+            return self.client.post('/add-new/', {'book_name': 'New Book', 'author': 'New Author', 'ISBN': isbn,
+                                                  'categories': f'{self.category.id}', 'rating': 7}, format='multipart')
+        self.assertEqual(add('0-306-40615-2').status_code, 201)
+        book = Book.objects.get(isbn13='9780306406157')
+        self.assertEqual(book.ISBN, '0306406152')
+        # the same book, as an ISBN-13
+        self.assertEqual(add('9780306406157').status_code, 400)
+        self.assertEqual(add('0306406151').status_code, 400)
+        self.assertEqual(Book.objects.count(), 2)
+
+        def edit(isbn):
+            return self.client.post('/add-edit/', {'book_id': book.id, 'book_name': 'New Book', 'author': 'New Author',
+                                                   'ISBN': isbn, 'categories': f'{self.category.id}'},
+                                    format='multipart')
+        self.assertEqual(edit('1-60358-055-X').status_code, 400)
+        # the ISBN-10 of the other book
+        self.assertEqual(edit('1-60358-055-7').status_code, 400)
+        self.assertEqual(edit('080442957X').status_code, 200)
+        book.refresh_from_db()
+        self.assertEqual((book.ISBN, book.isbn13), ('080442957X', '9780804429573'))
+        # a value stored before the validation can be kept
+        Book.objects.filter(id=book.id).update(ISBN='12345', isbn13=None)
+        self.assertEqual(edit('12345').status_code, 200)
+
+    def test_edit_duplicate(self):
+        # the second book of an ISBN entered twice, left without isbn13 by migration 0015
+        book = Book.objects.create(book_name='Thinking in Systems', author='Donella Meadows')
+        Book.objects.filter(id=book.id).update(ISBN='9781603580557')
+        response = self.client.post('/add-edit/', {
+            'book_id': book.id, 'book_name': 'Thinking in Systems: A Primer', 'author': 'Donella Meadows',
+            'ISBN': '9781603580557', 'categories': f'{self.category.id}'}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        book.refresh_from_db()
+        self.assertEqual((book.book_name, book.ISBN, book.isbn13), ('Thinking in Systems: A Primer', '9781603580557', None))
+        # until its ISBN changes
+        book.ISBN = '0-306-40615-2'
+        book.save()
+        self.assertEqual(Book.objects.get(id=book.id).isbn13, '9780306406157')
+
+
+class FacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = generate_catalog(copies=120, books=30, users=6, categories=5, seed=7)['users']
+        for user_book in UserBook.objects.all()[::3]:
+            user_book.status, user_book.borrowed_by = False, cls.users[-1]
+            user_book.save()
+        # a book without a category
+        UserBook.objects.create(book_owner_id=cls.users[1], book_id=Book.objects.create(
+            book_name='Synthetic Uncategorized', author='Nobody'))
+
+    def setUp(self):
+        caches['recommendations'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def count(self, query):
+        # What the list returns for this query
+        count, data = 0, self.client.get(f'/list/?page_size=100&{query}').data
+        while True:
+            count += len(data['results'])
+            if not data['next']:
+                return count
+            data = self.client.get(data['next']).data
+
+    def assertFacets(self, search='', categories=(), status=''):
+        query = f'search={search}&status={status}' + ''.join(f'&book_id__categories={id}' for id in categories)
+        facets = self.client.get(f'/list/facets/?{query}').data
+        for facet in facets['categories']:
+            self.assertEqual(facet['count'], self.count(
+                f'search={search}&status={status}&book_id__categories={facet["id"]}'), (query, facet))
+        self.assertEqual({facet['id'] for facet in facets['categories']}, {
+            category.id for category in Category.objects.all() if self.count(
+                f'search={search}&status={status}&book_id__categories={category.id}')})
+        for facet in facets['status']:
+            self.assertEqual(facet['count'], self.count(query.replace(
+                f'status={status}', f'status={str(facet["status"]).lower()}')), (query, facet))
+        return facets
+
+    def test_counts(self):
+        category_ids = list(Category.objects.values_list('id', flat=True))
+        facets = self.assertFacets()
+        self.assertEqual(sum(facet['count'] for facet in facets['status']), self.count(''))
+        self.assertFacets(status='false')
+        self.assertFacets(categories=category_ids[:1])
+        self.assertFacets(categories=category_ids[1:3], status='true')
+        self.assertFacets(search='synthetic book 1')
+        self.assertEqual(self.client.get('/list/facets/?book_id__categories=x').status_code, 400)
+
+    def test_cached(self):
+        category_id = Category.objects.first().id
+        path = f'/list/facets/?search=Synthetic&book_id__categories={category_id}'
+        with self.assertNumQueries(2):
+            facets = self.client.get(path).data
+        # the same normalized query
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(f'/list/facets/?book_id__categories={category_id}&search=SYNTHETIC').data,
+                             facets)
+        # a copy lent changes the catalog
+        user_book = UserBook.objects.exclude(book_owner_id=self.users[0]).filter(
+            status=True, book_id__categories=category_id).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            user_book.status = False
+            user_book.save()
+        self.assertNotEqual(self.client.get(path).data['status'], facets['status'])
+
+
+class LendingTestCase(TestCase):
+    # An owner, a reader and the copy of a book the owner lends, for the borrowing and notification tests
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner@example.com', 'Omar', 'Khalil')
+        cls.reader = User.objects.create_user('reader@example.com', 'Rania', 'Haddad')
+        cls.copy = UserBook.objects.create(book_owner_id=cls.owner, book_id=Book.objects.create(
+            book_name='Dune', author='Frank Herbert'))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def borrow_request(self):
+        # a reader each, a reader has one pending request per copy
+        reader = User.objects.create_user(f'reader{User.objects.count()}@example.com', 'Rania', 'Haddad')
+        return Notification.objects.create(sender_id=reader, receiver_id=self.owner, user_book_id=self.copy,
+                                           type='borrow_request', message='')
+
+    def unread(self, user):
+        return User.objects.get(id=user.id).unread_notifications
+
+
+class BorrowingTests(LendingTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user('other@example.com', 'Sami', 'Nassar')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def send(self, user, type, status_code=201, **data):
+        response = self.client_for(user).post('/create-notification/', {
+            'type': type, 'user_book_id': self.copy.id, **data}, format='json')
+        self.assertEqual(response.status_code, status_code, response.data)
+        return response
+
+    def test_accept_and_return(self):
+        self.send(self.reader, 'borrow_request')
+        self.send(self.other, 'borrow_request')
+        request = Notification.objects.get(sender_id=self.reader, type='borrow_request')
+        self.send(self.owner, 'accept', notification_id=request.id, message='call me')
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrowed_by), (False, self.reader))
+        answer = Notification.objects.get(receiver_id=self.reader)
+        self.assertEqual((answer.type, answer.sender_id, answer.message), ('accept', self.owner, 'call me'))
+        self.assertFalse(Notification.objects.filter(id=request.id).exists())
+
+        # the second click, the other request and new requests find the copy lent
+        self.send(self.owner, 'accept', 404, notification_id=request.id)
+        other_request = Notification.objects.get(sender_id=self.other, type='borrow_request')
+        self.send(self.owner, 'accept', 400, notification_id=other_request.id)
+        self.send(self.other, 'borrow_request', 400)
+        self.send(self.owner, 'reject', notification_id=other_request.id, message='Lent already')
+
+        self.send(self.owner, 'return', message='Thanks')
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrowed_by), (True, None))
+        self.assertEqual(Notification.objects.get(receiver_id=self.reader, type='return').message, 'Thanks')
+        self.send(self.owner, 'return', 400)
+        self.assertEqual(sorted(Notification.objects.values_list('receiver_id', 'type')),
+                         sorted([(self.reader.id, 'accept'), (self.other.id, 'reject'), (self.reader.id, 'return')]))
+
+    def test_invalid_transitions(self):
+        self.send(self.owner, 'borrow_request', 400)
+        self.send(self.reader, 'borrow_request', 404, user_book_id=self.copy.id + 100)
+        self.send(self.reader, 'borrow_request', 404, user_book_id='x')
+        self.send(self.reader, 'lend', 400)
+        self.send(self.reader, 'borrow_request')
+        request = Notification.objects.get(type='borrow_request')
+        # only the owner answers, a request of this copy
+        self.send(self.reader, 'accept', 403, notification_id=request.id)
+        self.send(self.owner, 'accept', 404, notification_id=request.id + 1)
+        self.send(self.reader, 'return', 403)
+        self.copy.refresh_from_db()
+        self.assertTrue(self.copy.status)
+
+    def test_pending_request_coalesced(self):
+        self.send(self.reader, 'borrow_request')
+        self.send(self.reader, 'borrow_request')
+        self.send(self.other, 'borrow_request')
+        self.assertEqual(sorted(Notification.objects.values_list('sender_id', flat=True)),
+                         [self.reader.id, self.other.id])
+        self.assertEqual(User.objects.get(id=self.owner.id).unread_notifications, 2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Notification.objects.create(sender_id=self.reader, receiver_id=self.owner, user_book_id=self.copy,
+                                        type='borrow_request', message='')
+        # once answered, a new request can be sent
+        request = Notification.objects.get(sender_id=self.reader)
+        self.send(self.owner, 'reject', notification_id=request.id)
+        self.send(self.reader, 'borrow_request')
+        self.assertNotEqual(Notification.objects.get(sender_id=self.reader).id, request.id)
+
+    def test_message_validated(self):
+        self.send(self.reader, 'borrow_request')
+        request = Notification.objects.get(type='borrow_request')
+        response = self.send(self.owner, 'accept', 400, notification_id=request.id, message='x' * 201)
+        self.assertEqual(list(response.data), ['message'])
+        self.copy.refresh_from_db()
+        self.assertTrue(self.copy.status)
+        self.send(self.owner, 'accept', notification_id=request.id, message='x' * 200)
+        self.send(self.owner, 'return', 400, message='x' * 201)
+        self.copy.refresh_from_db()
+        self.assertFalse(self.copy.status)
+
+    def test_locked_in_a_transaction(self):
+        # SQLite, the other transaction wrote first; this one can't be run again inside the test's transaction
+        self.send(self.reader, 'borrow_request')
+        request = Notification.objects.get(type='borrow_request')
+        with mock.patch.object(borrowing, '_lock_owned_copy', side_effect=OperationalError('database is locked')):
+            self.send(self.owner, 'accept', 409, notification_id=request.id)
+        with mock.patch.object(borrowing, '_lock_owned_copy', side_effect=OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                borrowing.answer_request(self.copy.id, self.owner, request.id, borrowing.ACCEPT)
+
+    def test_one_read_per_row(self):
+        self.send(self.reader, 'borrow_request')
+        request = Notification.objects.get(type='borrow_request')
+        # the copy, the request, the update of the copy, the delete of the request and the insert of
+        # the answer with the unread counters of both users, in a savepoint here (the test's transaction)
+        with self.assertNumQueries(9):
+            borrowing.answer_request(self.copy.id, self.owner, request.id, borrowing.ACCEPT, 'call me')
+
+    def test_owner_marks_returned(self):
+        self.send(self.reader, 'borrow_request')
+        self.send(self.owner, 'accept', notification_id=Notification.objects.get(type='borrow_request').id)
+        response = self.client_for(self.owner).patch(f'/your-library/{self.copy.id}/', {'status': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrowed_by), (True, None))
+
+
+class BorrowingRetryTests(TransactionTestCase):
+    # Not wrapped in a transaction, a transition that lost the race on SQLite runs again
+
+    def test_retried(self):
+        owner = User.objects.create_user('owner@example.com', 'Omar', 'Khalil')
+        reader = User.objects.create_user('reader@example.com', 'Rania', 'Haddad')
+        copy = UserBook.objects.create(book_owner_id=owner, book_id=Book.objects.create(
+            book_name='Dune', author='Frank Herbert'))
+        request = borrowing.request_borrow(copy.id, reader)
+        lock_owned_copy, calls = borrowing._lock_owned_copy, []
+
+        def locked_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return lock_owned_copy(*args)
+
+        with mock.patch.object(borrowing, '_lock_owned_copy', locked_once), \
+                mock.patch.object(borrowing, 'RETRY_DELAY', 0):
+            borrowing.answer_request(copy.id, owner, request.id, borrowing.ACCEPT, 'call me')
+            self.assertEqual(len(calls), 2)
+            copy.refresh_from_db()
+            self.assertEqual(copy.borrowed_by, reader)
+            # the second click, run again, finds the request answered
+            with self.assertRaises(borrowing.RequestNotFound):
+                borrowing.answer_request(copy.id, owner, request.id, borrowing.ACCEPT)
+
+
+class PushTests(LendingTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token, _ = Token.objects.get_or_create(user=cls.owner)
+        # verified, like TokenAuthentication the stream refuses the inactive users
+        User.objects.filter(id=cls.owner.id).update(is_active=True)
+
+    def test_published_after_commit(self):
+        subscription = push.broker.subscribe(self.owner.id)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                notification = self.borrow_request()
+            published = subscription.get(timeout=0)
+            self.assertEqual([(row['id'], row['sender_name'], row['book_name']) for row in published],
+                             [(notification.id, 'Rania Haddad', 'Dune')])
+            # serialized once, with what the list shows
+            with self.assertNumQueries(1):
+                push.publish(notification.id, self.owner.id)
+        finally:
+            push.broker.unsubscribe(subscription)
+        self.assertFalse(push.broker.listening(self.owner.id))
+        # nobody listening, nothing read
+        with self.assertNumQueries(0):
+            push.publish(notification.id, self.owner.id)
+
+    def test_long_poll(self):
+        first, second = self.borrow_request(), self.borrow_request()
+        data = self.client.get('/notifications/poll/', {'after': first.id - 1}).data
+        self.assertEqual([row['id'] for row in data], [first.id, second.id])
+        self.assertEqual(self.client.get('/notifications/poll/', {'after': second.id, 'timeout': 0}).data, [])
+        self.assertEqual(self.client.get('/notifications/poll/', {'after': 'x'}).status_code, 400)
+
+        # answered as soon as a notification is pushed
+        timer = threading.Timer(0.2, push.broker.publish, [self.owner.id, {'id': second.id + 1}])
+        timer.start()
+        start = time.perf_counter()
+        data = self.client.get('/notifications/poll/', {'after': second.id, 'timeout': 5}).data
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(data, [{'id': second.id + 1}])
+
+    def stream(self, headers=(), query=b'', until=lambda body: True, method='GET'):
+        # Runs the ASGI application of /notifications/stream/ until the body sent so far passes until,
+        # the headers of the response are left in self.response_headers
+        scope = {'type': 'http', 'method': method, 'path': push.STREAM_PATH, 'headers': list(headers),
+                 'query_string': query}
+        messages = []
+
+        async def run():
+            inbox = asyncio.Queue()
+            sent = asyncio.Event()
+
+            async def send(message):
+                messages.append(message)
+                sent.set()
+
+            task = asyncio.ensure_future(push.with_notification_stream(None)(scope, inbox.get, send))
+            while not task.done() and not until(b''.join(message.get('body', b'') for message in messages)):
+                sent.clear()
+                await asyncio.wait_for(sent.wait(), 5)
+                await self.on_stream_sent(messages)
+            await inbox.put({'type': 'http.disconnect'})
+            await asyncio.wait_for(task, 5)
+
+        async_to_sync(run)()
+        self.response_headers = dict(messages[0]['headers'])
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages).decode()
+
+    async def on_stream_sent(self, messages):
+        pass
+
+    def events(self, body):
+        return [json.loads(line[len('data: '):]) for line in body.splitlines() if line.startswith('data: ')]
+
+    def test_stream(self):
+        status_code, body = self.stream()
+        self.assertEqual((status_code, body), (401, '{"detail": "Authentication credentials were not provided."}'))
+
+        missed = self.borrow_request()
+        pushed = []
+
+        async def push_one(messages):
+            # once the stream is open, a new notification (the missed one may already be sent too)
+            if len(messages) >= 2 and not pushed:
+                pushed.append(await sync_to_async(self.borrow_request)())
+                await sync_to_async(push.publish)(pushed[0].id, self.owner.id)
+        self.on_stream_sent = push_one
+
+        # the missed ones first (Last-Event-ID after a reconnection), then the new ones
+        status_code, body = self.stream(
+            headers=[(b'last-event-id', str(missed.id - 1).encode())], query=f'token={self.token.key}'.encode(),
+            until=lambda body: body.count(b'event: notification') == 2)
+        self.assertEqual(status_code, 200)
+        self.assertEqual([(row['id'], row['type']) for row in self.events(body)],
+                         [(missed.id, 'borrow_request'), (pushed[0].id, 'borrow_request')])
+        self.assertIn(f'id: {pushed[0].id}\n', body)
+        self.assertFalse(push.broker.listening(self.owner.id))
+
+    def test_stream_cors(self):
+        # like the other routes, through CorsMiddleware
+        authorization = (b'authorization', f'Token {self.token.key}'.encode())
+        status_code, _ = self.stream(headers=[authorization, (b'origin', b'http://localhost:3000')])
+        self.assertEqual(status_code, 200)
+        self.assertEqual(self.response_headers[b'access-control-allow-origin'], b'http://localhost:3000')
+        self.assertEqual(self.client.get('/notifications/', HTTP_ORIGIN='http://localhost:3000')[
+            'Access-Control-Allow-Origin'], 'http://localhost:3000')
+        # the error can be read too
+        status_code, _ = self.stream(headers=[(b'origin', b'http://localhost:3000')])
+        self.assertEqual((status_code, self.response_headers[b'access-control-allow-origin']),
+                         (401, b'http://localhost:3000'))
+
+        self.stream(headers=[authorization, (b'origin', b'http://evil.example.com')])
+        self.assertNotIn(b'access-control-allow-origin', self.response_headers)
+        with self.settings(CORS_ALLOW_ALL_ORIGINS=True):
+            self.stream(headers=[authorization, (b'origin', b'http://evil.example.com')])
+        self.assertEqual(self.response_headers[b'access-control-allow-origin'], b'*')
+
+        # the preflight of a client sending the Authorization header
+        status_code, _ = self.stream(method='OPTIONS', headers=[
+            (b'origin', b'http://localhost:3000'), (b'access-control-request-method', b'GET')])
+        self.assertEqual(status_code, 200)
+        self.assertIn(b'authorization', self.response_headers[b'access-control-allow-headers'])
+
+    def test_stream_keep_alive(self):
+        # without a last id, only the new ones; at each keep-alive, those created by another process
+        old = self.borrow_request()
+        created = []
+
+        async def create_elsewhere(messages):
+            if len(messages) == 2 and not created:
+                created.append(await sync_to_async(self.borrow_request)())
+        self.on_stream_sent = create_elsewhere
+        with self.settings(NOTIFICATION_STREAM_KEEPALIVE=0.1):
+            status_code, body = self.stream(headers=[(b'authorization', f'Token {self.token.key}'.encode())],
+                                            until=lambda body: b'event: notification' in body)
+        self.assertIn(': keep-alive', body)
+        self.assertEqual([row['id'] for row in self.events(body)], [created[0].id])
+        self.assertNotEqual(created[0].id, old.id)
+
+
+class UnreadTests(LendingTestCase):
+
+    def test_counter(self):
+        first, second, third = self.borrow_request(), self.borrow_request(), self.borrow_request()
+        self.assertEqual(self.unread(self.owner), 3)
+        first.is_read = True
+        first.save()
+        first.save()
+        self.assertEqual(self.unread(self.owner), 2)
+        # deleting a read one changes nothing
+        first.delete()
+        second.delete()
+        self.assertEqual(self.unread(self.owner), 1)
+        third = Notification.objects.get(id=third.id)
+        third.is_read = True
+        third.save()
+        third.is_read = False
+        third.save()
+        self.assertEqual(self.unread(self.owner), 1)
+        self.assertEqual(self.unread(self.reader), 0)
+
+    def test_mark_read(self):
+        first, second, third = self.borrow_request(), self.borrow_request(), self.borrow_request()
+        # the ids of another user are ignored
+        other = Notification.objects.create(sender_id=self.owner, receiver_id=self.reader, user_book_id=self.copy,
+                                            type='accept', message='')
+        # like the token authentication, the user and its counter are read by each request
+        self.client.force_authenticate(User.objects.get(id=self.owner.id))
+        response = self.client.post('/notifications/read/', {'ids': [first.id, other.id]}, format='json')
+        self.assertEqual(response.data, {'unread': 2})
+        self.assertEqual(response.data, self.client.post('/notifications/read/', {'ids': [first.id]},
+                                                         format='json').data)
+        self.assertFalse(Notification.objects.get(id=other.id).is_read)
+        self.assertEqual(self.client.post('/notifications/read/', format='json').data, {'unread': 0})
+        self.assertEqual(list(Notification.objects.filter(receiver_id=self.owner, is_read=False)), [])
+        self.assertEqual((self.unread(self.owner), self.unread(self.reader)), (0, 1))
+        response = self.client.post('/notifications/read/', {'ids': 'all'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_count(self):
+        self.borrow_request()
+        self.borrow_request()
+        user = User.objects.get(id=self.owner.id)
+        self.client.force_authenticate(user)
+        with self.assertNumQueries(0):
+            response = self.client.get('/notifications/count/')
+        self.assertEqual(response.data, {'unread': 2})
+
+    def test_repair(self):
+        notification = self.borrow_request()
+        Notification.objects.create(sender_id=self.owner, receiver_id=self.reader, user_book_id=self.copy,
+                                    type='accept', message='', is_read=True)
+        User.objects.filter(id=self.owner.id).update(unread_notifications=0)
+        User.objects.filter(id=self.reader.id).update(unread_notifications=4)
+        self.assertEqual(unread.repair_unread(User, Notification.objects.all()), 2)
+        self.assertEqual((self.unread(self.owner), self.unread(self.reader)), (1, 0))
+        self.assertEqual(unread.repair_unread(User, Notification.objects.all()), 0)
+        # never below 0
+        User.objects.filter(id=self.owner.id).update(unread_notifications=0)
+        notification.delete()
+        self.assertEqual(self.unread(self.owner), 0)
+
+
+class RetentionTests(LendingTestCase):
+
+    def notify(self, sender, receiver, type, days_ago, is_read=False):
+        notification = Notification.objects.create(sender_id=sender, receiver_id=receiver, user_book_id=self.copy,
+                                                   type=type, message='', is_read=is_read)
+        Notification.objects.filter(id=notification.id).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return notification
+
+    def test_prune(self):
+        pending = self.notify(self.reader, self.owner, 'borrow_request', 400)
+        recent = self.notify(self.owner, self.reader, 'accept', 10)
+        for days_ago in (100, 200, 300):
+            self.notify(self.owner, self.reader, 'reject', days_ago)
+        self.notify(self.owner, self.reader, 'return', 150, is_read=True)
+        self.assertEqual((self.unread(self.owner), self.unread(self.reader)), (1, 4))
+
+        out = StringIO()
+        call_command('prune_notifications', '--batch-size=2', stdout=out)
+        self.assertIn('4 notifications older than 90 days deleted.', out.getvalue())
+        self.assertEqual(set(Notification.objects.values_list('id', flat=True)), {pending.id, recent.id})
+        self.assertEqual((self.unread(self.owner), self.unread(self.reader)), (1, 1))
+
+        call_command('prune_notifications', '--days=5', stdout=out)
+        self.assertEqual(list(Notification.objects.values_list('id', flat=True)), [pending.id])
+        self.assertEqual((self.unread(self.owner), self.unread(self.reader)), (1, 0))
+        with self.assertRaises(CommandError):
+            call_command('prune_notifications', '--batch-size=0')
+
+    def test_batches(self):
+        for days_ago in range(100, 105):
+            self.notify(self.owner, self.reader, 'reject', days_ago)
+        # a batch: the old rows, the read update, the counter, the rows of the delete and the delete, in a
+        # savepoint here (the test's transaction); the last one finds nothing
+        with self.assertNumQueries(3 * 7 + 3):
+            self.assertEqual(retention.prune_notifications(timezone.now() - timedelta(days=90), batch_size=2), 5)
+        self.assertEqual(self.unread(self.reader), 0)
@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, Value
+from django.db.models.functions import Greatest
+
+############################## Unread notification counters ##################################
+# User.unread_notifications is the number of its received notifications not read yet, so
+# that the badge of the navbar (/notifications/count/) reads one column of the user row
+# the token authentication already loaded. The signals in core/signals.py keep it up to date
+# on create, delete and on a save that reads a notification, mark_read on the bulk reads,
+# always with a single UPDATE with F() expressions like the rating aggregates.
+
+
+def add_unread(user_ids, count):
+    # Never below 0, even if a counter was wrong
+    get_user_model().objects.filter(pk__in=user_ids).update(
+        unread_notifications=Greatest(F('unread_notifications') + count, Value(0)))
+
+
+def mark_read(user, notification_ids=None):
+    # Mark these notifications of user as read (all of them when notification_ids is None),
+    # returns how many were unread
+    from .models import Notification
+
+    with transaction.atomic():
+        unread = Notification.objects.filter(receiver_id=user, is_read=False)
+        if notification_ids is not None:
+            unread = unread.filter(id__in=notification_ids)
+        count = unread.update(is_read=True)
+        if count:
+            add_unread([user.id], -count)
+    user.unread_notifications = max(user.unread_notifications - count, 0)
+    return count
+
+
+def repair_unread(user_model, notifications):
+    # Recompute the counters that don't match the notifications, returns how many there were.
+    # Also used by the migration that adds the column, with the historical models.
+    actual = dict(notifications.filter(is_read=False).values('receiver_id').annotate(
+        count=Count('id')).values_list('receiver_id', 'count'))
+    stale = [user_model(pk=pk, unread_notifications=actual.get(pk, 0))
+             for pk, count in user_model.objects.values_list('pk', 'unread_notifications')
+             if count != actual.get(pk, 0)]
+    user_model.objects.bulk_update(stale, ['unread_notifications'], batch_size=1000)
+    return len(stale)
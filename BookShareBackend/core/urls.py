@@ -4,10 +4,12 @@ from . import views
 
 urlpatterns = [
     path('list/', views.BookUserList.as_view(), name='book_user_list'),
+    path('list/facets/', views.BookUserFacets.as_view(), name='book_user_facets'),
     path('recommended-for-you/', views.RecommendedForYou.as_view(), name='recommended_for_you'),
     path('top-rated/', views.TopRated.as_view(), name='top_rated'),
 
     path('book-search/', views.BookSearch.as_view(), name='book_search'),
+    path('book-search/suggest/', views.BookSuggest.as_view(), name='book_suggest'),
     path('book-general/<int:pk>/', views.BookGeneralDetails.as_view(), name='book_general_details'),
     path('categories/', views.CategoriesView.as_view(), name='get_categories'),
     path('add-new/', views.AddNewBookView.as_view(), name='add_new_book'),
@@ -28,5 +30,8 @@ urlpatterns = [
 
     path('create-notification/', views.NotificationRequest.as_view(), name='create_notification'),
     path('notifications/', views.NotificationList.as_view(), name='list_notifications'),
+    path('notifications/poll/', views.NotificationPoll.as_view(), name='poll_notifications'),
+    path('notifications/count/', views.NotificationCount.as_view(), name='count_notifications'),
+    path('notifications/read/', views.NotificationRead.as_view(), name='read_notifications'),
     path('notification-delete/<int:pk>/', views.NotificationDestroy.as_view(), name='delete_notification'),
 ]
@@ -9,51 +9,135 @@ from .permissions import *
 from django_filters.rest_framework import DjangoFilterBackend
 from user_app.models import User
 from django.shortcuts import get_object_or_404
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import CountVectorizer
-from django.db.models import Count, Avg
-# from .recommender import *
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+import hashlib
+import json
+import random
+import re
+from . import borrowing, collaborative, push, recommendation_cache, unread
+from .facets import count_facets
+from .isbn import normalize_isbn, parse_isbn, to_isbn13
+from .pagination import IdKeysetPagination, KeysetPagination
+from .recommender import get_recommendations_for_books, top_rated_snapshot
+from .search import FullTextSearchFilter
+from .suggest import suggest
+from .similarity import recommendation_records, similar_books
+
+def with_book_details(queryset):
+    # Load everything UserBookSerializer/YourBooksSerializer read (the book, its categories,
+    # the owner and the borrower) with the page, so a page costs the same queries whatever its size
+    return queryset.select_related('book_id', 'book_owner_id', 'borrowed_by').prefetch_related('book_id__categories')
+
 
 ######################### Home Page (List of all books) with search/Filter/ordering #################
 # /list/?search=dfgd&book_id__categories=&status=
+# The search reads the full-text index (see core/search.py), the best matches first
+# The lists are paginated (see core/pagination.py): {"next": <url>, "previous": <url>, "results": [...]},
+# ?page_size= up to 100, follow the next/previous urls for the other pages
 
 
 class BookUserList(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 3
     queryset = UserBook.objects.all()
     serializer_class = serializers.UserBookSerializer
-    filter_backends = [filters.SearchFilter,
+    pagination_class = KeysetPagination
+    filter_backends = [FullTextSearchFilter,
                        DjangoFilterBackend, filters.OrderingFilter]
-    search_fields = ['book_id__book_name', 'book_id__author', 'book_id__ISBN',
+    search_fields = ['book_id__book_name', 'book_id__author', 'book_id__ISBN', 'book_id__publisher',
                      'book_owner_id__first_name', 'book_owner_id__last_name', 'book_owner_id__address']
     filterset_fields = ['book_id__categories', 'status']
     ordering_fields = ['created_at']
 
     def get_queryset(self):
         user = self.request.user
-        return UserBook.objects.exclude(book_owner_id=user)
+        return with_book_details(UserBook.objects.exclude(book_owner_id=user))
+
+
+# /list/facets/?search=dfgd&book_id__categories=&status=
+# The counts of the copies by category and by status for the same search and filters (see core/facets.py):
+# {"categories": [{"id": 1, "category": "Novel", "count": 12}, ...], "status": [{"status": true, "count": 30}, ...]}
+class BookUserFacets(BookUserList):
+    # The categories query validates ?book_id__categories=, only on a cache miss
+    query_budget = 3
+
+    def get(self, request, *args, **kwargs):
+        filterset = DjangoFilterBackend().get_filterset(request, self.get_queryset(), self)
+        # The normalized query, the order and the case of the terms don't change the results
+        terms = sorted({term.lower() for term in FullTextSearchFilter().get_search_terms(request)})
+        categories = sorted(set(request.query_params.getlist('book_id__categories')) - {''})
+        status_filter = filterset.form.fields['status'].widget.value_from_datadict(request.query_params, None, 'status')
+        key = hashlib.md5(json.dumps([terms, categories, status_filter]).encode()).hexdigest()
+
+        def compute():
+            if not filterset.is_valid():
+                raise ValidationError(filterset.errors)
+            queryset = FullTextSearchFilter().filter_queryset(
+                request, UserBook.objects.exclude(book_owner_id=request.user), self)
+            category_ids = [category.id for category in filterset.form.cleaned_data['book_id__categories']]
+            return count_facets(queryset, category_ids, filterset.form.cleaned_data['status'])
+
+        data = recommendation_cache.get_or_compute(
+            'facets', request.user.id, recommendation_cache.availability_version(), key, compute=compute,
+            timeout=settings.FACETS_TIMEOUT)
+        return Response(data, status=status.HTTP_200_OK)
 
 
 ################################### add a book page 1 (search) #######################################
-# /book/?search=
+# /book-search/?search= or ?isbn=
 class BookSearch(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 3
     queryset = Book.objects.all()
     serializer_class = serializers.BookSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ['book_name', 'author', 'ISBN']
+    pagination_class = IdKeysetPagination
+    filter_backends = [FullTextSearchFilter]
+    search_fields = ['book_name', 'author', 'ISBN', 'publisher']
 
     # To ensure that the books returned are not owned by the user before
     def get_queryset(self):
         user = self.request.user
         # return Book.objects.exclude(owners=user).distinct()
-        return Book.objects.exclude(owners=user)
+        queryset = Book.objects.exclude(owners=user).prefetch_related('categories')
+        # ?isbn= (a scanned barcode) is an exact lookup on the unique index, see core/isbn.py
+        isbn = self.request.query_params.get('isbn')
+        if isbn is not None:
+            try:
+                queryset = queryset.filter(isbn13=to_isbn13(normalize_isbn(isbn)))
+            except ValueError:
+                raise ValidationError({'isbn': ['Enter a valid ISBN-10 or ISBN-13.']})
+        return queryset
+
+
+# /book-search/suggest/?q=hobb&limit=10
+class BookSuggest(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    # The suggestions come from memory, the queries are for the books the user owns, the version
+    # stamp of the index (every SHARED_VERSION_INTERVAL seconds) and a rebuild
+    query_budget = 4
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 20)
+        except ValueError:
+            return Response({'detail': 'The limit must be a number.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not query.strip():
+            return Response([], status=status.HTTP_200_OK)
+        # Like the book search, without the books the user already owns
+        owned = set(UserBook.objects.filter(book_owner_id=request.user).values_list('book_id', flat=True))
+        data = [{'id': book_id, 'book_name': book_name, 'author': author}
+                for book_id, book_name, author in suggest(query, limit, exclude=owned)]
+        return Response(data, status=status.HTTP_200_OK)
 
 
 class BookGeneralDetails(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
-    queryset = Book.objects.all()
+    query_budget = 3
+    queryset = Book.objects.prefetch_related('categories')
     serializer_class = serializers.BookSerializer
 
 ################################### add a book page 2 (new) ##########################################
@@ -61,8 +145,12 @@ class BookGeneralDetails(generics.RetrieveAPIView):
 
 class AddNewBookView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
+    # With the term index of the book, its queued similarity update and the autocomplete stamp on commit
+    query_budget = 48
     serializer_class = serializers.BookSerializer
 
+    # One transaction, so the book, its copy and its rating are indexed together on commit
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
 
         book_serializer = self.get_serializer(data=request.data)
@@ -101,11 +189,25 @@ class AddNewBookView(generics.CreateAPIView):
 
 class AddEditBook(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
+    # With the term index of the book and its queued similarity update on commit
+    query_budget = 40
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         user_id = request.user.id
         book_id = request.data.get('book_id')
         rating = request.data.get('rating')
+        book = Book.objects.get(id=book_id)
+
+        # Checked before writing anything, an unchanged ISBN is kept even if it was stored before the validation
+        isbn = request.data.get('ISBN')
+        if isbn != book.ISBN:
+            try:
+                isbn, isbn13 = parse_isbn(isbn)
+            except ValueError:
+                return Response({'detail': 'Enter a valid ISBN-10 or ISBN-13.'}, status=status.HTTP_400_BAD_REQUEST)
+            if isbn13 and Book.objects.filter(isbn13=isbn13).exclude(id=book.id).exists():
+                return Response({'detail': 'A book with this ISBN already exists.'}, status=status.HTTP_400_BAD_REQUEST)
 
         # First we check if the book has rating or not
         book_rating_qs = BookRating.objects.filter(
@@ -159,13 +261,12 @@ class AddEditBook(generics.CreateAPIView):
             user_book_serializer.save()
 
         # Edit the Book information
-        book = Book.objects.get(id=book_id)
         book.book_name = request.data.get('book_name')
         book.author = request.data.get('author')
         book.publisher = request.data.get('publisher')
         book.description = request.data.get('description')
         book.year = request.data.get('year')
-        book.ISBN = request.data.get('ISBN')
+        book.ISBN = isbn
 
         category_ids = request.data.get('categories').split(
             ',')  # split string into list of ids
@@ -189,6 +290,7 @@ class AddEditBook(generics.CreateAPIView):
 
 class CategoriesView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 2
     queryset = Category.objects.all()
     serializer_class = serializers.CategorySerializer
 
@@ -198,9 +300,11 @@ class CategoriesView(generics.ListAPIView):
 
 class YourBooksList(generics.ListAPIView):
     permission_classes = [IsAuthenticated & IsOwner]
+    query_budget = 3
     queryset = UserBook.objects.all()
     serializer_class = serializers.YourBooksSerializer
-    filter_backends = [filters.SearchFilter,
+    pagination_class = KeysetPagination
+    filter_backends = [FullTextSearchFilter,
                        DjangoFilterBackend, filters.OrderingFilter]
     search_fields = ['book_id__book_name', 'book_id__author', 'book_id__ISBN']
     filterset_fields = ['book_id__categories', 'status']
@@ -208,13 +312,15 @@ class YourBooksList(generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return UserBook.objects.filter(book_owner_id=user)
+        return with_book_details(UserBook.objects.filter(book_owner_id=user))
 
 # Repost Functionality
 
 
 class RepostOrDelete(generics.UpdateAPIView, generics.DestroyAPIView):
     permission_classes = [IsAuthenticated & IsOwner]
+    # Deleting a copy updates the term index of the book and queues its similarity update on commit
+    query_budget = 20
     queryset = UserBook.objects.all()
     serializer_class = serializers.YourBooksSerializer
     # {
@@ -224,15 +330,13 @@ class RepostOrDelete(generics.UpdateAPIView, generics.DestroyAPIView):
 
     def patch(self, request, *args, **kwargs):
         instance = self.get_object()
+        # Check if status is being updated to True: the book was returned (see core/borrowing.py)
+        if request.data.get('status') is True and not instance.status:
+            instance = borrowing.return_copy(instance.id, instance.book_owner_id, notify=False)
         serializer = self.get_serializer(
             instance, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
 
-        # Check if status is being updated to True
-        if 'status' in request.data and request.data['status'] is True:
-            # Set borrowed_by to null
-            instance.borrowed_by = None
-
         serializer.save()
         return Response(serializer.data)
 
@@ -241,9 +345,11 @@ class RepostOrDelete(generics.UpdateAPIView, generics.DestroyAPIView):
 
 class LibraryBooksList(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 3
     queryset = UserBook.objects.all()
     serializer_class = serializers.UserBookSerializer
-    filter_backends = [filters.SearchFilter,
+    pagination_class = KeysetPagination
+    filter_backends = [FullTextSearchFilter,
                        DjangoFilterBackend, filters.OrderingFilter]
     search_fields = ['book_id__book_name', 'book_id__author', 'book_id__ISBN']
     filterset_fields = ['book_id__categories', 'status']
@@ -251,22 +357,23 @@ class LibraryBooksList(generics.ListAPIView):
 
     def get_queryset(self):
         pk = self.kwargs.get('pk')  # Get the pk parameter from the URL
-        return UserBook.objects.filter(book_owner_id=pk)
+        return with_book_details(UserBook.objects.filter(book_owner_id=pk))
 
 
 class UserRatingDetailView(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 3
     queryset = UserRating.objects.all()
     serializer_class = serializers.UserRatingSerializer
 
     def get(self, request, *args, **kwargs):
         pk = self.kwargs.get('pk')  # Get the pk parameter from the URL
         user_rater_id = request.user.id
-        user_rating_qs = UserRating.objects.filter(
-            user_rated_id=pk, user_rater_id=user_rater_id)
+        # The aggregates of the rated user are read with the rating, in one row
+        user_rating = UserRating.objects.filter(
+            user_rated_id=pk, user_rater_id=user_rater_id).select_related('user_rated_id').first()
 
-        if user_rating_qs.exists():
-            user_rating = user_rating_qs.first()
+        if user_rating:
             serializer = self.serializer_class(user_rating)
             return Response(serializer.data, status=status.HTTP_200_OK)
         else:
@@ -280,6 +387,7 @@ class UserRatingDetailView(generics.RetrieveAPIView):
 
 class UserRatingCreateView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 8
     queryset = UserRating.objects.all()
 
     def post(self, request, *args, **kwargs):
@@ -313,12 +421,14 @@ class UserRatingCreateView(generics.CreateAPIView):
 
 class BookDetails(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
-    queryset = UserBook.objects.all()
+    query_budget = 3
+    queryset = with_book_details(UserBook.objects.all())
     serializer_class = serializers.UserBookSerializer
 
 
 class SameBookView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 4
     queryset = UserBook.objects.all()
     serializer_class = serializers.UserBookSerializer
 
@@ -326,16 +436,13 @@ class SameBookView(generics.ListAPIView):
         user = self.request.user
         pk = self.kwargs.get('pk')
         # Get all books that are similar to this one but don't show the book we're on and don't show the book if the user owns it
-        similar_books = UserBook.objects.filter(book_id=UserBook.objects.get(
-            pk=pk).book_id).exclude(id=pk).exclude(book_owner_id=user)
-        if similar_books.exists():
-            return similar_books
-        else:
-            return UserBook.objects.none()
+        book_id = UserBook.objects.get(pk=pk).book_id_id
+        return with_book_details(UserBook.objects.filter(book_id=book_id).exclude(id=pk).exclude(book_owner_id=user))
 
 
 class BookRatingDetailView(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 6
     queryset = BookRating.objects.all()
     serializer_class = serializers.BookRatingSerializer
 
@@ -362,6 +469,7 @@ class BookRatingDetailView(generics.RetrieveAPIView):
 
 class BookRatingCreateView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 14
     queryset = UserRating.objects.all()
 
     def post(self, request, *args, **kwargs):
@@ -411,75 +519,100 @@ class BookRatingCreateView(generics.CreateAPIView):
 
 class NotificationRequest(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
+    # With the signals of a lent copy on commit
+    query_budget = 12
     queryset = Notification.objects.all()
 
+    # {"type": "borrow_request", "user_book_id": 1}
+    # {"type": "accept" or "reject", "user_book_id": 1, "notification_id": <the borrow request>, "message": "..."}
+    # {"type": "return", "user_book_id": 1, "message": "..."}
+    # The transitions of the copy are in core/borrowing.py, they raise the errors of the API
     def post(self, request, *args, **kwargs):
-        type = request.data.get('type')
-        user_book_qs = UserBook.objects.filter(
-            id=request.data.get('user_book_id'))
-
-        if not user_book_qs.exists():
-            return Response({'detail': 'The Book does not exist.'}, status=status.HTTP_404_NOT_FOUND)
-
-        if (type == 'accept' or type == 'reject') and not (user_book_qs.first().book_owner_id.id == request.user.id):
-            return Response({'detail': 'You do not have permission to perform this action.'}, status=status.HTTP_403_FORBIDDEN)
-
-        if type == 'borrow_request' and not user_book_qs.first().status:
-            return Response({'detail': 'This book is already borrowed.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        notification_data = {}
-
-        if type == 'borrow_request':
-            notification_data = {
-                'sender_id': request.user.id,
-                'receiver_id': user_book_qs.first().book_owner_id.id,
-                'user_book_id': user_book_qs.first().id,
-                'type': type,
-                'message': ''
-            }
+        kind = request.data.get('type')
+        user_book_id = request.data.get('user_book_id')
+        message = request.data.get('message')
+
+        if kind == borrowing.BORROW_REQUEST:
+            borrowing.request_borrow(user_book_id, request.user)
+        elif kind in (borrowing.ACCEPT, borrowing.REJECT):
+            borrowing.answer_request(user_book_id, request.user, request.data.get('notification_id'), kind, message)
+        elif kind == borrowing.RETURN:
+            borrowing.return_copy(user_book_id, request.user, message)
         else:
-            notification_data = {
-                'sender_id': request.user.id,
-                'receiver_id': request.data.get('receiver_id'),
-                'user_book_id': user_book_qs.first().id,
-                'type': type,
-                'message': request.data.get('message')
-            }
-
-        # if type == 'accept' we must modify the 'status' and 'borrowed_by' fields in the UserBook model
-        if type == 'accept':
-            user_book = user_book_qs.first()
-            user_book.status = False
-            user_book.borrowed_by = User.objects.get(
-                id=request.data.get('receiver_id'))
-            user_book.save()
-
-        notification_serializer = serializers.NotificationsSerializer(
-            data=notification_data)
-        notification_serializer.is_valid(raise_exception=True)
-        notification_serializer.save()
-
-        if not(type == 'borrow_request'):
-            # Delete the borrow request notification
-            notification = Notification.objects.filter(id = request.data.get('notification_id'))
-            notification.first().delete()
+            return Response({'detail': 'Unknown notification type.'}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'detail': 'The notification has been sent successfully.'}, status=status.HTTP_201_CREATED)
-        # return Response(notification_serializer.data, status=status.HTTP_201_CREATED)
 
 
 class NotificationList(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 2
     queryset = Notification.objects.all()
     serializer_class = serializers.NotificationsSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         user = self.request.user
-        return Notification.objects.filter(receiver_id=user)
+        # The names NotificationsSerializer shows, with the page
+        return Notification.objects.filter(receiver_id=user).select_related(
+            'sender_id', 'receiver_id', 'user_book_id__book_id')
+
+
+# /notifications/count/, the badge of the navbar: {"unread": 3}
+class NotificationCount(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    # The counter is a column of the user row the token authentication loads (see core/unread.py)
+    query_budget = 1
+
+    def get(self, request, *args, **kwargs):
+        return Response({'unread': request.user.unread_notifications}, status=status.HTTP_200_OK)
+
+
+# /notifications/read/ {"ids": [1, 2]}, without ids all the notifications of the user are read
+class NotificationRead(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    # The user, then the notifications and the counter updated in a transaction
+    query_budget = 4
+
+    def post(self, request, *args, **kwargs):
+        ids = request.data.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(id, int) for id in ids)):
+            return Response({'detail': 'ids must be a list of notification ids.'}, status=status.HTTP_400_BAD_REQUEST)
+        unread.mark_read(request.user, ids)
+        return Response({'unread': request.user.unread_notifications}, status=status.HTTP_200_OK)
+
+
+# /notifications/poll/?after=<the last notification id>&timeout=25
+# Long-polling, for the clients that can't keep the event stream of /notifications/stream/ (see core/push.py):
+# the notifications after that id, the oldest first, as soon as there are some ([] after the timeout).
+# The wait holds the worker thread, it needs threaded or ASGI workers.
+class NotificationPoll(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    # Waiting doesn't run queries, the notifications pushed meanwhile are already serialized
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        try:
+            after = int(request.query_params.get('after', 0))
+            timeout = min(max(float(request.query_params.get('timeout', settings.NOTIFICATION_POLL_TIMEOUT)), 0),
+                          settings.NOTIFICATION_POLL_TIMEOUT)
+        except ValueError:
+            return Response({'detail': 'after and timeout must be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Subscribed before reading the database, so that nothing falls between the two
+        subscription = push.broker.subscribe(request.user.id)
+        try:
+            data = push.notifications_after(request.user.id, after)
+            if not data:
+                data = [notification for notification in subscription.get(timeout) if notification['id'] > after]
+        finally:
+            push.broker.unsubscribe(subscription)
+        return Response(data, status=status.HTTP_200_OK)
 
 
 class NotificationDestroy(generics.DestroyAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 5
     queryset = Notification.objects.all()
     serializer_class = serializers.NotificationsSerializer
 
@@ -496,113 +629,10 @@ class NotificationDestroy(generics.DestroyAPIView):
 
 ############################## Recommender functionalities ##################################
 
-# version 1.0
-def get_recommendations(id, user_id):
-    # Load UserBooks into a DataFrame
-    user_books = pd.DataFrame.from_records(UserBook.objects.all().values(
-        'id', 'book_owner_id', 'book_id', 'book_id__book_name', 'book_id__author', 'book_id__categories__category', 'book_image_url'))
-
-    ratings_df = pd.DataFrame.from_records(BookRating.objects.all().values())
-
-    # get all the books rated by this user as a list
-    rated_books = ratings_df.loc[ratings_df['book_rater_id_id']
-                                 == user_id, 'book_id_id'].tolist()
-
-    user_books['book_image_url'] = user_books['book_image_url'].apply(
-        lambda x: 'http://127.0.0.1:8000/media/' + x)
-
-    # Renaming the columns
-    user_books = user_books.rename(columns={
-        'id': 'user_book_id',
-        'book_id__book_name': 'book_name',
-        'book_owner_id': 'owner_id',
-        'book_id__author': 'author',
-        'book_id__categories__category': 'categories__category',
-        'book_image_url': 'image_url'
-    })
-
-    # Grouping the data (Grouping categories)
-    # lambda function uses the filter() function
-    # to remove any None values from the set before joining the remaining values with ', '.
-    data = user_books.groupby('user_book_id').agg({
-        'book_id': 'first',
-        'owner_id': 'first',
-        'book_name': 'first',
-        'author': 'first',
-        'categories__category': lambda x: ', '.join(set(filter(None, x))),
-        'image_url': 'first'
-    }).reset_index()
-
-    # get all the books owned by this user as a list
-    owned_books = data.loc[data['owner_id'] == user_id, 'book_id'].tolist()
-
-    cleaned_data = data.copy()
-
-    # Function to convert all strings to lower case and strip names of spaces
-    def clean_data(x):
-        # Check if auther exists. If not, return empty string
-        if isinstance(x, str):
-            out = str.lower(x.replace(" ", ""))
-            output_string = out.replace(',', ' ')
-            return output_string
-        else:
-            return ''
-
-    # Apply clean_data function to your features.
-    features = ['author', 'categories__category']
-
-    for feature in features:
-        cleaned_data[feature] = cleaned_data[feature].apply(clean_data)
-
-    def create_metadata(x):
-        return x['author'] + ' ' + x['categories__category']
-    cleaned_data['metadata'] = cleaned_data.apply(create_metadata, axis=1)
-
-    count = CountVectorizer(stop_words='english')
-    count_matrix = count.fit_transform(cleaned_data['metadata'])
-
-    cosine_sim = cosine_similarity(count_matrix, count_matrix)
-
-    print(data)
-    print(cosine_sim)
-
-    index = data.index[data['user_book_id'] == id][0]
-    same_book_id = data[data['user_book_id'] == id]['book_id'].iloc[0]
-
-    similarity_series = pd.Series(
-        cosine_sim[index]).sort_values(ascending=False)
-    list_index = similarity_series[similarity_series > 0.3].index.tolist()
-
-    recommended_data = data.iloc[list_index]
-
-    # drop the same books
-    recommended_data = recommended_data[~(
-        recommended_data['book_id'] == same_book_id)]
-
-    # drop all books that owned by this user
-    recommended_data = recommended_data[~recommended_data['book_id'].isin(
-        owned_books)]
-
-    # drop all books that rated by this user
-    recommended_data = recommended_data[~recommended_data['book_id'].isin(
-        rated_books)]
-
-    # drop duplicate books
-    recommended_data.drop_duplicates(['book_id'], keep='last', inplace=True)
-
-    # get only first 10 books
-    if recommended_data.shape[0] > 10:
-        recommended_data = recommended_data[:10]
-
-    # convert dataframe to dictionary
-    # We used the 'records' option in the to_dict() method
-    # to convert the DataFrame to a list of dictionaries, where each dictionary represents a row in the DataFrame.
-    recommended_data_dict = recommended_data.to_dict('records')
-    return recommended_data_dict
-
-
 class MoreLikeThisView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    # With the read of the index version stamp, every SHARED_VERSION_INTERVAL seconds
+    query_budget = 4
     queryset = UserBook.objects.all()
 
     def get(self, request, *args, **kwargs):
@@ -611,103 +641,88 @@ class MoreLikeThisView(generics.ListAPIView):
         user_id = request.user.id
 
         # check if the book exists
-        user_book_qs = UserBook.objects.filter(id=user_book_id)
-        if not user_book_qs.exists():
+        user_book = UserBook.objects.filter(id=user_book_id).first()
+        if not user_book:
             return Response({'detail': 'The Book does not exist.'}, status=status.HTTP_404_NOT_FOUND)
 
-        data = get_recommendations(user_book_id, user_id)
+        # The neighbours are precomputed in the similarity index, we only filter them for this user
+        data = recommendation_cache.get_or_compute(
+            'more-like', user_id, recommendation_cache.index_version(), user_book.book_id_id,
+            compute=lambda: similar_books(user_book.book_id_id, user_id))
         return Response(data, status=status.HTTP_200_OK)
 
 
 class RecommendedForYou(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 8
     queryset = UserBook.objects.all()
 
     def get(self, request, *args, **kwargs):
         user_id = request.user.id
 
-        # We use "order_by('?')" to randomly order the books and only the first 5 books are selected
-        rated_books = BookRating.objects.filter(
-            book_rater_id=user_id, book_rating__gt=6).order_by('?')[:5]
-
-        if rated_books.count() == 0:
-            return Response({'detail': "You need to rate more books to get our Recommendations."}, status=status.HTTP_404_NOT_FOUND)
-            # return Response({'detail': "You need to rate at least 5 books to get our Recommendations."}, status=status.HTTP_404_NOT_FOUND)
-
-        # List of dictionaries
-        data = []
-        for rated_book in rated_books:
-            # get the id of the book
-            book_id = rated_book.book_id
-            user_book = UserBook.objects.filter(book_id=book_id).first()
-
-            if user_book:
-                user_book_id = user_book.id
-                # check if there are any recommendations for this book
-                recommendations = get_recommendations(user_book_id, user_id)
-                if recommendations:
-                    for recommendation in recommendations[0:2]:
-                        data.append(recommendation)
+        # The result is cached until the catalog, this user's books/ratings or the trained model change
+        data, status_code = recommendation_cache.get_or_compute(
+            'for-you', user_id, collaborative.model_version(), compute=lambda: self.recommend(user_id))
+        return Response(data, status=status_code)
+
+    def recommend(self, user_id):
+        # Collaborative filtering first, when it is on and the trained model knows this user well enough
+        min_ratings = settings.COLLABORATIVE_MIN_RATINGS
+        data = collaborative.recommend(user_id, min_ratings=min_ratings) if min_ratings is not None else None
+        if data:
+            return data, status.HTTP_200_OK
+
+        # Otherwise content-based recommendations from the books this user liked
+        rated_books = list(BookRating.objects.filter(
+            book_rater_id=user_id, book_rating__gt=6).values_list('book_id', flat=True))
+
+        if len(rated_books) == 0:
+            return {'detail': "You need to rate more books to get our Recommendations."}, status.HTTP_404_NOT_FOUND
+            # return {'detail': "You need to rate at least 5 books to get our Recommendations."}, status.HTTP_404_NOT_FOUND
+
+        # The list stored by "python manage.py precompute_recommendations", when it is up to date
+        data = self.precomputed(user_id)
+        if data is None:
+            # Pick up to 5 random books among the ones this user rated highly.
+            # Sampling the ids in Python avoids sorting the whole table with "order_by('?')"
+            seed_books = random.sample(rated_books, min(5, len(rated_books)))
+
+            # List of dictionaries, 2 recommendations for every seed book without duplicates
+            data = get_recommendations_for_books(seed_books, user_id)
 
         if not data:
-            return Response({'detail': "We're sorry, but we don't have any book recommendations for you yet."}, status=status.HTTP_404_NOT_FOUND)
+            return {'detail': "We're sorry, but we don't have any book recommendations for you yet."}, status.HTTP_404_NOT_FOUND
 
-        # drop the duplicate books
-        df = pd.DataFrame(data)
-        df.drop_duplicates(['book_id'], keep='first', inplace=True)
-        data = df.to_dict('records')
+        return data, status.HTTP_200_OK
 
-        return Response(data, status=status.HTTP_200_OK)
+    def precomputed(self, user_id):
+        # None when the list is missing or older than the last change of this user
+        if not RecommendationState.objects.filter(user_id=user_id, computed_version=F('version')).exists():
+            return None
+        book_ids = list(Recommendation.objects.filter(user_id=user_id).values_list('book_id', flat=True))
+        return recommendation_records(book_ids)
 
 
+# /top-rated/?category=<category id>&window=30d
 class TopRated(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 7
 
     def get(self, request, *args, **kwargs):
-        # Calculate the average rating and number of ratings for each book
-        books = Book.objects.annotate(
-            avg_rating=Avg('bookrating__book_rating'),
-            num_ratings=Count('bookrating')
-        ).values('id', 'book_name', 'avg_rating', 'num_ratings', 'categories__category')
-
-        books_df = pd.DataFrame.from_records(books)
-
-        books_df = books_df.groupby('id').agg({
-            'book_name': 'first',
-            'avg_rating': 'first',
-            'num_ratings': 'first',
-            'categories__category': lambda x: ', '.join(set(filter(None, x)))
-        }).reset_index()
-
-        # C is the mean rate across the whole books list
-        C = books_df['avg_rating'].mean()
-        # m is the minimum rates required to be listed in the chart
-        # In other words, for a book to feature in the charts, it must have more rates than at least 90% of the books in the list.
-        m = books_df['num_ratings'].quantile(0.9)
-        # We filter out the books that qualify for the chart
-        q_books = books_df.copy().loc[books_df['num_ratings'] >= m]
-
-        def weighted_rating(x, m=m, C=C):
-            v = x['num_ratings']
-            R = x['avg_rating']
-            # Calculation based on the IMDB formula
-            return (v/(v+m) * R) + (m/(m+v) * C)
-
-        # Define a new feature 'score' and calculate its value with `weighted_rating()`
-        q_books['score'] = q_books.apply(weighted_rating, axis=1)
-        # Sort movies based on score calculated above
-        q_books = q_books.sort_values('score', ascending=False)[:10]
-
-        def get_user_book_id(row):
-            userbook = UserBook.objects.filter(book_id=row['id']).first()
-            return userbook.id
-
-        def get_image(row):
-            userbook = UserBook.objects.filter(book_id=row['id']).first()
-            return 'http://127.0.0.1:8000' + userbook.book_image_url.url
-
-        q_books['user_book_id'] = q_books.apply(get_user_book_id, axis=1)
-        q_books['image_url'] = q_books.apply(get_image, axis=1)
-
-        q_books_dict = q_books.to_dict('records')
-        return Response(q_books_dict, status=status.HTTP_200_OK)
+        category = request.query_params.get('category')
+        window = request.query_params.get('window')
+
+        if category is not None:
+            if not category.isdigit() or not Category.objects.filter(id=category).exists():
+                return Response({'detail': 'The category does not exist.'}, status=status.HTTP_404_NOT_FOUND)
+            category = int(category)
+
+        days = None
+        if window is not None:
+            match = re.fullmatch(r'([1-9][0-9]{0,2})d', window)
+            if not match:
+                return Response({'detail': 'The window must be a number of days, like 30d.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            days = int(match.group(1))
+
+        return Response(top_rated_snapshot(category, days), status=status.HTTP_200_OK)
@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+def fill_aggregates(apps, schema_editor):
+    # The new columns, from the ratings every user received
+    from django.db.models import Count, Sum
+
+    User = apps.get_model('user_app', 'User')
+    users = [User(id=user_id, rating_sum=total, rating_count=count, avg_rating=total / count)
+             for user_id, total, count in apps.get_model('core', 'UserRating').objects.values('user_rated_id').annotate(
+                 total=Sum('user_rating'), count=Count('id')).values_list('user_rated_id', 'total', 'count')]
+    User.objects.bulk_update(users, ['rating_sum', 'rating_count', 'avg_rating'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_book_rating_aggregates'),
+        ('user_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avg_rating',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+def fill_unread(apps, schema_editor):
+    from core.unread import repair_unread
+
+    repair_unread(apps.get_model('user_app', 'User'), apps.get_model('core', 'Notification').objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_notification_is_read'),
+        ('user_app', '0002_user_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_unread, migrations.RunPython.noop),
+    ]
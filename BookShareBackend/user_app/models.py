@@ -7,7 +7,7 @@ from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
-from core.models import Book, UserBook, UserRating
+from core.models import Book, UserBook
 
 
 def upload_to(instance, filename):
@@ -60,6 +60,12 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     # Field to store verification token
     verification_token = models.CharField(max_length=64, null=True, blank=True)
+    # Aggregates of the UserRatings received by this user, kept up to date by core/signals.py
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    avg_rating = models.FloatField(default=0, editable=False)
+    # The received notifications not read yet, kept up to date by core/signals.py (see core/unread.py)
+    unread_notifications = models.PositiveIntegerField(default=0, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name']
@@ -92,27 +98,13 @@ class User(AbstractBaseUser, PermissionsMixin):
         self.save()
     
     def calculate_avg_rating(self):
-        # Get all UserBook objects for this book
-        user_ratings = UserRating.objects.filter(user_rated_id=self)
-
-        # Calculate the average rating for this book
-        total_rating = sum(user_rating.user_rating for user_rating in user_ratings)
-        num_ratings = user_ratings.count()
-        if num_ratings > 0:
-            avg_rating = round(total_rating / num_ratings, 1)
-        else:
-            avg_rating = 0
-
-        return avg_rating
+        # The average rating received by this user, rounded like it's displayed
+        if self.rating_count > 0:
+            return round(self.avg_rating, 1)
+        return 0
 
     def calculate_number_rating(self):
-        # Get all UserBook objects for this book
-        user_ratings = UserRating.objects.filter(user_rated_id=self)
-
-        # Get the number of ratings for this book
-        num_ratings = user_ratings.count()
-
-        return num_ratings
+        return self.rating_count
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -1,3 +1,46 @@
-from django.test import TestCase
+from django.core import mail
+from django.test import TransactionTestCase, override_settings
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from core.query_budget import view_budget
+from . import urls
+from .models import User
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class RouteBudgetTests(TransactionTestCase):
+    # Every route of user_app/urls.py, QueryBudgetMiddleware raises when one runs over its budget
+
+    def request(self, client, method, path, data=None, status_code=200, format='json'):
+        response = getattr(client, method)(path, data, format=format)
+        self.assertEqual(response.status_code, status_code, path)
+        return response
+
+    def test_every_route_declares_a_budget(self):
+        for pattern in urls.urlpatterns:
+            self.assertIsNotNone(view_budget(pattern.callback), pattern.name)
+
+    def test_account_routes(self):
+        client = APIClient()
+        self.request(client, 'post', '/account/register/', {
+            'email': 'reader@example.com', 'first_name': 'Book', 'last_name': 'Reader', 'phone_number': '0788888888',
+            'address': 'Amman', 'password': 'first-secret', 'confirm_password': 'first-secret'}, 201)
+        user = User.objects.get(email='reader@example.com')
+        self.request(client, 'get', f'/account/verify-email/{user.verification_token}/')
+
+        token = self.request(client, 'post', '/account/login/',
+                             {'username': 'reader@example.com', 'password': 'first-secret'}).data['token']
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.request(client, 'get', f'/account/{user.id}/')
+        self.request(client, 'get', f'/account/profile/{user.id}/')
+        self.request(client, 'patch', f'/account/profile/{user.id}/', {'about': 'I read a lot.'})
+        self.request(client, 'put', '/account/change-password/', {
+            'current_password': 'first-secret', 'new_password': 'second-secret',
+            'confirm_new_password': 'second-secret'})
+
+        self.request(client, 'post', '/account/password-reset/', {'email': 'reader@example.com'})
+        user.refresh_from_db()
+        self.request(client, 'post', '/account/password-reset-confirm/',
+                     {'password': 'third-secret', 'verification_token': user.verification_token})
+        self.request(client, 'post', '/account/logout/')
+        self.assertEqual(len(mail.outbox), 3)
@@ -12,6 +12,7 @@ from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.serializers import ValidationError
 from .permissions import *
 from rest_framework.permissions import IsAuthenticated
+from core.query_budget import query_budget
 
 
 User = get_user_model()
@@ -19,12 +20,14 @@ User = get_user_model()
 
 class ProfileInfo(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 2
     queryset = User.objects.all()
     serializer_class = serializers.ProfileInfoSerializer
 
 
 class ChangePassword(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated]
+    query_budget = 3
     queryset = User.objects.all()
     serializer_class = serializers.ChangePasswordSerializer
 
@@ -37,11 +40,13 @@ class ChangePassword(generics.UpdateAPIView):
 
 class ProfileDetail(generics.RetrieveUpdateAPIView):
     permission_classes = [IsAuthenticated & IsOwnerOrReadOnly]
+    query_budget = 4
     queryset = User.objects.all()
     serializer_class = serializers.ProfileSerializer
 
 
 class CustomAuthToken(ObtainAuthToken):
+    query_budget = 3
 
     def post(self, request, *args, **kwargs):
         username = request.data["username"]
@@ -69,6 +74,7 @@ class CustomAuthToken(ObtainAuthToken):
         })
 
 
+@query_budget(2)
 @api_view(['POST'])
 @permission_classes((permissions.IsAuthenticated,))
 def logout_view(request):
@@ -76,6 +82,7 @@ def logout_view(request):
     return Response({'success': 'Logged out successfully'}, status=status.HTTP_200_OK)
 
 
+@query_budget(2)
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
 def verify_email(request, token):
@@ -86,6 +93,7 @@ def verify_email(request, token):
     return Response({'success': 'Email verification successful'}, status=status.HTTP_200_OK)
 
 
+@query_budget(5)
 @api_view(['POST'])
 @permission_classes((permissions.AllowAny,))
 def registration_view(request):
@@ -106,6 +114,7 @@ def registration_view(request):
 
 class PasswordResetView(generics.GenericAPIView):
     permission_classes = [permissions.AllowAny]
+    query_budget = 5
     serializer_class = serializers.PasswordResetSerializer
 
     def post(self, request, *args, **kwargs):
@@ -122,6 +131,7 @@ class PasswordResetView(generics.GenericAPIView):
 
 
 class PasswordResetConfirmView(generics.GenericAPIView):
+    query_budget = 5
     serializer_class = serializers.PasswordResetConfirmSerializer
 
     def post(self, request, *args, **kwargs):